@@ -0,0 +1,142 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Common utilities for the benchmarks: timing, saving results as JSON, and
+comparing two result files.
+
+A result file is a JSON object with two keys: "metadata" (git commit,
+python version, platform, and time of the run) and "results", which maps
+each benchmark name to a dict containing at least "events",
+"ns_per_event", and "events_per_sec".
+"""
+import sys
+import os
+import os.path
+import json
+import time
+import platform
+import subprocess
+import datetime
+
+# time.perf_counter_ns() is not available before Python 3.7
+perf_counter_ns = getattr(time, 'perf_counter_ns', None) or \
+                  (lambda: int(time.perf_counter()*1000000000))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'results')
+
+# Changes in ns/event smaller than this percentage are reported as noise
+DEFAULT_THRESHOLD_PCT = 5.0
+
+
+def git_commit():
+    """Return the short hash of the current commit, or None if we are not
+    in a git repository.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_metadata():
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'timestamp': datetime.datetime.now().isoformat()}
+
+
+def make_result(events, elapsed_ns, **extra):
+    """Convert an event count and elapsed time to a result dict.
+    """
+    elapsed_ns = max(elapsed_ns, 1)
+    r = {'events': events,
+         'elapsed_ns': elapsed_ns,
+         'ns_per_event': elapsed_ns/events,
+         'events_per_sec': events*1000000000.0/elapsed_ns}
+    r.update(extra)
+    return r
+
+
+def time_best_of(setup_fn, events, repeats):
+    """Call setup_fn() to get a zero-argument run function, then time the
+    run function. This is repeated and the fastest time is returned as a
+    result dict. The setup time is not included.
+    """
+    best = None
+    for i in range(repeats):
+        run = setup_fn()
+        start = perf_counter_ns()
+        run()
+        elapsed = perf_counter_ns() - start
+        if best is None or elapsed<best:
+            best = elapsed
+    return make_result(events, best, repeats=repeats)
+
+
+def save_results(results, filename=None, prefix='bench'):
+    """Save the results along with the metadata for this run. If filename
+    is not specified, the file is written to RESULTS_DIR and named after
+    the prefix and the current commit. Returns the filename.
+    """
+    metadata = get_metadata()
+    if filename is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        filename = os.path.join(RESULTS_DIR, '%s-%s.json' %
+                                (prefix, metadata['commit'] or 'nocommit'))
+    with open(filename, 'w') as f:
+        json.dump({'metadata':metadata, 'results':results}, f, indent=2,
+                  sort_keys=True)
+    return filename
+
+
+def load_results(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def compare_results(old, new, threshold_pct=DEFAULT_THRESHOLD_PCT,
+                    file=sys.stdout):
+    """Print a comparison of two result files (as returned by load_results()).
+    Returns the names of benchmarks whose ns/event went up by more than
+    threshold_pct percent.
+    """
+    regressions = []
+    print("Comparing %s (old) to %s (new)" %
+          (old['metadata'].get('commit'), new['metadata'].get('commit')),
+          file=file)
+    print("%-45s %12s %12s %8s" % ('benchmark', 'old ns/ev', 'new ns/ev',
+                                   'change'), file=file)
+    for name in sorted(set(old['results']) & set(new['results'])):
+        o = old['results'][name]
+        n = new['results'][name]
+        change = 100.0*(n['ns_per_event']-o['ns_per_event'])/o['ns_per_event']
+        if change > threshold_pct:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif change < -threshold_pct:
+            flag = '  faster'
+        else:
+            flag = ''
+        print("%-45s %12.1f %12.1f %+7.1f%%%s" %
+              (name[:45], o['ns_per_event'], n['ns_per_event'], change, flag),
+              file=file)
+    for (label, a, b) in (('old', old, new), ('new', new, old)):
+        missing = sorted(set(a['results']) - set(b['results']))
+        if len(missing)>0:
+            print("Only in %s: %s" % (label, ', '.join(missing)), file=file)
+    return regressions
+
+
+def print_results(results, file=sys.stdout):
+    print("%-45s %12s %14s" % ('benchmark', 'ns/event', 'events/sec'),
+          file=file)
+    for name in sorted(results):
+        r = results[name]
+        print("%-45s %12.1f %14.0f" % (name[:45], r['ns_per_event'],
+                                       r['events_per_sec']), file=file)
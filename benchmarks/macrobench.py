@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+End-to-end macro-benchmarks, built from the example scenarios and scaled up
+to many virtual sensors.
+
+There are two scenarios:
+
+ * solar_heater - the graph from examples/solar_heater_scenario.py (running
+   average transducer, dispatch, controller state machine, and actuator),
+   one copy per sensor.
+ * median_queue - the scenario from examples/event_library_comparison:
+   each sample is written to a (null) CSV writer and every 5 samples the
+   median is sent to a message queue. The queue is simulated in memory: a
+   send is a coroutine that yields to the event loop once. The scenario is
+   implemented in three variants, following the code in that directory:
+   thingflow, asyncawait, and callbacks (continuation passing style).
+
+All sensors are sampled periodically on the main event loop. For each run,
+we report the sustained throughput (events/sec), the maximum event loop lag
+(how late a periodic probe callback ran), and the growth in resident memory.
+If the offered load (sensors/interval) is more than the implementation can
+handle, the throughput levels off and the loop lag grows.
+
+Examples::
+
+    python3 macrobench.py                        # all scenarios, default size
+    python3 macrobench.py --sensors 5000 --events-per-sensor 400 median_queue
+"""
+import sys
+import os.path
+import argparse
+import asyncio
+import contextlib
+import gc
+import resource
+import time
+from collections import deque
+from statistics import median
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '../examples')))
+
+from thingflow.base import InputThing, SensorEvent, SensorAsOutputThing,\
+    Scheduler
+from thingflow.adapters.async_generic import AsyncInputThing
+from thingflow.filters.transducer import PeriodicMedianTransducer
+import thingflow.filters.transducer
+import thingflow.filters.dispatch
+import thingflow.filters.combinators
+import solar_heater_scenario as shs
+
+from benchutils import perf_counter_ns, make_result, save_results,\
+    load_results, compare_results
+
+DEFAULT_SENSORS = 1000
+DEFAULT_EVENTS_PER_SENSOR = 100
+DEFAULT_INTERVAL = 0.01 # seconds between samples for each sensor
+PROBE_INTERVAL = 0.01   # seconds between loop lag probes
+MEDIAN_PERIOD = 5
+
+
+class VirtualSensor:
+    """A sensor that cycles through a precomputed waveform, so sampling
+    is cheap and the runs are repeatable. The values swing between about
+    95 and 115, crossing the solar heater thresholds.
+    """
+    WAVEFORM = [round(105 + 10*((i%40)-20)/20.0*(1 if (i//40)%2==0 else -1), 1)
+                for i in range(160)]
+
+    def __init__(self, sensor_id, stop_after_events):
+        self.sensor_id = sensor_id
+        self.stop_after_events = stop_after_events
+        self.count = 0
+        self.offset = sensor_id % len(self.WAVEFORM)
+
+    def sample(self):
+        if self.count==self.stop_after_events:
+            raise StopIteration
+        self.count += 1
+        return self.WAVEFORM[(self.offset+self.count)%len(self.WAVEFORM)]
+
+    def __repr__(self):
+        return 'VirtualSensor(%s)' % self.sensor_id
+
+
+class LoopMonitor:
+    """Measure the event loop lag by scheduling a probe callback every
+    PROBE_INTERVAL seconds and recording how late it ran.
+    """
+    def __init__(self, loop, interval=PROBE_INTERVAL):
+        self.loop = loop
+        self.interval = interval
+        self.max_lag = 0.0
+        self.handle = None
+
+    def _probe(self, expected):
+        lag = self.loop.time() - expected
+        if lag>self.max_lag:
+            self.max_lag = lag
+        expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(expected, self._probe, expected)
+
+    def start(self):
+        expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(expected, self._probe, expected)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+def get_rss_kb():
+    """Return the current resident set size in KB. We use /proc if available,
+    falling back to the maximum RSS reported by getrusage().
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*resource.getpagesize()//1024
+    except (OSError, IOError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on Mac OS X and KB on Linux
+        return maxrss//1024 if sys.platform=='darwin' else maxrss
+
+
+async def simulated_publish(counter):
+    """Simulate sending a message to the queue: yield to the event loop
+    once, as a network client would.
+    """
+    await asyncio.sleep(0)
+    counter[0] += 1
+
+
+def null_csv_writer(event):
+    pass
+
+
+###########################################################################
+#                          Solar heater scenario                           #
+###########################################################################
+
+class CountingActuator(InputThing):
+    def __init__(self, counter):
+        self.counter = counter
+
+    def on_next(self, x):
+        self.counter[0] += 1
+
+
+def run_solar_heater(loop, sensors, events_per_sensor, interval, counter):
+    scheduler = Scheduler(loop)
+    for i in range(sensors):
+        sensor = SensorAsOutputThing(VirtualSensor(i, events_per_sensor))
+        dispatcher = sensor.transduce(shs.RunningAvg(4))\
+                           .dispatch([(lambda v: v[2]>=shs.T_high, 't_high'),
+                                      (lambda v: v[2]<=shs.T_low, 't_low')])
+        controller = shs.Controller()
+        dispatcher.connect(controller, port_mapping=('t_high', 't_high'))
+        dispatcher.connect(controller, port_mapping=('t_low', 't_low'))
+        dispatcher.connect(controller, port_mapping=('default', 'between'))
+        controller.connect(CountingActuator(counter))
+        scheduler.schedule_periodic(sensor, interval)
+    return scheduler.run_forever
+
+
+###########################################################################
+#                          Median to queue scenario                        #
+###########################################################################
+
+class SimulatedQueueWriter(AsyncInputThing):
+    def __init__(self, scheduler, counter):
+        super().__init__(scheduler)
+        self.counter = counter
+
+    async def _write_batch(self, events):
+        await simulated_publish(self.counter)
+
+
+def run_median_queue_thingflow(loop, sensors, events_per_sensor, interval,
+                               counter):
+    scheduler = Scheduler(loop)
+    for i in range(sensors):
+        sensor = SensorAsOutputThing(VirtualSensor(i, events_per_sensor))
+        sensor.connect(null_csv_writer)
+        sensor.transduce(PeriodicMedianTransducer(MEDIAN_PERIOD))\
+              .connect(SimulatedQueueWriter(scheduler, counter))
+        scheduler.schedule_periodic(sensor, interval)
+    return scheduler.run_forever
+
+
+def _median_stepper():
+    """A plain version of PeriodicMedianTransducer, as used by the non-ThingFlow
+    variants.
+    """
+    samples = []
+    def step(event):
+        samples.append(event.val)
+        if len(samples)==MEDIAN_PERIOD:
+            e = SensorEvent(sensor_id=event.sensor_id, ts=event.ts,
+                            val=median(samples))
+            del samples[:]
+            return e
+        return None
+    def complete():
+        return median(samples) if len(samples)>0 else None
+    return (step, complete)
+
+
+def run_median_queue_asyncawait(loop, sensors, events_per_sensor, interval,
+                                counter):
+    """Follows examples/event_library_comparison/asyncawait.py"""
+    remaining = [sensors]
+
+    async def sample_and_process(sensor, step, complete):
+        try:
+            sample = sensor.sample()
+        except StopIteration:
+            if complete() is not None:
+                await simulated_publish(counter)
+            return False
+        event = SensorEvent(sensor_id=sensor.sensor_id, ts=time.time(),
+                            val=sample)
+        null_csv_writer(event)
+        median_event = step(event)
+        if median_event:
+            await simulated_publish(counter)
+        return True
+
+    def start_sensor(sensor):
+        (step, complete) = _median_stepper()
+        def loop_fn():
+            task = loop.create_task(sample_and_process(sensor, step, complete))
+            def done_callback(f):
+                exc = f.exception()
+                if exc:
+                    raise exc
+                elif f.result()==False:
+                    remaining[0] -= 1
+                    if remaining[0]==0:
+                        loop.stop()
+                else:
+                    loop.call_later(interval, loop_fn)
+            task.add_done_callback(done_callback)
+        loop.call_later(interval, loop_fn)
+
+    for i in range(sensors):
+        start_sensor(VirtualSensor(i, events_per_sensor))
+    return loop.run_forever
+
+
+class CallbackQueueWriter:
+    """Follows MqttWriter in examples/event_library_comparison/event.py:
+    sends are serialized, with later requests queued until the pending one
+    completes.
+    """
+    def __init__(self, loop, counter):
+        self.loop = loop
+        self.counter = counter
+        self.pending_task = None
+        self.request_queue = deque()
+
+    def _request_done(self, f, completion_cb, error_cb):
+        self.pending_task = None
+        exc = f.exception()
+        if exc:
+            self.loop.call_soon(error_cb, exc)
+        else:
+            self.loop.call_soon(completion_cb)
+        if len(self.request_queue)>0:
+            self.loop.call_soon(self._process_queue)
+
+    def _start(self, completion_cb, error_cb):
+        self.pending_task = self.loop.create_task(
+            simulated_publish(self.counter))
+        self.pending_task.add_done_callback(
+            lambda f: self._request_done(f, completion_cb, error_cb))
+
+    def _process_queue(self):
+        (msg, completion_cb, error_cb) = self.request_queue.popleft()
+        self._start(completion_cb, error_cb)
+
+    def send(self, msg, completion_cb, error_cb):
+        if self.pending_task:
+            self.request_queue.append((msg, completion_cb, error_cb))
+        else:
+            self._start(completion_cb, error_cb)
+
+
+def run_median_queue_callbacks(loop, sensors, events_per_sensor, interval,
+                               counter):
+    """Follows examples/event_library_comparison/event.py"""
+    remaining = [sensors]
+    def error_cb(e):
+        loop.stop()
+        raise e
+
+    def start_sensor(sensor):
+        (step, complete) = _median_stepper()
+        writer = CallbackQueueWriter(loop, counter)
+        def completion_cb(more):
+            if more:
+                loop.call_later(interval, sample_and_process)
+            else:
+                remaining[0] -= 1
+                if remaining[0]==0:
+                    loop.stop()
+        def sample_and_process():
+            try:
+                sample = sensor.sample()
+            except StopIteration:
+                if complete() is not None:
+                    writer.send(None, lambda: completion_cb(False), error_cb)
+                else:
+                    completion_cb(False)
+                return
+            event = SensorEvent(sensor_id=sensor.sensor_id, ts=time.time(),
+                                val=sample)
+            null_csv_writer(event)
+            median_event = step(event)
+            if median_event:
+                writer.send(median_event, lambda: completion_cb(True),
+                            error_cb)
+            else:
+                completion_cb(True)
+        loop.call_later(interval, sample_and_process)
+
+    for i in range(sensors):
+        start_sensor(VirtualSensor(i, events_per_sensor))
+    return loop.run_forever
+
+
+# map from benchmark name to the function that builds it. Each function
+# sets up the scenario on the loop and returns a function to run it.
+SCENARIOS = [
+    ('solar_heater.thingflow', run_solar_heater),
+    ('median_queue.thingflow', run_median_queue_thingflow),
+    ('median_queue.asyncawait', run_median_queue_asyncawait),
+    ('median_queue.callbacks', run_median_queue_callbacks),
+]
+
+
+def run_scenario(build_fn, sensors, events_per_sensor, interval):
+    gc.collect()
+    loop = asyncio.new_event_loop()
+    counter = [0] # outputs (actuator events or queue messages)
+    rss_start = get_rss_kb()
+    run = build_fn(loop, sensors, events_per_sensor, interval, counter)
+    monitor = LoopMonitor(loop)
+    monitor.start()
+    start = perf_counter_ns()
+    try:
+        run()
+    finally:
+        elapsed = perf_counter_ns() - start
+        monitor.stop()
+        loop.close()
+    rss_end = get_rss_kb()
+    return make_result(sensors*events_per_sensor, elapsed,
+                       sensors=sensors, interval=interval,
+                       offered_events_per_sec=sensors/interval,
+                       outputs=counter[0],
+                       max_loop_lag_ms=monitor.max_lag*1000.0,
+                       rss_start_kb=rss_start, rss_end_kb=rss_end,
+                       rss_growth_kb=rss_end-rss_start)
+
+
+def run_benchmarks(sensors=DEFAULT_SENSORS,
+                   events_per_sensor=DEFAULT_EVENTS_PER_SENSOR,
+                   interval=DEFAULT_INTERVAL, patterns=None, verbose=True):
+    results = {}
+    devnull = open(os.devnull, 'w')
+    try:
+        for (name, build_fn) in SCENARIOS:
+            if patterns and not any(p in name for p in patterns):
+                continue
+            # the scheduler prints progress messages
+            with contextlib.redirect_stdout(devnull):
+                r = run_scenario(build_fn, sensors, events_per_sensor,
+                                 interval)
+            results[name] = r
+            if verbose:
+                print("%-25s %10.0f events/sec %8.1f ms max lag %8d KB rss growth"
+                      % (name, r['events_per_sec'], r['max_loop_lag_ms'],
+                         r['rss_growth_kb']))
+    finally:
+        devnull.close()
+    return results
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sensors', type=int, default=DEFAULT_SENSORS,
+                        help="Number of virtual sensors (default %s)" %
+                             DEFAULT_SENSORS)
+    parser.add_argument('--events-per-sensor', type=int,
+                        default=DEFAULT_EVENTS_PER_SENSOR,
+                        help="Number of samples per sensor (default %s)" %
+                             DEFAULT_EVENTS_PER_SENSOR)
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help="Sample interval in seconds (default %s)" %
+                             DEFAULT_INTERVAL)
+    parser.add_argument('--output', default=None,
+                        help="JSON file for the results (default "
+                             "results/macro-COMMIT.json)")
+    parser.add_argument('--compare', default=None, metavar='OLD_JSON',
+                        help="Compare the results to a previous results file")
+    parser.add_argument('patterns', nargs='*',
+                        help="Only run scenarios whose names contain one of "
+                             "these strings")
+    args = parser.parse_args(argv)
+    print("%d sensors, %d events/sensor, offered load %.0f events/sec" %
+          (args.sensors, args.events_per_sensor, args.sensors/args.interval))
+    results = run_benchmarks(args.sensors, args.events_per_sensor,
+                             args.interval, args.patterns)
+    filename = save_results(results, args.output, prefix='macro')
+    print("Wrote results to %s" % filename)
+    if args.compare:
+        compare_results(load_results(args.compare), load_results(filename))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Micro-benchmarks for the dispatch core and the built-in filters.
+
+Each benchmark is a function that takes the number of events and builds a
+graph, returning a zero-argument function that pushes the events through
+the graph. Only the run function is timed, and we keep the fastest of
+several repeats. Events are pushed by calling _dispatch_next() directly on
+a plain OutputThing, so the loop overhead is included in the numbers (see
+the baseline.loop benchmark).
+
+Run via "make bench" from the top level directory, or directly::
+
+    python3 microbench.py [--output FILE] [--compare OLD.json] [PATTERN ...]
+
+The results are written as JSON (by default to results/micro-COMMIT.json),
+so that the results from two commits can be compared with --compare.
+"""
+import sys
+import os.path
+import argparse
+import asyncio
+import contextlib
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from thingflow.base import OutputThing, InputThing, Scheduler, SensorEvent,\
+    EventLoopOutputThingMixin, from_iterable
+import thingflow.filters.map
+import thingflow.filters.select
+import thingflow.filters.where
+import thingflow.filters.scan
+import thingflow.filters.skip
+import thingflow.filters.take
+import thingflow.filters.first
+import thingflow.filters.some
+import thingflow.filters.codec
+from thingflow.codecs import get_codec, StructCodec
+import thingflow.filters.buffer
+import thingflow.filters.dispatch
+import thingflow.filters.json
+from thingflow.filters.json import SENSOR_EVENT_SCHEMA
+import thingflow.filters.output
+import thingflow.filters.combinators
+from thingflow.filters.timeout import EventWatcher
+from thingflow.filters.transducer import SensorSlidingMean
+from thingflow.filters.dispatch import Dispatcher
+
+from benchutils import time_best_of, save_results, load_results,\
+    compare_results
+
+DEFAULT_EVENTS = 100000
+DEFAULT_REPEATS = 5
+
+# List of (name, setup_fn, events_scale, per) tuples, in definition order.
+# The number of events for a benchmark is events_scale times the --events
+# argument. per describes what is counted as one "event".
+BENCHMARKS = []
+
+
+def benchmark(name, events_scale=1.0, per='event'):
+    def decorator(fn):
+        BENCHMARKS.append((name, fn, events_scale, per))
+        return fn
+    return decorator
+
+
+class NullInputThing(InputThing):
+    """A sink that does nothing, so we just measure the dispatch path.
+    """
+    pass
+
+
+def _push(src, events):
+    """Return a run function that dispatches the events on src.
+    """
+    def run():
+        dispatch = src._dispatch_next
+        for e in events:
+            dispatch(e)
+    return run
+
+
+def _filter_benchmark(name, build, make_events=lambda n: range(n)):
+    """Register a benchmark for a filter chain. build takes the source
+    OutputThing and returns the end of the chain.
+    """
+    def setup(n):
+        src = OutputThing()
+        build(src).connect(NullInputThing())
+        return _push(src, make_events(n))
+    benchmark('filter.' + name)(setup)
+
+
+def _sensor_events(n):
+    return [SensorEvent(sensor_id=1, ts=float(i), val=float(i%100))
+            for i in range(n)]
+
+
+###########################################################################
+#                          Dispatch core                                   #
+###########################################################################
+
+@benchmark('baseline.loop')
+def bench_baseline_loop(n):
+    def f(x):
+        pass
+    def run():
+        for i in range(n):
+            f(i)
+    return run
+
+
+def _dispatch_benchmark(num_connections):
+    def setup(n):
+        src = OutputThing()
+        for i in range(num_connections):
+            src.connect(NullInputThing())
+        return _push(src, range(n))
+    benchmark('dispatch_next.%d_connections' % num_connections)(setup)
+
+for _num_connections in (1, 2, 10):
+    _dispatch_benchmark(_num_connections)
+
+
+@benchmark('dispatch_next.named_port')
+def bench_dispatch_named_port(n):
+    src = OutputThing(ports=['alt'])
+    src.connect(NullInputThing(), port_mapping=('alt', 'default'))
+    def run():
+        dispatch = src._dispatch_next
+        for i in range(n):
+            dispatch(i, port='alt')
+    return run
+
+
+@benchmark('dispatch_next.function_sink')
+def bench_dispatch_function_sink(n):
+    src = OutputThing()
+    src.connect(lambda x: None)
+    return _push(src, range(n))
+
+
+def _connect_churn_benchmark(existing):
+    def setup(n):
+        src = OutputThing()
+        for i in range(existing):
+            src.connect(NullInputThing())
+        sink = NullInputThing()
+        def run():
+            connect = src.connect
+            for i in range(n):
+                connect(sink)()
+        return run
+    benchmark('connect_disconnect.%d_existing' % existing,
+              events_scale=0.2, per='connect+disconnect')(setup)
+
+for _existing in (0, 10):
+    _connect_churn_benchmark(_existing)
+
+
+###########################################################################
+#                          Filters                                         #
+###########################################################################
+
+_filter_benchmark('map', lambda src: src.map(lambda x: x+1))
+_filter_benchmark('select', lambda src: src.select(lambda x: x+1))
+_filter_benchmark('where_pass', lambda src: src.where(lambda x: True))
+_filter_benchmark('where_drop', lambda src: src.where(lambda x: False))
+_filter_benchmark('map_where_map_chain',
+                  lambda src: src.map(lambda x: x+1).where(lambda x: x%2==0)\
+                                 .map(lambda x: x*2))
+_filter_benchmark('scan', lambda src: src.scan(lambda acc, x: acc+x, 0))
+_filter_benchmark('reduce', lambda src: src.reduce(lambda acc, x: acc+x, 0))
+_filter_benchmark('skip', lambda src: src.skip(10))
+_filter_benchmark('take', lambda src: src.take(10**12))
+_filter_benchmark('take_last', lambda src: src.take_last(10))
+_filter_benchmark('last', lambda src: src.last())
+_filter_benchmark('buffer_with_count', lambda src: src.buffer_with_count(10))
+_filter_benchmark('to_json', lambda src: src.to_json())
+_filter_benchmark('from_json', lambda src: src.from_json(),
+                  make_events=lambda n: [json.dumps([i, 'x', float(i)])
+                                         for i in range(n)])
+_filter_benchmark('to_json_schema',
+                  lambda src: src.to_json(schema=SENSOR_EVENT_SCHEMA),
+                  make_events=_sensor_events)
+_filter_benchmark('from_json_schema',
+                  lambda src: src.from_json(schema=SENSOR_EVENT_SCHEMA),
+                  make_events=lambda n: [json.dumps(e)
+                                         for e in _sensor_events(n)])
+
+def _from_json_batch_benchmark(name, make_batch, **kwargs):
+    """Decode batches of 100 SensorEvents.
+    """
+    def setup(n):
+        src = OutputThing()
+        src.from_json(schema=SENSOR_EVENT_SCHEMA, **kwargs)\
+           .connect(NullInputThing())
+        payloads = [json.dumps(e) for e in _sensor_events(n)]
+        return _push(src, [make_batch(payloads[i:i+100])
+                           for i in range(0, n, 100)])
+    benchmark('filter.' + name)(setup)
+
+_from_json_batch_benchmark('from_json_schema_batch', lambda p: p, batch=True)
+_from_json_batch_benchmark('from_json_schema_ndjson', '\n'.join, ndjson=True)
+
+for _codec in ('json', 'struct'):
+    _filter_benchmark('encode_' + _codec,
+                      lambda src, codec=_codec: src.encode(codec),
+                      make_events=_sensor_events)
+    _filter_benchmark('decode_' + _codec,
+                      lambda src, codec=_codec: src.decode(codec),
+                      make_events=lambda n, codec=_codec:
+                          [get_codec(codec).encode(e)
+                           for e in _sensor_events(n)])
+# A where() that keeps one event in 100, with eager and lazy decoding of
+# SensorEvents with string ids.
+_string_id_codec = StructCodec('<16sdd')
+def _string_id_payloads(n):
+    return [_string_id_codec.encode(SensorEvent('sensor-1', e.ts, e.val))
+            for e in _sensor_events(n)]
+_filter_benchmark('decode_struct_where',
+                  lambda src: src.decode(_string_id_codec)\
+                                 .where(lambda e: e.val==0.0),
+                  make_events=_string_id_payloads)
+_filter_benchmark('decode_struct_lazy_where',
+                  lambda src: src.decode(_string_id_codec, lazy=True)\
+                                 .where(lambda e: e.val==0.0).materialize(),
+                  make_events=_string_id_payloads)
+_filter_benchmark('passthrough',
+                  lambda src: src.passthrough(NullInputThing()))
+_filter_benchmark('transduce_sliding_mean_5',
+                  lambda src: src.transduce(SensorSlidingMean(5)),
+                  make_events=_sensor_events)
+_filter_benchmark('transduce_sliding_mean_100',
+                  lambda src: src.transduce(SensorSlidingMean(100)),
+                  make_events=_sensor_events)
+
+
+@benchmark('filter.output')
+def bench_output(n):
+    src = OutputThing()
+    devnull = open(os.devnull, 'w')
+    src.output(file=devnull).connect(NullInputThing())
+    return _push(src, range(n))
+
+
+@benchmark('filter.output_count')
+def bench_output_count(n):
+    src = OutputThing()
+    src.output_count(file=open(os.devnull, 'w')).connect(NullInputThing())
+    return _push(src, range(n))
+
+
+def _one_shot_benchmark(name, build):
+    """Filters like first() and some() disconnect after the first event, so we
+    measure building a chain and pushing a single event through it.
+    """
+    def setup(n):
+        sink = NullInputThing()
+        def run():
+            for i in range(n):
+                src = OutputThing()
+                build(src).connect(sink)
+                src._dispatch_next(i)
+        return run
+    benchmark('filter.' + name, events_scale=0.1, per='chain')(setup)
+
+_one_shot_benchmark('first', lambda src: src.first())
+_one_shot_benchmark('some', lambda src: src.some())
+
+
+def _dispatcher_benchmark(num_rules):
+    def setup(n):
+        src = OutputThing()
+        # The events are spread evenly over the rules' ports and the
+        # default port.
+        rules = [(lambda x, i=i: x%(num_rules+1)==i, 'port%d' % i)
+                 for i in range(num_rules)]
+        d = Dispatcher(src, rules)
+        for (pred, port) in rules:
+            d.connect(NullInputThing(), port_mapping=(port, 'default'))
+        d.connect(NullInputThing())
+        return _push(src, range(n))
+    benchmark('filter.dispatch.%d_rules' % num_rules)(setup)
+
+for _num_rules in (1, 4, 16):
+    _dispatcher_benchmark(_num_rules)
+
+
+class _Timers:
+    """The timer-based filters need a scheduler, but we never run the event
+    loop: each event just resets the pending timer.
+    """
+    loops = []
+
+    @classmethod
+    def scheduler(cls):
+        loop = asyncio.new_event_loop()
+        cls.loops.append(loop)
+        return Scheduler(loop)
+
+    @classmethod
+    def close(cls):
+        for loop in cls.loops:
+            loop.close()
+        cls.loops = []
+
+
+_filter_benchmark('supply_event_when_timeout',
+                  lambda src: src.supply_event_when_timeout(
+                      EventWatcher(), _Timers.scheduler(), 60.0))
+# BufferEventWatcher prints each event, so stdout is redirected while running
+# this benchmark (see main()).
+_filter_benchmark('buffer_with_time_or_count',
+                  lambda src: src.buffer_with_time_or_count(
+                      60.0, 10, _Timers.scheduler()))
+
+
+###########################################################################
+#                          Scheduler                                       #
+###########################################################################
+
+@benchmark('scheduler.schedule_recurring_from_iterable')
+def bench_schedule_recurring(n):
+    loop = asyncio.new_event_loop()
+    scheduler = Scheduler(loop)
+    src = from_iterable(iter(range(n)))
+    src.connect(NullInputThing())
+    scheduler.schedule_recurring(src)
+    def run():
+        try:
+            scheduler.run_forever()
+        finally:
+            loop.close()
+    return run
+
+
+class _PrivateLoopBurst(OutputThing, EventLoopOutputThingMixin):
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    def _observe_event_loop(self):
+        for i in range(self.n):
+            self._dispatch_next(i)
+        self._dispatch_completed()
+
+    def _stop_loop(self):
+        pass
+
+
+@benchmark('scheduler.private_event_loop_handoff')
+def bench_private_event_loop_handoff(n):
+    """Events dispatched from a private event loop thread are handed off to
+    the main event loop.
+    """
+    loop = asyncio.new_event_loop()
+    scheduler = Scheduler(loop)
+    src = _PrivateLoopBurst(n)
+    src.connect(NullInputThing())
+    scheduler.schedule_on_private_event_loop(src)
+    def run():
+        try:
+            scheduler.run_forever()
+        finally:
+            loop.close()
+    return run
+
+
+###########################################################################
+#                          Adapters                                        #
+###########################################################################
+
+class _StopAfter(InputThing):
+    """Call the cancel thunk after n events, where a list counts as one
+    event per element.
+    """
+    def __init__(self, n):
+        self.events_left = n
+        self.cancel_thunk = None
+
+    def on_next(self, x):
+        if self.events_left<=0:
+            return
+        self.events_left -= len(x) if isinstance(x, list) else 1
+        if self.events_left<=0:
+            self.cancel_thunk()
+
+
+def _mqtt_reader_benchmark(name, socket_reader, batches):
+    """Throughput of the MQTT readers, driven by the mock client. Each read
+    delivers 100 messages.
+    """
+    def setup(n):
+        from thingflow.adapters.mqtt import MQTTReader, MQTTSocketReader,\
+                                            MockMQTTClient
+        loop = asyncio.new_event_loop()
+        scheduler = Scheduler(loop)
+        if socket_reader:
+            reader = MQTTSocketReader('localhost', scheduler,
+                                      topics=[('bench', 0)],
+                                      mock_class=MockMQTTClient,
+                                      max_packets=100, batches=batches)
+        else:
+            reader = MQTTReader('localhost', topics=[('bench', 0)],
+                                mock_class=MockMQTTClient, loop_timeout=0,
+                                max_packets=100, batches=batches)
+        reader.connect(NullInputThing())
+        stop = _StopAfter(n)
+        reader.connect(stop)
+        if socket_reader:
+            stop.cancel_thunk = scheduler.schedule_on_main_event_loop(reader)
+        else:
+            stop.cancel_thunk = scheduler.schedule_on_private_event_loop(reader)
+        def run():
+            try:
+                scheduler.run_forever()
+            finally:
+                loop.close()
+        return run
+    benchmark(name, events_scale=0.1, per='message')(setup)
+
+_mqtt_reader_benchmark('adapters.mqtt_reader', False, False)
+_mqtt_reader_benchmark('adapters.mqtt_reader_batches', False, True)
+_mqtt_reader_benchmark('adapters.mqtt_socket_reader', True, False)
+_mqtt_reader_benchmark('adapters.mqtt_socket_reader_batches', True, True)
+
+
+def run_benchmarks(events=DEFAULT_EVENTS, repeats=DEFAULT_REPEATS,
+                   patterns=None, verbose=True):
+    """Run the benchmarks whose names contain one of the patterns (or all the
+    benchmarks if no patterns are provided) and return a dict of results.
+    """
+    results = {}
+    devnull = open(os.devnull, 'w')
+    try:
+        for (name, setup, events_scale, per) in BENCHMARKS:
+            if patterns and not any(p in name for p in patterns):
+                continue
+            n = max(1, int(events*events_scale))
+            # the scheduler and some filters print progress messages
+            with contextlib.redirect_stdout(devnull):
+                r = time_best_of(lambda: setup(n), n, repeats)
+                _Timers.close()
+            r['per'] = per
+            results[name] = r
+            if verbose:
+                print("%-45s %12.1f ns/%s" % (name, r['ns_per_event'], per))
+    finally:
+        devnull.close()
+    return results
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=DEFAULT_EVENTS,
+                        help="Number of events per benchmark (default %s)" %
+                             DEFAULT_EVENTS)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS,
+                        help="Number of repeats, the fastest is kept "
+                             "(default %s)" % DEFAULT_REPEATS)
+    parser.add_argument('--output', default=None,
+                        help="JSON file for the results (default "
+                             "results/micro-COMMIT.json)")
+    parser.add_argument('--compare', default=None, metavar='OLD_JSON',
+                        help="Compare the results to a previous results file")
+    parser.add_argument('--list', action='store_true', default=False,
+                        help="List the benchmarks and exit")
+    parser.add_argument('patterns', nargs='*',
+                        help="Only run benchmarks whose names contain one of "
+                             "these strings")
+    args = parser.parse_args(argv)
+    if args.list:
+        for (name, setup, events_scale, per) in BENCHMARKS:
+            print(name)
+        return 0
+    results = run_benchmarks(args.events, args.repeats, args.patterns)
+    filename = save_results(results, args.output, prefix='micro')
+    print("Wrote results to %s" % filename)
+    if args.compare:
+        compare_results(load_results(args.compare), load_results(filename))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
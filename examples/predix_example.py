@@ -47,12 +47,13 @@ class TestSensor:
 
 def run(args, token):
     sensor1 = TestSensor.output_thing(TEST_SENSOR1, 5)
+    scheduler = Scheduler(asyncio.get_event_loop())
     writer = PredixWriter(args.ingest_url, args.predix_zone_id, token,
+                          scheduler=scheduler,
                           extractor=EventExtractor(attributes={'test':True}),
                           batch_size=3)
     sensor1.connect(writer)
     sensor1.connect(print) # also print the event
-    scheduler = Scheduler(asyncio.get_event_loop())
     scheduler.schedule_periodic(sensor1, 0.5)
     
     start_time = time.time()
@@ -60,11 +61,11 @@ def run(args, token):
     
     print("Reading back events")
     reader1 = PredixReader(args.query_url, args.predix_zone_id, token,
-                           TEST_SENSOR1,
+                           TEST_SENSOR1, scheduler=scheduler,
                            start_time=start_time,
                            one_shot=True)
     reader1.connect(print)
-    scheduler.schedule_recurring(reader1)
+    scheduler.schedule_on_main_event_loop(reader1)
     scheduler.run_forever()
 
 
@@ -0,0 +1,150 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test of AsyncInputThing, which writes batches of events via coroutines
+on the scheduler's event loop.
+"""
+import asyncio
+import unittest
+
+from thingflow.base import Scheduler, from_list, FatalError
+from thingflow.adapters.async_generic import AsyncInputThing,\
+    OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK, from_async_iterable
+
+VALUES = list(range(20))
+
+
+class RecordingWriter(AsyncInputThing):
+    def __init__(self, scheduler, delay=0.02, fail=False, **kwargs):
+        super().__init__(scheduler, **kwargs)
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+        self.active_writes = 0
+        self.max_active_writes = 0
+        self.close_called = False
+        self.max_queued = 0
+
+    def on_next(self, x):
+        super().on_next(x)
+        self.max_queued = max(self.max_queued, len(self.queue))
+
+    async def _write_batch(self, events):
+        self.batches.append(events)
+        self.active_writes += 1
+        self.max_active_writes = max(self.max_active_writes,
+                                     self.active_writes)
+        await asyncio.sleep(self.delay)
+        self.active_writes -= 1
+        if self.fail:
+            raise Exception("write failed")
+
+    async def _close(self):
+        self.close_called = True
+
+
+class TestAsyncInputThing(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_batched_writes(self):
+        writer = RecordingWriter(self.scheduler, batch_size=5, max_in_flight=2)
+        src = from_list(VALUES)
+        src.connect(writer)
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.run_forever()
+        self.assertEqual(VALUES, [x for b in writer.batches for x in b])
+        self.assertTrue(all(len(b)<=5 for b in writer.batches))
+        self.assertEqual(2, writer.max_active_writes)
+        self.assertTrue(writer.close_called)
+        self.assertEqual(0, len(self.scheduler.pending_futures))
+
+    def test_stop_waits_for_writes(self):
+        writer = RecordingWriter(self.scheduler, delay=0.1, max_in_flight=3)
+        for v in VALUES[:3]:
+            writer.on_next(v)
+        self.loop.call_later(0.01, self.scheduler.stop)
+        self.scheduler.run_forever()
+        self.assertEqual(0, writer.active_writes)
+        self.assertEqual(3, writer.batches_written)
+        self.assertTrue(writer.close_called)
+
+    def test_overflow(self):
+        writer = RecordingWriter(self.scheduler, max_queue_size=5,
+                                 on_overflow=OVERFLOW_DROP_OLDEST)
+        for v in VALUES:
+            writer.on_next(v)
+        writer.on_completed()
+        self.scheduler.run_forever()
+        self.assertEqual(15, writer.dropped)
+        self.assertEqual(VALUES[15:], [x for b in writer.batches for x in b])
+
+    def test_backpressure(self):
+        values = list(range(200))
+        writer = RecordingWriter(self.scheduler, delay=0.001, batch_size=5,
+                                 max_queue_size=10, on_overflow=OVERFLOW_BLOCK)
+        src = from_list(values)
+        src.connect(writer)
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.run_forever()
+        # the source was held back rather than events being dropped
+        self.assertEqual(values, [x for b in writer.batches for x in b])
+        self.assertEqual(0, writer.dropped)
+        self.assertLessEqual(writer.max_queued, 11)
+        self.assertEqual(set(), self.scheduler.congested)
+
+    def test_backpressure_async_source(self):
+        values = list(range(200))
+        async def agen():
+            for v in values:
+                yield v
+        writer = RecordingWriter(self.scheduler, delay=0.001, batch_size=5,
+                                 max_queue_size=10, on_overflow=OVERFLOW_BLOCK)
+        src = from_async_iterable(agen(), self.scheduler)
+        src.connect(writer)
+        self.scheduler.schedule_on_main_event_loop(src)
+        self.scheduler.run_forever()
+        self.assertEqual(values, [x for b in writer.batches for x in b])
+        self.assertLessEqual(writer.max_queued, 11)
+
+    def test_flush_interval(self):
+        writer = RecordingWriter(self.scheduler, delay=0, batch_size=10,
+                                 flush_interval=0.05)
+        def push(values, complete=False):
+            for v in values:
+                writer.on_next(v)
+            if complete:
+                writer.on_completed()
+        snapshots = []
+        def snapshot():
+            snapshots.append(list(writer.batches))
+        push(VALUES[:3])
+        self.loop.call_later(0.02, snapshot)
+        self.loop.call_later(0.2, push, VALUES[3:15])
+        self.loop.call_later(0.22, snapshot)
+        self.loop.call_later(0.4, push, VALUES[15:], True)
+        self.scheduler.run_forever()
+        # partial batches wait for the timer, full batches are written
+        # right away, and the rest is flushed on completion
+        self.assertEqual([[], [VALUES[:3], VALUES[3:13]]], snapshots)
+        self.assertEqual([VALUES[:3], VALUES[3:13], VALUES[13:15],
+                          VALUES[15:]], writer.batches)
+
+    def test_failed_write(self):
+        writer = RecordingWriter(self.scheduler, fail=True)
+        src = from_list(VALUES)
+        src.connect(writer)
+        self.scheduler.schedule_recurring(src)
+        try:
+            self.scheduler.run_forever()
+        except FatalError:
+            pass
+        else:
+            self.assertFalse(1, "Did not get a fatal error")
+
+
+if __name__ == '__main__':
+    unittest.main()
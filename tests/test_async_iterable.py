@@ -0,0 +1,111 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test of AsyncIterableAsOutputThing, which runs an async iterable
+directly on the scheduler's event loop.
+"""
+import asyncio
+import unittest
+
+from thingflow.base import Scheduler
+from thingflow.adapters.async_generic import AsyncIterableAsOutputThing,\
+    from_async_iterable
+from utils import ValidationInputThing, CaptureInputThing
+
+VALUES = [1, 2, 3, 4, 5, 6, 7]
+
+
+async def async_values(values, delay=0):
+    for v in values:
+        if delay:
+            await asyncio.sleep(delay)
+        yield v
+
+
+async def async_batches(values, batch_size):
+    for i in range(0, len(values), batch_size):
+        await asyncio.sleep(0)
+        yield values[i:i+batch_size]
+
+
+async def forever():
+    i = 0
+    while True:
+        await asyncio.sleep(0.01)
+        yield i
+        i += 1
+
+
+async def error_after(values):
+    for v in values:
+        yield v
+    raise Exception("async iterable failed")
+
+
+class TestAsyncIterable(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_values(self):
+        o = from_async_iterable(async_values(VALUES, delay=0.01), self.scheduler)
+        vs = ValidationInputThing(VALUES, self, extract_value_fn=lambda v:v)
+        o.connect(vs)
+        self.scheduler.schedule_on_main_event_loop(o)
+        self.scheduler.run_forever()
+        self.assertTrue(vs.completed)
+
+    def test_batches(self):
+        o = AsyncIterableAsOutputThing(async_batches(VALUES, 3), self.scheduler,
+                                       batches=True)
+        vs = ValidationInputThing(VALUES, self, extract_value_fn=lambda v:v)
+        o.connect(vs)
+        self.scheduler.schedule_on_main_event_loop(o)
+        self.scheduler.run_forever()
+        self.assertTrue(vs.completed)
+
+    def test_yield_budget(self):
+        """An async iterable that never suspends should still let other
+        callbacks run after yield_budget events.
+        """
+        o = AsyncIterableAsOutputThing(async_values(list(range(100))),
+                                       self.scheduler, yield_budget=10)
+        capture = CaptureInputThing()
+        seen_by_probe = []
+        def probe():
+            seen_by_probe.append(len(capture.events))
+        def on_next(x):
+            if x==0:
+                self.loop.call_soon(probe)
+        o.connect(capture)
+        o.connect(on_next)
+        self.scheduler.schedule_on_main_event_loop(o)
+        self.scheduler.run_forever()
+        self.assertEqual(100, len(capture.events))
+        self.assertEqual([10], seen_by_probe)
+
+    def test_stop_cancels(self):
+        o = from_async_iterable(forever(), self.scheduler)
+        capture = CaptureInputThing()
+        o.connect(capture)
+        self.scheduler.schedule_on_main_event_loop(o)
+        self.loop.call_later(0.2, self.scheduler.stop)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.completed)
+        self.assertGreater(len(capture.events), 0)
+        self.assertEqual(0, len(self.scheduler.pending_futures))
+
+    def test_error(self):
+        o = from_async_iterable(error_after(VALUES), self.scheduler)
+        capture = CaptureInputThing(expecting_error=True)
+        o.connect(capture)
+        self.scheduler.schedule_on_main_event_loop(o)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.errored)
+        self.assertEqual(VALUES, capture.events)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Run the benchmarks with a tiny number of events, to make sure that they
+do not break as the code changes.
+"""
+import sys
+import os.path
+import unittest
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '../benchmarks')))
+
+import microbench
+import macrobench
+import benchutils
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_microbench(self):
+        results = microbench.run_benchmarks(events=50, repeats=1,
+                                            verbose=False)
+        self.assertEqual(len(microbench.BENCHMARKS), len(results))
+        for (name, r) in results.items():
+            self.assertGreater(r['ns_per_event'], 0, name)
+            self.assertGreater(r['events_per_sec'], 0, name)
+
+    def test_macrobench(self):
+        results = macrobench.run_benchmarks(sensors=5, events_per_sensor=10,
+                                            interval=0.001, verbose=False)
+        self.assertEqual(len(macrobench.SCENARIOS), len(results))
+        for (name, r) in results.items():
+            self.assertEqual(50, r['events'], name)
+            self.assertGreater(r['outputs'], 0, name)
+        # every 5th event goes to the queue, plus none left at the end
+        for variant in ('thingflow', 'asyncawait', 'callbacks'):
+            self.assertEqual(10, results['median_queue.' + variant]['outputs'])
+
+    def test_save_and_compare(self):
+        results = microbench.run_benchmarks(events=50, repeats=1,
+                                            patterns=['dispatch_next'],
+                                            verbose=False)
+        with tempfile.TemporaryDirectory() as d:
+            filename = benchutils.save_results(results,
+                                               os.path.join(d, 'r.json'))
+            old = benchutils.load_results(filename)
+            self.assertEqual(sorted(results.keys()),
+                             sorted(old['results'].keys()))
+            new = {'metadata':old['metadata'],
+                   'results':dict((name, dict(r, ns_per_event=r['ns_per_event']*2))
+                                  for (name, r) in old['results'].items())}
+            with open(os.devnull, 'w') as f:
+                regressions = benchutils.compare_results(old, new, file=f)
+            self.assertEqual(sorted(results.keys()), sorted(regressions))
+
+
+if __name__ == '__main__':
+    unittest.main()
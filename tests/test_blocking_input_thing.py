@@ -6,7 +6,7 @@
 import unittest
 import asyncio
 import time
-from thingflow.base import BlockingInputThing, Scheduler
+from thingflow.base import BlockingInputThing, Scheduler, ScheduleError
 from utils import make_test_output_thing_from_vallist
 
 values = [ 1, 2, 3, 4, 5 ]
@@ -48,6 +48,22 @@ class TestCase(unittest.TestCase):
         sensor.connect(blocking_subscriber)
         scheduler.run_forever()
         self.assertTrue(blocking_subscriber.completed)
+    def test_error_in_on_next(self):
+        class FailingInputThing(BlockingInputThing):
+            def _on_next(self, port, x):
+                raise ValueError("bad event %s" % repr(x))
+        scheduler = Scheduler(asyncio.new_event_loop())
+        sensor = make_test_output_thing_from_vallist(1, values)
+        scheduler.schedule_periodic(sensor, 0.01)
+        sensor.connect(FailingInputThing(scheduler))
+        with self.assertRaises(ScheduleError):
+            scheduler.run_forever()
+        # the original error is the cause of the ScheduleError
+        self.assertIsInstance(scheduler.fatal_error, ScheduleError)
+        self.assertIsInstance(scheduler.fatal_error.__cause__, ValueError)
+        # the worker pool was shut down when the scheduler stopped
+        self.assertIsNone(scheduler.blocking_executor)
+        scheduler.event_loop.close()
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+# Copyright 2016 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Blocking sensors and InputThings share a bounded pool of worker threads
+rather than each getting their own thread.
+"""
+import time
+import threading
+import asyncio
+import unittest
+
+from thingflow.base import Scheduler, OutputThing, DirectOutputThingMixin,\
+    SensorAsOutputThing, BlockingInputThing, ScheduleError
+from utils import ValidationInputThing, CaptureInputThing
+
+NUM_SENSORS = 12
+MAX_WORKERS = 3
+EVENTS = 3
+
+
+class ThreadRecordingSensor:
+    def __init__(self, sensor_id, stop_after, threads):
+        self.sensor_id = sensor_id
+        self.stop_after = stop_after
+        self.threads = threads
+        self.event_count = 0
+
+    def sample(self):
+        if self.event_count==self.stop_after:
+            raise StopIteration
+        self.event_count += 1
+        self.threads.add(threading.get_ident())
+        time.sleep(0.05) # simulate a blocking call
+        return self.event_count
+
+    def __repr__(self):
+        return "ThreadRecordingSensor(%s)" % self.sensor_id
+
+
+class ThreadRecordingInputThing(BlockingInputThing):
+    def __init__(self, scheduler, threads):
+        self.threads = threads
+        self.events = []
+        self.completed = False
+        super().__init__(scheduler)
+
+    def _on_next(self, port, x):
+        self.threads.add(threading.get_ident())
+        time.sleep(0.01)
+        self.events.append(x)
+
+    def _on_completed(self, port):
+        self.completed = True
+
+
+class FailingOutputThing(OutputThing, DirectOutputThingMixin):
+    def _observe(self):
+        raise Exception("sample failed")
+
+
+class TestBlockingWorkerPool(unittest.TestCase):
+    def test_many_sensors_share_pool(self):
+        scheduler = Scheduler(asyncio.new_event_loop(),
+                              max_blocking_workers=MAX_WORKERS)
+        threads = set()
+        sinks = []
+        for i in range(NUM_SENSORS):
+            o = SensorAsOutputThing(ThreadRecordingSensor(i, EVENTS, threads),
+                                    make_event_fn=lambda s, v: v)
+            o.connect(ValidationInputThing([j+1 for j in range(EVENTS)], self,
+                                           extract_value_fn=lambda v:v))
+            sink = ThreadRecordingInputThing(scheduler, threads)
+            o.connect(sink)
+            sinks.append(sink)
+            scheduler.schedule_periodic_on_separate_thread(o, 0.1)
+        scheduler.run_forever()
+        scheduler.event_loop.close()
+        self.assertLessEqual(len(threads), MAX_WORKERS)
+        for sink in sinks:
+            self.assertEqual([j+1 for j in range(EVENTS)], sink.events)
+            self.assertTrue(sink.completed)
+
+    def test_cancel_one_sensor(self):
+        scheduler = Scheduler(asyncio.new_event_loop(),
+                              max_blocking_workers=MAX_WORKERS)
+        threads = set()
+        s1 = ThreadRecordingSensor(1, 100, threads)
+        s2 = ThreadRecordingSensor(2, EVENTS, threads)
+        cancel = scheduler.schedule_sensor_on_separate_thread(
+            s1, 0.1, CaptureInputThing(), make_event_fn=lambda s, v: v)
+        scheduler.schedule_sensor_on_separate_thread(
+            s2, 0.1, CaptureInputThing(), make_event_fn=lambda s, v: v)
+        scheduler.event_loop.call_later(0.15, cancel)
+        scheduler.run_forever()
+        scheduler.event_loop.close()
+        self.assertLess(s1.event_count, 5)
+        self.assertEqual(EVENTS, s2.event_count)
+
+    def test_error_stops_scheduler(self):
+        scheduler = Scheduler(asyncio.new_event_loop())
+        o = FailingOutputThing()
+        o.connect(print)
+        scheduler.schedule_periodic_on_separate_thread(o, 0.1)
+        try:
+            scheduler.run_forever()
+        except ScheduleError:
+            pass
+        else:
+            self.assertFalse(1, "Did not get a ScheduleError")
+        finally:
+            scheduler.event_loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
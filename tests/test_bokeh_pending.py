@@ -0,0 +1,97 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the buffering of points between Bokeh plot updates (PendingPoints
+and make_update()). This does not need a Bokeh server.
+"""
+import math
+import threading
+import unittest
+
+try:
+    from thingflow.adapters.bokeh import PendingPoints, make_update
+    BOKEH_AVAILABLE = True
+except ImportError:
+    BOKEH_AVAILABLE = False
+
+from thingflow.filters.downsample import MIN_MAX
+
+
+@unittest.skipUnless(BOKEH_AVAILABLE, "bokeh library not installed")
+class TestPendingPoints(unittest.TestCase):
+    def test_max_pending(self):
+        pending = PendingPoints(max_pending=5)
+        for i in range(8):
+            pending.append(float(i), i)
+        self.assertEqual(5, len(pending))
+        self.assertEqual(3, pending.dropped)
+        # the oldest points were dropped
+        self.assertEqual(([3.0, 4.0, 5.0, 6.0, 7.0], [3, 4, 5, 6, 7]),
+                         pending.drain())
+
+    def test_drain(self):
+        pending = PendingPoints()
+        pending.append(1.0, 10)
+        pending.append(2.0, 20)
+        drained = pending.drain()
+        self.assertEqual(0, len(pending))
+        pending.append(3.0, 30)
+        # the new point went into a new buffer
+        self.assertEqual(([1.0, 2.0], [10, 20]), drained)
+        self.assertEqual(([3.0], [30]), pending.drain())
+        self.assertEqual(([], []), pending.drain())
+
+    def test_drain_while_appending(self):
+        num_points = 100000
+        pending = PendingPoints(max_pending=num_points)
+        def append_points():
+            for i in range(num_points):
+                pending.append(float(i), i)
+        thread = threading.Thread(target=append_points)
+        thread.start()
+        xs = []
+        while thread.is_alive():
+            xs.extend(pending.drain()[0])
+        thread.join()
+        xs.extend(pending.drain()[0])
+        # every point was drained exactly once, in order
+        self.assertEqual(0, pending.dropped)
+        self.assertEqual([float(i) for i in range(num_points)], xs)
+
+
+@unittest.skipUnless(BOKEH_AVAILABLE, "bokeh library not installed")
+class TestMakeUpdate(unittest.TestCase):
+    def _pending(self, n):
+        pending = PendingPoints()
+        for i in range(n):
+            pending.append(float(i), math.sin(i/50.0))
+        return pending
+
+    def test_downsample(self):
+        pending = self._pending(1000)
+        (xs, ys) = make_update(pending, 50)
+        self.assertEqual(50, len(xs))
+        self.assertEqual(50, len(ys))
+        self.assertEqual(0.0, xs[0])
+        self.assertEqual(999.0, xs[-1])
+        self.assertEqual(sorted(xs), xs)
+        self.assertEqual(0, len(pending))
+
+    def test_min_max(self):
+        (xs, ys) = make_update(self._pending(1000), 50, MIN_MAX)
+        self.assertLessEqual(len(xs), 50)
+        self.assertEqual(sorted(xs), xs)
+        # the extremes are kept
+        all_ys = [math.sin(i/50.0) for i in range(1000)]
+        self.assertEqual(max(all_ys), max(ys))
+        self.assertEqual(min(all_ys), min(ys))
+
+    def test_no_downsampling(self):
+        (xs, ys) = make_update(self._pending(1000), 50, None)
+        self.assertEqual(1000, len(xs))
+        # fewer points than the maximum are sent as they are
+        (xs, ys) = make_update(self._pending(10), 50)
+        self.assertEqual([float(i) for i in range(10)], xs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the codec registry and the encode() and decode() filters.
+"""
+import json
+import unittest
+
+from thingflow.base import SensorEvent, OutputThing
+from thingflow.codecs import get_codec, register_codec, Codec, JsonCodec,\
+    StructCodec, CODECS
+import thingflow.filters.codec
+from utils import CaptureInputThing
+
+EVENTS = [SensorEvent(sensor_id=i%3, ts=1500000000.123+i*0.25, val=20.0+i*0.173)
+          for i in range(20)]
+
+
+class TestCodecs(unittest.TestCase):
+    def test_json(self):
+        codec = get_codec('json')
+        payload = codec.encode(EVENTS[1])
+        self.assertEqual(json.dumps(EVENTS[1]).encode('utf-8'), payload)
+        self.assertEqual(list(EVENTS[1]), codec.decode(payload))
+        codec = JsonCodec(constructor=SensorEvent)
+        self.assertEqual(EVENTS, codec.decode_batch(codec.encode_batch(EVENTS)))
+        self.assertEqual(EVENTS,
+                         codec.decode_many([codec.encode(e) for e in EVENTS]))
+
+    def test_json_schema(self):
+        from thingflow.filters.json import SENSOR_EVENT_SCHEMA
+        codec = JsonCodec(schema=SENSOR_EVENT_SCHEMA)
+        self.assertEqual(get_codec('json').encode(EVENTS[1]),
+                         codec.encode(EVENTS[1]))
+        self.assertEqual(EVENTS[1], codec.decode(codec.encode(EVENTS[1])))
+        self.assertEqual(get_codec('json').encode_batch(EVENTS),
+                         codec.encode_batch(EVENTS))
+        self.assertEqual(EVENTS, codec.decode_batch(codec.encode_batch(EVENTS)))
+        self.assertEqual(EVENTS,
+                         codec.decode_many([codec.encode(e) for e in EVENTS]))
+
+    def test_struct(self):
+        codec = get_codec('struct')
+        payload = codec.encode(EVENTS[1])
+        self.assertEqual(20, len(payload))
+        self.assertEqual(EVENTS[1], codec.decode(payload))
+        self.assertEqual(EVENTS[1], codec.decode(memoryview(payload)))
+        batch = codec.encode_batch(EVENTS)
+        self.assertEqual(20*len(EVENTS), len(batch))
+        self.assertLess(len(batch), len(get_codec('json').encode_batch(EVENTS)))
+        self.assertEqual(EVENTS, codec.decode_batch(batch))
+        self.assertEqual(EVENTS,
+                         codec.decode_many([codec.encode(e) for e in EVENTS]))
+
+    def test_struct_string_ids(self):
+        codec = StructCodec('<8sdd')
+        events = [SensorEvent('lux-%d' % i, float(i), 2.0*i) for i in range(5)]
+        self.assertEqual(events, codec.decode_batch(codec.encode_batch(events)))
+        self.assertEqual(events[2], codec.decode(codec.encode(events[2])))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, get_codec, 'bogus')
+
+    def test_register_codec(self):
+        class ReprCodec(Codec):
+            name = 'repr'
+            def encode(self, event):
+                return repr(event).encode('utf-8')
+            def decode(self, payload):
+                return eval(str(payload, encoding='utf-8'))
+        codec = ReprCodec()
+        register_codec(codec)
+        try:
+            self.assertIs(codec, get_codec('repr'))
+            self.assertEqual(EVENTS[0], codec.decode(codec.encode(EVENTS[0])))
+        finally:
+            del CODECS['repr']
+
+    def test_filters(self):
+        capture = CaptureInputThing()
+        s = OutputThing()
+        s.encode('struct').decode('struct').connect(capture)
+        for e in EVENTS:
+            s._dispatch_next(e)
+        self.assertEqual(EVENTS, capture.events)
+
+    def test_batch_filters(self):
+        encoded = CaptureInputThing()
+        capture = CaptureInputThing()
+        s = OutputThing()
+        e = s.encode(StructCodec(), batch=True)
+        e.connect(encoded)
+        e.decode('struct', batch=True).connect(capture)
+        s._dispatch_next(EVENTS[:10])
+        s._dispatch_next(EVENTS[10:])
+        self.assertEqual(2, len(encoded.events))
+        self.assertEqual(EVENTS, capture.events)
+
+
+if __name__ == '__main__':
+    unittest.main()
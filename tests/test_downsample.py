@@ -0,0 +1,67 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the downsampling algorithms and the downsample() filter.
+"""
+import math
+import unittest
+
+from thingflow.base import SensorEvent, OutputThing
+from thingflow.filters.downsample import lttb_indices, min_max_indices,\
+    downsample_indices, MIN_MAX
+from utils import CaptureInputThing
+
+XS = list(range(1000))
+# a sine wave with a single spike
+YS = [math.sin(x/50.0) + (5.0 if x==500 else 0.0) for x in XS]
+
+
+class TestDownsample(unittest.TestCase):
+    def test_lttb(self):
+        indices = lttb_indices(XS, YS, 50)
+        self.assertEqual(50, len(indices))
+        self.assertEqual(0, indices[0])
+        self.assertEqual(999, indices[-1])
+        self.assertEqual(sorted(set(indices)), indices)
+        self.assertIn(500, indices)
+        # nothing to do for short series
+        self.assertEqual(list(range(10)), lttb_indices(XS[:10], YS[:10], 50))
+
+    def test_min_max(self):
+        indices = min_max_indices(XS, YS, 20)
+        self.assertLessEqual(len(indices), 40)
+        self.assertEqual(sorted(set(indices)), indices)
+        self.assertIn(500, indices)
+        # the extremes of each bucket are kept
+        for b in range(20):
+            bucket = range(b*50, (b+1)*50)
+            self.assertIn(min(bucket, key=YS.__getitem__), indices)
+            self.assertIn(max(bucket, key=YS.__getitem__), indices)
+
+    def test_min_max_degenerate_width(self):
+        # all the points at the same x value, with the maximum before the
+        # minimum
+        ys = [0.0]*100
+        ys[10] = 5.0
+        ys[90] = -5.0
+        self.assertEqual([10, 90], min_max_indices([1.0]*100, ys, 20))
+        # a constant series gives a single point, not a duplicate
+        self.assertEqual([0], min_max_indices([1.0]*100, [2.0]*100, 20))
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, downsample_indices, XS, YS, 10, 'bogus')
+
+    def test_filter(self):
+        events = [SensorEvent(1, float(x), y) for (x, y) in zip(XS, YS)]
+        capture = CaptureInputThing()
+        s = OutputThing()
+        s.downsample(100, algorithm=MIN_MAX).connect(capture)
+        s._dispatch_next(events)
+        s._dispatch_next(events[:10])
+        self.assertEqual(2, len(capture.events))
+        self.assertLessEqual(len(capture.events[0]), 100)
+        self.assertIn(events[500], capture.events[0])
+        self.assertEqual(events[:10], capture.events[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
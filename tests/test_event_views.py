@@ -0,0 +1,150 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test lazily decoded events (EventView) and the lazy options of the
+decode() filter and the MQTT readers.
+"""
+import asyncio
+import unittest
+
+from thingflow.base import SensorEvent, OutputThing, Scheduler, InputThing
+from thingflow.codecs import EventView, StructCodec, JsonCodec, get_codec
+from thingflow.adapters.mqtt import MQTTSocketReader, MockMQTTClient
+import thingflow.filters.codec
+import thingflow.filters.where
+from utils import CaptureInputThing
+
+EVENTS = [SensorEvent(sensor_id=i%4, ts=1500000000.0+i, val=float(i))
+          for i in range(20)]
+
+
+class CountingCodec(StructCodec):
+    """Count the full and single field decodes.
+    """
+    def __init__(self, fmt='<Idd'):
+        super().__init__(fmt)
+        self.decodes = 0
+        self.field_decodes = 0
+
+    def decode(self, payload):
+        self.decodes += 1
+        return super().decode(payload)
+
+    def decode_field(self, payload, index):
+        self.field_decodes += 1
+        return super().decode_field(payload, index)
+
+
+class TestEventViews(unittest.TestCase):
+    def test_fields(self):
+        codec = CountingCodec()
+        payload = codec.encode(EVENTS[5])
+        view = codec.make_view(payload, topic='t')
+        # a single payload is wrapped without copying, as for batches
+        self.assertIsInstance(view.payload, memoryview)
+        self.assertIs(payload, view.payload.obj)
+        self.assertEqual('t', view.topic)
+        self.assertEqual(1, view.sensor_id)
+        self.assertEqual(1, view.sensor_id)
+        self.assertEqual(5.0, view[2])
+        self.assertEqual((0, 2), (codec.decodes, codec.field_decodes))
+        self.assertEqual(EVENTS[5], view.materialize())
+        self.assertEqual(1500000005.0, view.ts)
+        self.assertEqual((1, 2), (codec.decodes, codec.field_decodes))
+        self.assertEqual(list(EVENTS[5]), list(view))
+        self.assertRaises(AttributeError, getattr, view, 'bogus')
+
+    def test_string_and_native_layouts(self):
+        event = SensorEvent('lux-1', 2.5, 3.5)
+        for fmt in ('<8sdd', '@8sId', 'Id'):
+            codec = StructCodec(fmt, constructor=None)
+            if fmt=='<8sdd':
+                values = list(event)
+            elif fmt=='@8sId':
+                values = ['lux-1', 7, 3.5]
+            else:
+                values = [7, 3.5]
+            view = codec.make_view(codec.encode(values))
+            self.assertEqual(values,
+                             [view[i] for i in range(len(values))], fmt)
+
+    def test_json_codec(self):
+        codec = JsonCodec(constructor=SensorEvent)
+        view = codec.make_view(codec.encode(EVENTS[3]))
+        self.assertEqual(3.0, view.val)
+        self.assertEqual(EVENTS[3], view.materialize())
+
+    def test_no_codec(self):
+        view = EventView(b'abc', None, topic='t')
+        self.assertIsInstance(view.payload, memoryview)
+        self.assertEqual(b'abc', view.materialize())
+        self.assertRaises(AttributeError, getattr, view, 'val')
+        # indexing does not depend on whether the view was materialized
+        self.assertEqual(ord('a'), EventView(b'abc', None, topic='t')[0])
+        self.assertEqual(ord('a'), view[0])
+
+    def test_batch_views(self):
+        codec = get_codec('struct')
+        payload = codec.encode_batch(EVENTS)
+        views = codec.views(payload)
+        self.assertEqual(EVENTS, [v.materialize() for v in views])
+        self.assertIs(views[0].payload.obj, views[1].payload.obj)
+        # codecs without fixed size records return the decoded events
+        codec = JsonCodec(constructor=SensorEvent)
+        self.assertEqual(EVENTS, codec.views(codec.encode_batch(EVENTS)))
+
+    def test_lazy_filters(self):
+        codec = CountingCodec()
+        capture = CaptureInputThing()
+        s = OutputThing()
+        s.decode(codec, lazy=True).where(lambda e: e.sensor_id==1)\
+         .materialize().connect(capture)
+        for e in EVENTS:
+            s._dispatch_next(codec.encode(e))
+        self.assertEqual([e for e in EVENTS if e.sensor_id==1],
+                         capture.events)
+        # one field decode per event, and a full decode for the survivors
+        self.assertEqual(len(EVENTS), codec.field_decodes)
+        self.assertEqual(len(capture.events), codec.decodes)
+
+        capture = CaptureInputThing()
+        s = OutputThing()
+        s.decode('struct', batch=True, lazy=True).where(lambda e: e.val>15)\
+         .materialize().connect(capture)
+        s._dispatch_next(get_codec('struct').encode_batch(EVENTS))
+        self.assertEqual(EVENTS[16:], capture.events)
+
+
+class StopLoopAfter(InputThing):
+    def __init__(self, stop_after, cancel_thunk):
+        self.events_left = stop_after
+        self.cancel_thunk = cancel_thunk
+
+    def on_next(self, x):
+        self.events_left -= 1
+        if self.events_left == 0:
+            self.cancel_thunk()
+
+
+class TestLazyMQTTReader(unittest.TestCase):
+    def test_lazy_reader(self):
+        loop = asyncio.new_event_loop()
+        scheduler = Scheduler(loop)
+        try:
+            m = MQTTSocketReader("localhost", scheduler,
+                                 topics=[('bogus/bogus', 0),],
+                                 mock_class=MockMQTTClient, max_packets=10,
+                                 lazy=True)
+            capture = CaptureInputThing()
+            m.where(lambda e: e.topic=='bogus/bogus').connect(capture)
+            c = scheduler.schedule_on_main_event_loop(m)
+            m.connect(StopLoopAfter(5, c))
+            scheduler.run_forever()
+        finally:
+            loop.close()
+        self.assertEqual(5, len(capture.events))
+        self.assertTrue(all(isinstance(e, EventView) for e in capture.events))
+        self.assertEqual(b'xxx', capture.events[0].materialize())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,8 @@ we shut down cleanly and don't lose the error.
 """
 
 import thingflow.filters.output
-from thingflow.base import Scheduler, OutputThing, EventLoopOutputThingMixin, FatalError
+from thingflow.base import Scheduler, OutputThing, EventLoopOutputThingMixin, FatalError,\
+    ScheduleError
 
 import unittest
 import asyncio
@@ -26,6 +27,10 @@ class TestOutputThing(OutputThing, EventLoopOutputThingMixin):
             time.sleep(1)
         raise FatalError("testing the fatal error")
 
+class FailingOutputThing(OutputThing, EventLoopOutputThingMixin):
+    def _observe_event_loop(self):
+        raise ValueError("private loop failed")
+
 class TestFatalErrorInPrivateLoop(unittest.TestCase):
     def test_case(self):
         m = TestOutputThing()
@@ -40,6 +45,17 @@ class TestFatalErrorInPrivateLoop(unittest.TestCase):
             print("The event loop exited without throwing a fatal error!")
             self.assertFalse(1, "The event loop exited without throwing a fatal error!")
 
+    def test_error_is_cause(self):
+        scheduler = Scheduler(asyncio.new_event_loop())
+        m = FailingOutputThing()
+        m.output()
+        scheduler.schedule_on_private_event_loop(m)
+        self.assertRaises(ScheduleError, scheduler.run_forever)
+        # the original error is kept as the cause of the ScheduleError
+        self.assertIsInstance(scheduler.fatal_error, ScheduleError)
+        self.assertIsInstance(scheduler.fatal_error.__cause__, ValueError)
+        scheduler.event_loop.close()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,114 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the to_json() and from_json() filters, including schemas, batches,
+and backends.
+"""
+import json
+import unittest
+
+from thingflow.base import SensorEvent, OutputThing
+from thingflow.filters.json import JsonSchema, SENSOR_EVENT_SCHEMA, BACKENDS
+from utils import CaptureInputThing
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+EVENTS = [SensorEvent(sensor_id='sensor-%d' % (i%3), ts=1500000000.123+i,
+                      val=20.0+i*0.173) for i in range(10)]
+
+
+def push(events, build):
+    src = OutputThing()
+    capture = CaptureInputThing()
+    build(src).connect(capture)
+    for e in events:
+        src._dispatch_next(e)
+    return capture.events
+
+
+class TestJsonFilters(unittest.TestCase):
+    def test_round_trip(self):
+        encoded = push(EVENTS, lambda s: s.to_json())
+        self.assertEqual([json.dumps(e) for e in EVENTS], encoded)
+        self.assertEqual(EVENTS,
+                         push(encoded,
+                              lambda s: s.from_json(constructor=SensorEvent)))
+
+    def test_schema_encoder(self):
+        events = EVENTS + [SensorEvent(1, 2, float('nan')),
+                           SensorEvent('é"\n', float('inf'), -0.0),
+                           SensorEvent(None, 1e300, 5e-324)]
+        self.assertEqual([json.dumps(e) for e in events],
+                         push(events,
+                              lambda s: s.to_json(schema=SENSOR_EVENT_SCHEMA)))
+
+    def test_schema_encoder_fallback(self):
+        """Values that are not exactly of the declared types are encoded by
+        json.dumps().
+        """
+        class MyFloat(float):
+            def __repr__(self):
+                return 'MyFloat(%s)' % float.__repr__(self)
+        events = [SensorEvent(1, 2.0, None), SensorEvent(1, 2.0, MyFloat(1.5)),
+                  SensorEvent(1, 2, True), SensorEvent(1, None, float('nan')),
+                  SensorEvent(1, float('-inf'), 3)]
+        self.assertEqual([json.dumps(e) for e in events],
+                         push(events,
+                              lambda s: s.to_json(schema=SENSOR_EVENT_SCHEMA)))
+        schema = JsonSchema(SensorEvent, (str, int, float))
+        events = [SensorEvent('a', True, 1), SensorEvent(None, 1, 2.5)]
+        self.assertEqual([json.dumps(e) for e in events],
+                         push(events, lambda s: s.to_json(schema=schema)))
+
+    @unittest.skipUnless(NUMPY_AVAILABLE, "numpy not installed")
+    def test_schema_encoder_numpy(self):
+        events = [SensorEvent(1, 2.0, numpy.float64(1.5)),
+                  SensorEvent(1, numpy.float64(3.25), numpy.float64('nan'))]
+        encoded = push(events, lambda s: s.to_json(schema=SENSOR_EVENT_SCHEMA))
+        self.assertEqual([json.dumps(e) for e in events], encoded)
+        self.assertEqual('[1, 2.0, 1.5]', encoded[0])
+
+    def test_untyped_schema(self):
+        schema = JsonSchema(SensorEvent)
+        events = [SensorEvent(True, [1, 2], {'a':1}), SensorEvent(1, 2, 'x')]
+        encoded = push(events, lambda s: s.to_json(schema=schema))
+        self.assertEqual([json.dumps(e) for e in events], encoded)
+
+    def test_schema_decoder(self):
+        encoded = [json.dumps(e) for e in EVENTS]
+        for backend in BACKENDS.keys():
+            self.assertEqual(EVENTS,
+                             push(encoded,
+                                  lambda s: s.from_json(
+                                      schema=SENSOR_EVENT_SCHEMA,
+                                      backend=backend)))
+
+    def test_batch(self):
+        encoded = [json.dumps(e) for e in EVENTS]
+        batches = [encoded[:4], encoded[4:], []]
+        self.assertEqual(EVENTS,
+                         push(batches,
+                              lambda s: s.from_json(schema=SENSOR_EVENT_SCHEMA,
+                                                    batch=True)))
+        batches = [[e.encode('utf-8') for e in encoded]]
+        self.assertEqual(EVENTS,
+                         push(batches,
+                              lambda s: s.from_json(constructor=SensorEvent,
+                                                    batch=True)))
+
+    def test_ndjson(self):
+        text = '\n'.join(json.dumps(e) for e in EVENTS) + '\n'
+        self.assertEqual(EVENTS,
+                         push([text],
+                              lambda s: s.from_json(schema=SENSOR_EVENT_SCHEMA,
+                                                    ndjson=True)))
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, OutputThing().from_json, backend='bogus')
+
+
+if __name__ == '__main__':
+    unittest.main()
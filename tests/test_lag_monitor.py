@@ -0,0 +1,148 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the event loop lag monitor (Scheduler.enable_lag_monitor()).
+"""
+import asyncio
+import time
+import unittest
+
+from thingflow.base import Scheduler, SensorAsOutputThing, InputThing,\
+    from_list, _WrappedConnection
+from thingflow.lagmonitor import _LagConnection
+from thingflow.metrics import _InstrumentedConnection
+import thingflow.filters.map
+from utils import CaptureInputThing, ValueListSensor
+
+
+class SlowSensor(ValueListSensor):
+    def sample(self):
+        time.sleep(0.06)
+        return super().sample()
+
+
+class SlowInputThing(InputThing):
+    def on_next(self, x):
+        time.sleep(0.06)
+
+    def __str__(self):
+        return 'SlowInputThing'
+
+
+def slow_map(x):
+    time.sleep(0.06)
+    return x
+
+
+class TestLagMonitor(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.scheduler.disable_lag_monitor()
+        self.loop.close()
+
+    def test_slow_sensor(self):
+        sensor = SensorAsOutputThing(SlowSensor(1, [1, 2, 3]))
+        sensor.connect(CaptureInputThing())
+        self.scheduler.schedule_periodic(sensor, 0.01)
+        lags = []
+        monitor = self.scheduler.enable_lag_monitor(
+            probe_interval=0.01, slow_callback_threshold=0.03)
+        monitor.add_listener(lags.append)
+        self.scheduler.run_forever()
+        report = self.scheduler.lag_report()
+        self.assertTrue(report['enabled'])
+        self.assertGreaterEqual(len(report['slow_callbacks']), 3)
+        self.assertEqual(str(sensor),
+                         report['slow_output_things'][0]['thing'])
+        self.assertGreaterEqual(report['max_lag_ms'], 30.0)
+        self.assertGreater(len(lags), 0)
+        self.assertGreaterEqual(max(lags), 0.03)
+
+    def test_slow_downstream(self):
+        src = from_list([1, 2, 3])
+        capture = CaptureInputThing()
+        src.map(slow_map).connect(capture)
+        src.connect(CaptureInputThing())
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.enable_lag_monitor(probe_interval=0.01,
+                                          slow_callback_threshold=0.03)
+        self.scheduler.run_forever()
+        self.assertEqual([1, 2, 3], capture.events)
+        report = self.scheduler.lag_report()
+        self.assertEqual(3, len(report['slow_callbacks']))
+        self.assertEqual('map', report['slow_input_things'][0]['thing'])
+        self.assertEqual(1, len(report['slow_input_things']))
+        cb = report['slow_callbacks'][0]
+        self.assertEqual('%s => map' % src, cb['path'])
+        self.assertGreaterEqual(cb['input_self_ms'], 50.0)
+
+    def test_slow_sink_for_threaded_sensor(self):
+        sink = SlowInputThing()
+        self.scheduler.schedule_sensor_on_separate_thread(
+            ValueListSensor(1, [1, 2]), 0.01, sink)
+        self.scheduler.enable_lag_monitor(probe_interval=0.01,
+                                          slow_callback_threshold=0.03)
+        self.scheduler.run_forever()
+        report = self.scheduler.lag_report()
+        inputs = [s['thing'] for s in report['slow_input_things']]
+        self.assertIn('SlowInputThing', inputs)
+
+    def test_disable(self):
+        src = from_list([1, 2, 3])
+        capture = CaptureInputThing()
+        src.connect(capture)
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.enable_lag_monitor()
+        self.assertTrue(isinstance(src.__connections__['default'][0],
+                                   _LagConnection))
+        self.scheduler.disable_lag_monitor()
+        self.assertFalse(isinstance(src.__connections__['default'][0],
+                                    _LagConnection))
+        self.assertFalse(self.scheduler.lag_report()['enabled'])
+        self.scheduler.run_forever()
+        self.assertEqual([1, 2, 3], capture.events)
+
+    def test_stacked_with_metrics(self):
+        """Enable and disable the metrics and the lag monitor in mixed order.
+        Each must remove its own wrapper, wherever it is in the chain.
+        """
+        def wrappers():
+            result = []
+            c = src.__connections__['default'][0]
+            while isinstance(c, _WrappedConnection):
+                result.append(type(c))
+                c = c.original
+            self.assertIs(capture, c.input_thing)
+            return result
+        for (first_off, second_off) in [('metrics', 'lag'), ('lag', 'metrics')]:
+            self.scheduler = Scheduler(asyncio.new_event_loop())
+            src = from_list([1, 2, 3])
+            capture = CaptureInputThing()
+            src.connect(capture)
+            self.scheduler.enable_metrics(src)
+            self.scheduler.enable_lag_monitor(src)
+            self.assertEqual([_LagConnection, _InstrumentedConnection],
+                             wrappers())
+            # enabling again does not wrap twice
+            self.scheduler.enable_metrics(src)
+            self.assertEqual(2, len(wrappers()))
+            disable = {'metrics':self.scheduler.disable_metrics,
+                       'lag':self.scheduler.disable_lag_monitor}
+            disable[first_off]()
+            self.assertEqual([_InstrumentedConnection if first_off=='lag'
+                              else _LagConnection], wrappers())
+            src._dispatch_next(1)
+            disable[second_off]()
+            self.assertEqual([], wrappers())
+            src._dispatch_next(2)
+            self.assertEqual([1, 2], capture.events)
+            events_in = [m['events_in'] for m in
+                         self.scheduler.metrics()['inputs']]
+            self.assertEqual([1 if first_off=='lag' else 0], events_in)
+            self.scheduler.event_loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
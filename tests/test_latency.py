@@ -0,0 +1,145 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test end-to-end latency tracking (Scheduler.enable_latency_tracking()).
+"""
+import asyncio
+import time
+import unittest
+
+from thingflow.base import Scheduler, from_list, BlockingInputThing,\
+    ingress_clock, OutputThing, DirectOutputThingMixin
+import thingflow.filters.map
+from utils import CaptureInputThing, ValueListSensor
+
+VALUES = list(range(10))
+
+
+class SlowBlockingSink(BlockingInputThing):
+    def __init__(self, scheduler):
+        self.events = []
+        super().__init__(scheduler)
+
+    def _on_next(self, port, x):
+        time.sleep(0.01)
+        self.events.append(x)
+
+
+class UnstampedOutputThing(OutputThing, DirectOutputThingMixin):
+    """A source which does not call ingress_clock.stamp()
+    """
+    def __init__(self, values):
+        super().__init__()
+        self.values = list(values)
+
+    def _observe(self):
+        if len(self.values)>0:
+            self._dispatch_next(self.values.pop(0))
+        else:
+            self._dispatch_completed()
+
+
+class TestLatency(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.scheduler.disable_latency_tracking()
+        self.loop.close()
+
+    def _get_sink(self, sink):
+        for s in self.scheduler.latencies()['sinks']:
+            if s['sink']==str(sink):
+                return s
+        self.fail("No latencies for sink %s" % sink)
+
+    def test_plain_sink(self):
+        src = from_list(VALUES)
+        capture = CaptureInputThing()
+        src.map(lambda x: x+1).connect(capture)
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.enable_latency_tracking()
+        self.assertTrue(ingress_clock.enabled)
+        self.scheduler.run_forever()
+        self.assertEqual([v+1 for v in VALUES], capture.events)
+        s = self._get_sink(capture)
+        self.assertEqual(len(VALUES), s['end_to_end_ns']['count'])
+        self.assertEqual(0, s['queue_ns']['max'])
+        self.assertGreaterEqual(s['end_to_end_ns']['p50'],
+                                s['processing_ns']['p50'])
+        self.scheduler.disable_latency_tracking()
+        self.assertFalse(ingress_clock.enabled)
+        self.assertFalse(self.scheduler.latencies()['enabled'])
+
+    def test_blocking_sink(self):
+        src = from_list(VALUES)
+        sink = SlowBlockingSink(self.scheduler)
+        src.connect(sink)
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.enable_latency_tracking()
+        self.scheduler.run_forever()
+        self.assertEqual(VALUES, sink.events)
+        s = self._get_sink(sink)
+        self.assertEqual(len(VALUES), s['processing_ns']['count'])
+        self.assertGreaterEqual(s['processing_ns']['min'], 10000000)
+        # the events were all queued before the first one was processed
+        self.assertGreaterEqual(s['queue_ns']['max'],
+                                (len(VALUES)-2)*10000000)
+        self.assertGreaterEqual(s['end_to_end_ns']['max'],
+                                s['queue_ns']['max'])
+
+    def test_sensor_on_separate_thread(self):
+        capture = CaptureInputThing()
+        self.scheduler.schedule_sensor_on_separate_thread(
+            ValueListSensor(1, VALUES), 0.01, capture)
+        self.scheduler.enable_latency_tracking()
+        self.scheduler.run_forever()
+        self.assertEqual(VALUES, [e.val for e in capture.events])
+        s = self._get_sink(capture)
+        self.assertEqual(len(VALUES), s['end_to_end_ns']['count'])
+
+    def test_unstamped_source(self):
+        stamped = CaptureInputThing()
+        unstamped = CaptureInputThing()
+        src = from_list(VALUES)
+        src.connect(stamped)
+        unstamped_src = UnstampedOutputThing(VALUES)
+        unstamped_src.connect(unstamped)
+        # the two sources take turns, so each unstamped event follows a
+        # stamped one
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.schedule_recurring(unstamped_src)
+        self.scheduler.enable_latency_tracking()
+        self.scheduler.run_forever()
+        self.assertEqual(VALUES, unstamped.events)
+        self.assertEqual(len(VALUES),
+                         self._get_sink(stamped)['end_to_end_ns']['count'])
+        # the unstamped events did not pick up the earlier stamps
+        s = self._get_sink(unstamped)
+        self.assertEqual(len(VALUES), s['processing_ns']['count'])
+        self.assertEqual(0, s['end_to_end_ns']['count'])
+
+    def test_inbox_replaces_stamp(self):
+        seen = []
+        inbox = self.scheduler._make_inbox(self)
+        self.scheduler.enable_latency_tracking()
+        ingress_clock.stamp()
+        inbox.enqueue(lambda: seen.append(ingress_clock.get()))
+        ingress_clock.clear()
+        inbox.enqueue(lambda: seen.append(ingress_clock.get()))
+        ingress_clock.set(12345)
+        inbox.flush()
+        self.assertEqual(2, len(seen))
+        self.assertIsNotNone(seen[0])
+        self.assertIsNone(seen[1])
+
+    def test_not_enabled(self):
+        src = from_list(VALUES)
+        src.connect(CaptureInputThing())
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.run_forever()
+        self.assertEqual([], self.scheduler.latencies()['sinks'])
+
+
+if __name__ == '__main__':
+    unittest.main()
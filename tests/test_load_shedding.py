@@ -0,0 +1,152 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the load shedding filters and controller (thingflow.filters.shedding)
+"""
+import asyncio
+import time
+import unittest
+
+from thingflow.base import Scheduler, OutputThing, SensorEvent,\
+    SensorAsOutputThing
+from thingflow.filters.shedding import SheddingController, queue_depth_fn,\
+    _param_for_level
+import thingflow.filters.shedding
+import thingflow.filters.map
+from thingflow.adapters.async_generic import AsyncInputThing
+from utils import CaptureInputThing, ValueListSensor
+
+
+def events(n, sensors=2):
+    return [SensorEvent(sensor_id=i%sensors, ts=float(i), val=float(i))
+            for i in range(n)]
+
+
+class SlowWriter(AsyncInputThing):
+    def __init__(self, scheduler):
+        super().__init__(scheduler)
+        self.written = []
+
+    async def _write_batch(self, events):
+        await asyncio.sleep(0.01)
+        self.written.extend(events)
+
+
+class TestShedders(unittest.TestCase):
+    def _push(self, shedder_fn, level, evs):
+        src = OutputThing()
+        capture = CaptureInputThing()
+        shedder = shedder_fn(src)
+        shedder.connect(capture)
+        shedder.set_level(level)
+        for e in evs:
+            src._dispatch_next(e)
+        src._dispatch_completed()
+        return (shedder, capture.events)
+
+    def test_param_for_level(self):
+        policy = {1:2, 3:10}
+        self.assertEqual([None, 2, 2, 10, 10],
+                         [_param_for_level(policy, l) for l in range(5)])
+
+    def test_sample(self):
+        (s, out) = self._push(lambda src: src.sample({1:2, 2:5}), 0, events(10))
+        self.assertEqual(10, len(out))
+        (s, out) = self._push(lambda src: src.sample({1:2, 2:5}), 2, events(10))
+        self.assertEqual([0.0, 5.0], [e.val for e in out])
+        self.assertEqual((10, 2, 8), (s.events_in, s.events_out, s.events_shed))
+
+    def test_drop_below_priority(self):
+        (s, out) = self._push(lambda src: src.drop_below_priority(
+                                  lambda e: e.val%3, {1:1, 2:2}),
+                              2, events(9))
+        self.assertEqual([2.0, 5.0, 8.0], [e.val for e in out])
+        self.assertEqual(6, s.events_shed)
+
+    def test_degrade_aggregation(self):
+        (s, out) = self._push(lambda src: src.degrade_aggregation({1:2}), 1,
+                              events(10))
+        # two sensors, windows of 2: (0,2), (1,3), (4,6), (5,7), (8), (9)
+        self.assertEqual([(0, 1.0), (1, 2.0), (0, 5.0), (1, 6.0), (0, 8.0),
+                          (1, 9.0)],
+                         [(e.sensor_id, e.val) for e in out])
+        self.assertEqual(4, s.events_shed)
+
+    def test_latest_per_key(self):
+        loop = asyncio.new_event_loop()
+        scheduler = Scheduler(loop)
+        src = OutputThing()
+        capture = CaptureInputThing()
+        shedder = src.latest_per_key(scheduler, {1:0.05})
+        shedder.connect(capture)
+        shedder.set_level(1)
+        for e in events(10):
+            src._dispatch_next(e)
+        self.assertEqual([], capture.events)
+        loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual([(0, 8.0), (1, 9.0)],
+                         [(e.sensor_id, e.val) for e in capture.events])
+        self.assertEqual(8, shedder.events_shed)
+        # back to level 0, events pass through
+        shedder.set_level(0)
+        src._dispatch_next(events(1)[0])
+        self.assertEqual(3, len(capture.events))
+        loop.close()
+
+
+class TestSheddingController(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.scheduler.disable_lag_monitor()
+        self.loop.close()
+
+    def test_queue_depth(self):
+        """A fast source into a slow writer: the queue builds up and the
+        controller starts sampling.
+        """
+        controller = SheddingController(self.scheduler, lag_thresholds=None,
+                                        check_interval=0.01,
+                                        recovery_time=0.05)
+        writer = SlowWriter(self.scheduler)
+        controller.add_queue(queue_depth_fn(writer), (5, 20), name='writer')
+        src = SensorAsOutputThing(ValueListSensor(1, list(range(200))))
+        shedder = src.sample({1:2, 2:10}, controller=controller)
+        shedder.connect(writer)
+        self.scheduler.schedule_periodic(src, 0.001)
+        controller.start()
+        self.scheduler.run_forever()
+        controller.stop()
+        report = controller.report()
+        self.assertGreater(report['level_changes'], 0)
+        self.assertGreater(report['events_shed'], 0)
+        self.assertEqual(200, shedder.events_in)
+        self.assertEqual(len(writer.written), shedder.events_out)
+        self.assertEqual(200, shedder.events_out + shedder.events_shed)
+        self.assertEqual({'writer':0}, report['queues'])
+
+    def test_lag(self):
+        """A slow filter causes loop lag, which raises the level. Once the
+        load goes away, the level recovers.
+        """
+        controller = SheddingController(self.scheduler,
+                                        lag_thresholds=(0.02,),
+                                        check_interval=0.02,
+                                        recovery_time=0.05)
+        levels = []
+        src = SensorAsOutputThing(ValueListSensor(1, list(range(40))))
+        slow = src.map(lambda e: time.sleep(0.03) or e if e.val<10 else e)
+        shedder = slow.sample({1:4}, controller=controller)
+        shedder.connect(lambda e: levels.append(controller.level))
+        self.scheduler.schedule_periodic(src, 0.01)
+        self.scheduler.enable_lag_monitor(probe_interval=0.005)
+        controller.start()
+        self.scheduler.run_forever()
+        self.assertIn(1, levels)
+        self.assertEqual(0, controller.level)
+        self.assertGreater(shedder.events_shed, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the per-thing metrics (Scheduler.enable_metrics() and friends).
+"""
+import asyncio
+import time
+import unittest
+
+from thingflow.base import Scheduler, from_list, _Connection
+from thingflow.metrics import LogHistogram, _InstrumentedConnection,\
+    print_metrics
+import thingflow.filters.map
+import thingflow.filters.where
+from utils import CaptureInputThing
+
+VALUES = list(range(10))
+
+
+def slow_double(x):
+    time.sleep(0.002)
+    return 2*x
+
+
+class TestLogHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        h = LogHistogram()
+        for v in range(1, 1001):
+            h.record(v)
+        self.assertEqual(1000, h.count)
+        self.assertEqual(1, h.min)
+        self.assertEqual(1000, h.max)
+        # buckets have a relative error of at most 1/8
+        for (p, expected) in [(50, 500), (90, 900), (99, 990)]:
+            actual = h.percentile(p)
+            self.assertGreaterEqual(actual, expected)
+            self.assertLessEqual(actual, expected*1.125)
+        self.assertEqual(1000, h.percentile(100))
+
+    def test_empty(self):
+        self.assertIsNone(LogHistogram().percentile(50))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_metrics(self):
+        src = from_list(VALUES)
+        doubled = src.map(slow_double)
+        evens = doubled.where(lambda x: x%4==0)
+        capture = CaptureInputThing()
+        evens.connect(capture)
+        self.scheduler.schedule_recurring(src)
+        self.assertFalse(self.scheduler.metrics()['enabled'])
+        self.scheduler.enable_metrics()
+        self.scheduler.run_forever()
+        self.assertEqual([2*v for v in VALUES if (2*v)%4==0], capture.events)
+        snapshot = self.scheduler.metrics()
+        print_metrics(snapshot)
+        self.assertTrue(snapshot['enabled'])
+        inputs = snapshot['inputs']
+        # the slow map filter should be first, even though its downstream
+        # things are called from within its on_next()
+        self.assertEqual('map', inputs[0]['thing'])
+        self.assertEqual(len(VALUES), inputs[0]['events_in'])
+        self.assertGreaterEqual(inputs[0]['self_ns']['total'],
+                                len(VALUES)*2000000)
+        by_name = dict([(m['thing'], m) for m in inputs])
+        self.assertEqual(len(VALUES), by_name['where']['events_in'])
+        self.assertLess(by_name['where']['self_ns']['total'],
+                        inputs[0]['self_ns']['total']/10)
+        self.assertEqual(1, by_name['where']['completed_in'])
+        outputs = dict([(m['thing'], m) for m in snapshot['outputs']])
+        self.assertEqual(len(VALUES)//2, outputs['where']['events_out'])
+        self.scheduler.disable_metrics()
+        self.assertFalse(self.scheduler.metrics()['enabled'])
+
+    def test_disable_restores_connections(self):
+        src = from_list(VALUES)
+        capture = CaptureInputThing()
+        src.map(lambda x: x).connect(capture)
+        self.scheduler.schedule_recurring(src)
+        self.scheduler.enable_metrics()
+        self.assertIsInstance(src.__connections__['default'][0],
+                              _InstrumentedConnection)
+        self.scheduler.disable_metrics()
+        conn = src.__connections__['default'][0]
+        self.assertNotIsInstance(conn, _InstrumentedConnection)
+        self.assertIsInstance(conn, _Connection)
+        self.scheduler.run_forever()
+        self.assertEqual(VALUES, capture.events)
+        # nothing was recorded while disabled
+        self.assertEqual(0, self.scheduler.metrics()['inputs'][0]['events_in'])
+
+
+if __name__ == '__main__':
+    unittest.main()
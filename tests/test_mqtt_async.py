@@ -8,19 +8,26 @@
 import unittest
 import sys
 import asyncio
+import json
 import string
+import time
 from random import choice, seed
-from thingflow.base import Scheduler, SensorAsOutputThing, SensorEvent
+from thingflow.base import Scheduler, SensorAsOutputThing, SensorEvent,\
+    from_list, ScheduleError
 import thingflow.filters.output
 import thingflow.filters.combinators
 import thingflow.filters.select
 from thingflow.filters.transducer import PeriodicMedianTransducer
-from utils import ValueListSensor, ValidateAndStopInputThing
+from thingflow.codecs import StructCodec
+from thingflow.adapters.async_generic import OVERFLOW_BLOCK
+from utils import ValueListSensor, ValidateAndStopInputThing,\
+    CaptureInputThing
 
 seed()
 
 try:
     import hbmqtt
+    import hbmqtt.session
     from thingflow.adapters.mqtt_async import QueueWriter, QueueReader
     HBMQTT_AVAILABLE = True
 except ImportError:
@@ -111,6 +118,234 @@ class TestCase(unittest.TestCase):
         self.send_and_recv_body(3.0)
         
 
+class LocalBroker:
+    """A stand-in for an MQTT broker, so that we can test the queue adapters
+    without a network. Each publish takes latency seconds, and every third
+    publish takes three times as long, so that publishes complete out of
+    order. Published messages are delivered to the clients subscribed to
+    the topic when the publish starts.
+    """
+    def __init__(self, latency=0.01):
+        self.latency = latency
+        self.published = [] # (topic, message) pairs, in completion order
+        self.max_in_flight = 0
+        self.in_flight = 0
+        self.subscribers = {} # map from topic to list of clients
+
+    def client(self):
+        return LocalBrokerClient(self)
+
+
+class LocalSession:
+    """Like the hbmqtt session, this holds the queue of messages delivered
+    to a client.
+    """
+    def __init__(self):
+        self.delivered_message_queue = asyncio.Queue()
+
+
+class LocalBrokerClient:
+    """A client for LocalBroker with the coroutine API of
+    hbmqtt.client.MQTTClient.
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.publishes = 0
+        self.session = None
+
+    async def connect(self, uri):
+        self.session = LocalSession()
+        await asyncio.sleep(self.broker.latency)
+
+    async def subscribe(self, topics):
+        for (topic, qos) in topics:
+            self.broker.subscribers.setdefault(topic, []).append(self)
+
+    async def unsubscribe(self, topics):
+        for topic in topics:
+            self.broker.subscribers[topic].remove(self)
+
+    async def deliver_message(self, timeout=None):
+        return await self.session.delivered_message_queue.get()
+
+    async def publish(self, topic, message, qos=None):
+        broker = self.broker
+        latency = broker.latency*(3 if self.publishes%3==0 else 1)
+        self.publishes += 1
+        broker.in_flight += 1
+        broker.max_in_flight = max(broker.max_in_flight, broker.in_flight)
+        # As with a real broker, messages are delivered in the order they
+        # were sent, even though the acknowledgements arrive out of order.
+        for client in broker.subscribers.get(topic, []):
+            client.session.delivered_message_queue.put_nowait(
+                hbmqtt.session.ApplicationMessage(None, topic, qos,
+                                                  bytearray(message), False))
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            broker.in_flight -= 1
+        broker.published.append((topic, message))
+
+    async def disconnect(self):
+        pass
+
+
+EVENTS = [SensorEvent('sensor-1', i, float(i)) for i in range(100)]
+
+
+@unittest.skipUnless(HBMQTT_AVAILABLE,
+                     "HBMQTT library not installed for python at %s" %
+                     sys.executable)
+class TestQueueWriterWindow(unittest.TestCase):
+    """Test the in-flight window and batching of QueueWriter, using the
+    local broker stand-in.
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.sched = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, broker, **kwargs):
+        src = from_list(EVENTS)
+        qw = QueueWriter(src, URL, 'topic', self.sched,
+                         client=broker.client(), **kwargs)
+        capture = CaptureInputThing()
+        qw.connect(capture)
+        self.sched.schedule_recurring(src)
+        start = time.time()
+        self.sched.run_forever()
+        self.assertFalse(qw.has_pending_requests(),
+                         "QueueWriter has pending requests: %s" % qw.dump_state())
+        self.assertEqual(EVENTS, capture.events)
+        self.assertTrue(capture.completed)
+        return (qw, time.time()-start)
+
+    def test_window(self):
+        broker = LocalBroker()
+        (qw, elapsed) = self._run(broker, max_in_flight=10)
+        self.assertEqual(10, broker.max_in_flight)
+        self.assertEqual(len(EVENTS), len(broker.published))
+        # one at a time would take at least len(EVENTS)*latency
+        self.assertLess(elapsed, len(EVENTS)*broker.latency)
+
+    def test_single_in_flight(self):
+        broker = LocalBroker(latency=0.001)
+        self._run(broker, max_in_flight=1)
+        self.assertEqual(1, broker.max_in_flight)
+
+    def test_batching(self):
+        broker = LocalBroker()
+        (qw, elapsed) = self._run(broker, max_in_flight=2, batch_size=25)
+        self.assertEqual(4, qw.messages_published)
+        self.assertEqual(4, len(broker.published))
+        batches = [json.loads(str(m, encoding='utf-8'))
+                   for (t, m) in broker.published]
+        self.assertEqual(len(EVENTS), sum(len(b) for b in batches))
+
+    def test_overflow(self):
+        broker = LocalBroker()
+        src = from_list(EVENTS)
+        QueueWriter(src, URL, 'topic', self.sched, client=broker.client(),
+                    max_queue_size=10)
+        self.sched.schedule_recurring(src)
+        with self.assertRaises(ScheduleError):
+            self.sched.run_forever()
+
+    def test_backpressure(self):
+        broker = LocalBroker()
+        (qw, elapsed) = self._run(broker, max_in_flight=2, max_queue_size=10,
+                                  on_overflow=OVERFLOW_BLOCK)
+        self.assertEqual(0, qw.dropped)
+        self.assertEqual(len(EVENTS), len(broker.published))
+
+
+@unittest.skipUnless(HBMQTT_AVAILABLE,
+                     "HBMQTT library not installed for python at %s" %
+                     sys.executable)
+class TestQueueReaderBatching(unittest.TestCase):
+    """Test the continuous consumer of QueueReader, using the local broker
+    stand-in.
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.sched = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _send_and_recv(self, batch_size=1, batches=False, codec='json',
+                       public_api_only=False):
+        broker = LocalBroker()
+        src = from_list(EVENTS)
+        QueueWriter(src, URL, 'topic', self.sched, client=broker.client(),
+                    max_in_flight=10, batch_size=batch_size, codec=codec)
+        qr = QueueReader(URL, 'topic', self.sched, client=broker.client(),
+                         batches=batches, batched_messages=batch_size>1,
+                         codec=codec)
+        if public_api_only:
+            # as if the client had no queue of delivered messages
+            qr._delivered_queue = lambda: None
+        stop_qr = self.sched.schedule_on_main_event_loop(qr)
+        capture = CaptureInputThing()
+        qr.connect(capture)
+        # wait for the reader to subscribe before sending
+        self.loop.call_later(5*broker.latency, self.sched.schedule_recurring,
+                             src)
+        def stop_after_all_received(x):
+            n = len(capture.events) if not batches else \
+                sum(len(b) for b in capture.events)
+            if n==len(EVENTS):
+                stop_qr()
+        qr.connect(stop_after_all_received)
+        self.sched.run_forever()
+        self.assertEqual(qr.state, QueueReader.FINAL_STATE)
+        self.assertTrue(capture.completed)
+        return (qr, capture)
+
+    def test_send_and_recv(self):
+        (qr, capture) = self._send_and_recv()
+        self.assertEqual(EVENTS, [msg_to_event(m) for m in capture.events])
+        self.assertEqual(len(EVENTS), qr.messages_received)
+        # the publishes complete in groups, which are received together
+        self.assertLess(qr.batches_received, qr.messages_received)
+
+    def test_public_api_only(self):
+        (qr, capture) = self._send_and_recv(public_api_only=True)
+        self.assertEqual(EVENTS, [msg_to_event(m) for m in capture.events])
+        self.assertEqual(qr.messages_received, qr.batches_received)
+
+    def test_batches(self):
+        (qr, capture) = self._send_and_recv(batches=True)
+        self.assertEqual(qr.batches_received, len(capture.events))
+        self.assertEqual(EVENTS, [msg_to_event(m) for b in capture.events
+                                  for m in b])
+
+    def test_batched_messages(self):
+        (qr, capture) = self._send_and_recv(batch_size=10)
+        self.assertEqual(10, qr.messages_received)
+        self.assertEqual(EVENTS, [msg_to_event(m) for m in capture.events])
+
+    def test_struct_codec(self):
+        codec = StructCodec('<8sdd')
+        (qr, capture) = self._send_and_recv(codec=codec)
+        self.assertEqual(EVENTS, capture.events)
+        (qr, capture) = self._send_and_recv(batch_size=10, codec=codec)
+        self.assertEqual(EVENTS, capture.events)
+
+    def test_stop_promptly(self):
+        broker = LocalBroker()
+        qr = QueueReader(URL, 'topic', self.sched, client=broker.client())
+        stop_qr = self.sched.schedule_on_main_event_loop(qr)
+        self.loop.call_later(0.1, stop_qr)
+        start = time.time()
+        self.sched.run_forever()
+        self.assertLess(time.time()-start, 0.5)
+        self.assertEqual(qr.state, QueueReader.FINAL_STATE)
+        self.assertEqual({'topic':[]}, broker.subscribers)
+
+
 if __name__ == '__main__':
     unittest.main()
     
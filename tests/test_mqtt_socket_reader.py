@@ -0,0 +1,91 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the MQTT readers with the mock client (does not require an mqtt
+broker or the paho client).
+"""
+import asyncio
+import time
+import unittest
+
+from thingflow.base import Scheduler, InputThing
+from thingflow.adapters.mqtt import MQTTReader, MQTTSocketReader,\
+    MockMQTTClient, MQTTEvent
+import thingflow.filters.take
+from utils import CaptureInputThing
+
+
+class StopLoopAfter(InputThing):
+    def __init__(self, stop_after, cancel_thunk):
+        self.events_left = stop_after
+        self.cancel_thunk = cancel_thunk
+
+    def on_next(self, x):
+        self.events_left -= 1
+        if self.events_left == 0:
+            self.cancel_thunk()
+
+
+class TestMQTTSocketReader(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_socket_reader(self):
+        m = MQTTSocketReader("localhost", self.scheduler,
+                             topics=[('bogus/bogus', 0),],
+                             mock_class=MockMQTTClient, max_packets=10)
+        capture = CaptureInputThing()
+        m.connect(capture)
+        c = self.scheduler.schedule_on_main_event_loop(m)
+        m.connect(StopLoopAfter(25, c))
+        self.scheduler.run_forever()
+        # we stop in the middle of the third batch
+        self.assertEqual(25, len(capture.events))
+        self.assertTrue(all(isinstance(e, MQTTEvent) for e in capture.events))
+        self.assertTrue(capture.completed)
+        self.assertIsNone(m.sock)
+
+    def test_socket_reader_batches(self):
+        m = MQTTSocketReader("localhost", self.scheduler,
+                             topics=[('bogus/bogus', 0),],
+                             mock_class=MockMQTTClient, max_packets=10,
+                             batches=True)
+        capture = CaptureInputThing()
+        m.take(3).connect(capture)
+        self.scheduler.schedule_on_main_event_loop(m)
+        self.scheduler.run_forever()
+        self.assertEqual([10, 10, 10], [len(b) for b in capture.events])
+        self.assertTrue(capture.completed)
+
+    def test_stop_before_start(self):
+        m = MQTTSocketReader("localhost", self.scheduler,
+                             topics=[('bogus/bogus', 0),],
+                             mock_class=MockMQTTClient)
+        capture = CaptureInputThing()
+        m.connect(capture)
+        c = self.scheduler.schedule_on_main_event_loop(m)
+        c()
+        self.scheduler.run_forever()
+        self.assertEqual([], capture.events)
+        self.assertTrue(capture.completed)
+
+    def test_private_loop_reader_stops_promptly(self):
+        m = MQTTReader("localhost", topics=[('bogus/bogus', 0),],
+                       mock_class=MockMQTTClient, batches=True)
+        capture = CaptureInputThing()
+        m.connect(capture)
+        c = self.scheduler.schedule_on_private_event_loop(m)
+        m.connect(StopLoopAfter(1, c))
+        start = time.time()
+        self.scheduler.run_forever()
+        self.assertLess(time.time()-start, 1.0)
+        self.assertGreaterEqual(len(capture.events), 1)
+        self.assertTrue(all(isinstance(b, list) and len(b)>0
+                            for b in capture.events))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,9 @@ Test the adapter to pandas (data analysis library)
 """
 
 import asyncio
+import datetime
+import os
+import time
 import unittest
 
 try:
@@ -11,8 +14,8 @@ try:
 except:
     PANDAS_AVAILABLE = False
 
-from utils import ValueListSensor
-from thingflow.base import Scheduler, SensorAsOutputThing
+from utils import ValueListSensor, CaptureInputThing
+from thingflow.base import Scheduler, SensorAsOutputThing, SensorEvent
 
 value_stream = [
     20,
@@ -24,6 +27,18 @@ value_stream = [
     2222
 ]
 
+
+def _replay(thing, scheduler):
+    """Run the scheduler until thing completes and return its events.
+    """
+    capture = CaptureInputThing()
+    thing.connect(capture)
+    scheduler.schedule_on_main_event_loop(thing)
+    scheduler.run_forever()
+    assert capture.completed
+    return capture.events
+
+
 @unittest.skipUnless(PANDAS_AVAILABLE, "pandas library not installed")
 class TestPandas(unittest.TestCase):
     def test_pandas(self):
@@ -39,7 +54,7 @@ class TestPandas(unittest.TestCase):
         self.assertTrue(w.result is not None, "Result of pandas never set")
         # now we verify each element
         for (i, v) in enumerate(value_stream):
-            pv = w.result[i]
+            pv = w.result.iloc[i]
             self.assertTrue(isinstance(pv, numpy.int64),
                             "Expecting pandas value '%s' to be numpy.int64, but instead was %s" %
                             (pv, repr(type(pv))))
@@ -48,6 +63,111 @@ class TestPandas(unittest.TestCase):
                              (repr(pv), repr(v)))
         print("Validate pandas array")
 
+    def test_pandas_growth(self):
+        import thingflow.adapters.pandas
+        import numpy
+        w = thingflow.adapters.pandas.PandasSeriesWriter(initial_capacity=2)
+        events = [SensorEvent(1, 1500000000.0+i, i) for i in range(10)] + \
+                 [SensorEvent(1, 1500000010.5, 10.5)]
+        for e in events[:5]:
+            w.on_next(e)
+        first = w.snapshot()
+        for e in events[5:]:
+            w.on_next(e)
+        new = w.snapshot(incremental=True)
+        w.on_completed()
+        # the integers were widened to floats by the last value
+        self.assertEqual(numpy.float64, w.result.dtype)
+        self.assertEqual([e.val for e in events], list(w.result.values))
+        self.assertEqual([e.val for e in events[:5]], list(first.values))
+        self.assertEqual([e.val for e in events[5:]], list(new.values))
+        self.assertEqual(pandas.Timestamp(1500000010.5, unit='s', tz='UTC'),
+                         w.result.index[-1])
+
+    def test_local_time_dst(self):
+        import thingflow.adapters.pandas
+        if not hasattr(time, 'tzset'):
+            self.skipTest("time.tzset() not available")
+        old_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            # one timestamp in summer time and one in winter time
+            timestamps = [1500000000.0, 1510000000.0]
+            w = thingflow.adapters.pandas.PandasSeriesWriter(tz=None)
+            for (i, ts) in enumerate(timestamps):
+                w.on_next(SensorEvent(1, ts, i))
+            w.on_completed()
+            self.assertEqual([datetime.datetime.fromtimestamp(ts)
+                              for ts in timestamps],
+                             list(w.result.index.to_pydatetime()))
+        finally:
+            if old_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = old_tz
+            time.tzset()
+
+    def test_pandas_data_frame(self):
+        import thingflow.adapters.pandas
+        import numpy
+        w = thingflow.adapters.pandas.PandasDataFrameWriter()
+        w.on_next(SensorEvent('a', 1.0, 10))
+        w.on_next(SensorEvent('b', 1.0, 20))
+        w.on_next(SensorEvent('a', 2.0, 11))
+        first = w.snapshot(incremental=True)
+        w.on_next(SensorEvent('c', 3.0, 30))
+        new = w.snapshot(incremental=True)
+        w.on_completed()
+        self.assertEqual(['a', 'b', 'c'], list(w.result.columns))
+        self.assertEqual(3, len(w.result))
+        self.assertEqual(11.0, w.result['a'].iloc[1])
+        self.assertTrue(numpy.isnan(w.result['b'].iloc[1]))
+        self.assertEqual(['a', 'b'], list(first.columns))
+        self.assertEqual(['c'], list(new.columns))
+        self.assertEqual([30.0], list(new['c'].values))
+
+    def test_data_frame_replay(self):
+        import thingflow.adapters.pandas
+        events = [SensorEvent('s%d' % (i%3), 1500000000.0+i, float(i))
+                  for i in range(25)]
+        df = pandas.DataFrame({'sensor_id':[e.sensor_id for e in events],
+                               'ts':[e.ts for e in events],
+                               'val':[e.val for e in events]})
+        sch = Scheduler(asyncio.new_event_loop())
+        batches = _replay(
+            thingflow.adapters.pandas.DataFrameAsOutputThing(df, sch,
+                                                             chunk_size=10),
+            sch)
+        self.assertEqual([10, 10, 5], [len(b) for b in batches])
+        self.assertEqual(events, [e for b in batches for e in b])
+        # the same, with a datetime index, as individual events
+        df = pandas.DataFrame({'val':[e.val for e in events]},
+                              index=pandas.to_datetime([e.ts for e in events],
+                                                       unit='s', utc=True))
+        self.assertEqual([SensorEvent('s', e.ts, e.val) for e in events],
+                         _replay(
+            thingflow.adapters.pandas.DataFrameAsOutputThing(
+                df, sch, sensor_id='s', ts_column=None, chunk_size=10,
+                batches=False), sch))
+
+    def test_paced_replay(self):
+        import thingflow.adapters.pandas
+        import numpy
+        sch = Scheduler(asyncio.new_event_loop())
+        ts = 1500000000.0 + numpy.arange(20)*0.5 # ten seconds of data
+        thing = thingflow.adapters.pandas.from_arrays(ts, numpy.arange(20),
+                                                      sch, sensor_id=1,
+                                                      speed=20.0)
+        start = time.time()
+        batches = _replay(thing, sch)
+        elapsed = time.time()-start
+        self.assertEqual(list(range(20)), [e.val for b in batches for e in b])
+        self.assertGreater(len(batches), 5)
+        self.assertGreaterEqual(elapsed, 0.45)
+        self.assertLess(elapsed, 2.0)
+
+
 if __name__ == '__main__':
     unittest.main()
 
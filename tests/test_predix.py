@@ -20,8 +20,7 @@ except ImportError:
     PREDIX_QUERY_URL=None
 
 try:
-    import websocket
-    import requests
+    import aiohttp
     from thingflow.adapters.predix import *
     PREREQS_AVAILABLE = True
 except ImportError:
@@ -79,12 +78,13 @@ class TestPredix(unittest.TestCase):
         """
         sensor1 = make_test_output_thing_from_vallist(TEST_SENSOR1, VALUE_STREAM)
         sensor2 = make_test_output_thing_from_vallist(TEST_SENSOR2, VALUE_STREAM)
+        scheduler = Scheduler(asyncio.get_event_loop())
         writer = PredixWriter(PREDIX_INGEST_URL, PREDIX_ZONE_ID, PREDIX_TOKEN,
+                              scheduler=scheduler,
                               extractor=EventExtractor(attributes={'test':True}),
                               batch_size=3)
         sensor1.connect(writer)
         sensor2.connect(writer)
-        scheduler = Scheduler(asyncio.get_event_loop())
         scheduler.schedule_periodic(sensor1, 0.5)
         scheduler.schedule_periodic(sensor2, 0.5)
 
@@ -93,15 +93,15 @@ class TestPredix(unittest.TestCase):
 
         # Now we read the events back
         reader1 = PredixReader(PREDIX_QUERY_URL, PREDIX_ZONE_ID, PREDIX_TOKEN, TEST_SENSOR1,
-                               start_time=start_time,
-                               one_shot=False)
+                               scheduler=scheduler, start_time=start_time,
+                               one_shot=False, min_interval=2, max_interval=2)
         reader2 = PredixReader(PREDIX_QUERY_URL, PREDIX_ZONE_ID, PREDIX_TOKEN, TEST_SENSOR2,
-                               start_time=start_time,
-                               one_shot=False)
+                               scheduler=scheduler, start_time=start_time,
+                               one_shot=False, min_interval=2, max_interval=2)
         ti1 = TestInput(reader1, 'sensor-1')
         ti2 = TestInput(reader2, 'sensor-2')
-        scheduler.schedule_periodic(reader1, 2)
-        scheduler.schedule_periodic(reader2, 2)
+        ti1.disconnect = scheduler.schedule_on_main_event_loop(reader1)
+        ti2.disconnect = scheduler.schedule_on_main_event_loop(reader2)
         scheduler.run_forever()
         self.assertListEqual(VALUE_STREAM, ti1.values)
         self.assertListEqual(VALUE_STREAM, ti2.values)
@@ -112,12 +112,13 @@ class TestPredix(unittest.TestCase):
         """
         sensor1 = make_test_output_thing_from_vallist(TEST_SENSOR1, VALUE_STREAM)
         sensor2 = make_test_output_thing_from_vallist(TEST_SENSOR2, VALUE_STREAM)
+        scheduler = Scheduler(asyncio.get_event_loop())
         writer = PredixWriter(PREDIX_INGEST_URL, PREDIX_ZONE_ID, PREDIX_TOKEN,
+                              scheduler=scheduler,
                               extractor=EventExtractor(attributes={'test':True}),
                               batch_size=1)
         sensor1.connect(writer)
         sensor2.connect(writer)
-        scheduler = Scheduler(asyncio.get_event_loop())
         scheduler.schedule_periodic(sensor1, 0.5)
         scheduler.schedule_periodic(sensor2, 0.5)
 
@@ -126,15 +127,15 @@ class TestPredix(unittest.TestCase):
 
         # Now we read the events back
         reader1 = PredixReader(PREDIX_QUERY_URL, PREDIX_ZONE_ID, PREDIX_TOKEN, TEST_SENSOR1,
-                               start_time=start_time,
-                               one_shot=False)
+                               scheduler=scheduler, start_time=start_time,
+                               one_shot=False, min_interval=2, max_interval=2)
         reader2 = PredixReader(PREDIX_QUERY_URL, PREDIX_ZONE_ID, PREDIX_TOKEN, TEST_SENSOR2,
-                               start_time=start_time,
-                               one_shot=False)
+                               scheduler=scheduler, start_time=start_time,
+                               one_shot=False, min_interval=2, max_interval=2)
         ti1 = TestInput(reader1, 'sensor-1')
         ti2 = TestInput(reader2, 'sensor-2')
-        scheduler.schedule_periodic(reader1, 2)
-        scheduler.schedule_periodic(reader2, 2)
+        ti1.disconnect = scheduler.schedule_on_main_event_loop(reader1)
+        ti2.disconnect = scheduler.schedule_on_main_event_loop(reader2)
         scheduler.run_forever()
         self.assertListEqual(VALUE_STREAM, ti1.values)
         self.assertListEqual(VALUE_STREAM, ti2.values)
@@ -0,0 +1,244 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the PredixReader against a local stand-in for the Predix time series
+query API. The HTTP session is replaced by an in-process object with the
+same coroutine API, and, if aiohttp is installed, we also test against a
+local aiohttp HTTP server.
+"""
+import asyncio
+import json
+import time
+import unittest
+
+from thingflow.base import Scheduler, SensorEvent, InputThing
+from thingflow.adapters.predix import PredixReader, _split_range,\
+    ts_to_predix_ts
+from utils import CaptureInputThing
+
+try:
+    import aiohttp
+    import aiohttp.web
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+SENSOR_ID = 'sensor-1'
+START_TIME = 1500000000.0
+
+
+class LocalQueryService:
+    """Answer time series queries for SENSOR_ID from a list of (timestamp,
+    value) pairs, after latency seconds. Records the queried ranges (when
+    each query arrives) and the maximum number of queries in progress at
+    once.
+    """
+    def __init__(self, datapoints, latency=0.01, status=200):
+        self.datapoints = datapoints
+        self.latency = latency
+        self.status = status
+        self.ranges = []
+        self.in_progress = 0
+        self.max_in_progress = 0
+
+    def record(self, request):
+        self.ranges.append((request['start'], request['end']))
+
+    def respond(self, request):
+        start = request['start']
+        end = request['end']
+        values = [[ts_to_predix_ts(ts), val, 3]
+                  for (ts, val) in self.datapoints
+                  if start<=ts_to_predix_ts(ts)<=end]
+        return {'tags':[{'name':request['tags'][0]['name'],
+                         'results':[{'values':values}],
+                         'stats':{'rawCount':len(values)}}]}
+
+    async def query(self, data):
+        request = json.loads(data)
+        self.record(request)
+        self.in_progress += 1
+        self.max_in_progress = max(self.max_in_progress, self.in_progress)
+        try:
+            await asyncio.sleep(self.latency)
+            return self.respond(request)
+        finally:
+            self.in_progress -= 1
+
+
+class LocalResponse:
+    def __init__(self, service, data):
+        self.service = service
+        self.data = data
+        self.status = service.status
+
+    async def __aenter__(self):
+        self.body = json.dumps(await self.service.query(self.data))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def read(self):
+        return self.body.encode('utf-8')
+
+
+class LocalQuerySession:
+    def __init__(self, service):
+        self.service = service
+        self.headers = None
+
+    def post(self, url, data=None, headers=None):
+        self.headers = headers
+        return LocalResponse(self.service, data)
+
+
+class StopAfter(InputThing):
+    def __init__(self, n):
+        self.events_left = n
+        self.cancel_thunk = None
+
+    def on_next(self, x):
+        self.events_left -= 1
+        if self.events_left==0:
+            self.cancel_thunk()
+
+
+class TestSplitRange(unittest.TestCase):
+    def test_split_range(self):
+        self.assertEqual([(0, 9), (10, 19), (20, 25)], _split_range(0, 25, 10))
+        self.assertEqual([(0, 9)], _split_range(0, 9, 10))
+        self.assertEqual([(5, 25)], _split_range(5, 25, None))
+
+
+class TestPredixReader(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _reader(self, service, **kwargs):
+        return PredixReader('http://localhost/query', 'zone', 'token',
+                            SENSOR_ID, scheduler=self.scheduler,
+                            session=LocalQuerySession(service), **kwargs)
+
+    def test_split_queries(self):
+        datapoints = [(START_TIME+0.5*i, float(i)) for i in range(200)]
+        service = LocalQueryService(datapoints)
+        reader = self._reader(service, start_time=START_TIME,
+                              end_time=START_TIME+100, one_shot=True,
+                              max_range=10, max_parallel=3)
+        capture = CaptureInputThing()
+        reader.connect(capture)
+        # record how many queries were issued when each event was dispatched
+        issued = []
+        reader.connect(lambda e: issued.append(len(service.ranges)))
+        self.scheduler.schedule_on_main_event_loop(reader)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.completed)
+        self.assertEqual([SensorEvent(SENSOR_ID, ts, val)
+                          for (ts, val) in datapoints], capture.events)
+        self.assertEqual(11, len(service.ranges))
+        self.assertEqual(3, service.max_in_progress)
+        # the later sub-ranges were queried while the first was dispatched
+        self.assertEqual(3, issued[0])
+
+    def test_polling(self):
+        now = round(time.time(), 3)
+        datapoints = [(round(now-1.0+0.05*i, 3), float(i)) for i in range(30)]
+        service = LocalQueryService(datapoints)
+        reader = self._reader(service, start_time=now-2.0,
+                              min_interval=0.05, max_interval=0.2)
+        capture = CaptureInputThing()
+        reader.connect(capture)
+        stop = StopAfter(len(datapoints))
+        stop.cancel_thunk = self.scheduler.schedule_on_main_event_loop(reader)
+        reader.connect(stop)
+        self.scheduler.run_forever()
+        # all the events were read, once each, over several queries
+        self.assertEqual([SensorEvent(SENSOR_ID, ts, val)
+                          for (ts, val) in datapoints], capture.events)
+        self.assertTrue(capture.completed)
+        self.assertGreater(len(service.ranges), 2)
+        self.assertEqual('Bearer token',
+                         reader.session.headers['Authorization'])
+
+    def test_end_time(self):
+        # the last event is at the end time, so we are done after it
+        datapoints = [(START_TIME+0.5*i, float(i)) for i in range(21)]
+        service = LocalQueryService(datapoints)
+        reader = self._reader(service, start_time=START_TIME,
+                              end_time=START_TIME+10, one_shot=False,
+                              min_interval=0.05, max_interval=0.05)
+        capture = CaptureInputThing()
+        reader.connect(capture)
+        self.scheduler.schedule_on_main_event_loop(reader)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.completed)
+        self.assertEqual([SensorEvent(SENSOR_ID, ts, val)
+                          for (ts, val) in datapoints], capture.events)
+        self.assertEqual(1, len(service.ranges))
+
+    def test_adapt_interval(self):
+        reader = self._reader(LocalQueryService([]), interval=5.0,
+                              min_interval=1.0, max_interval=60.0,
+                              target_events=100)
+        reader._adapt_interval(1000, 10000) # 100 events/sec
+        self.assertEqual(1.0, reader.interval)
+        reader._adapt_interval(50, 10000) # 5 events/sec
+        self.assertEqual(20.0, reader.interval)
+        reader._adapt_interval(0, 10000)
+        self.assertEqual(40.0, reader.interval)
+        reader._adapt_interval(0, 10000)
+        self.assertEqual(60.0, reader.interval)
+
+    def test_query_error(self):
+        service = LocalQueryService([], status=500)
+        reader = self._reader(service, start_time=START_TIME,
+                              end_time=START_TIME+1, one_shot=True)
+        capture = CaptureInputThing(expecting_error=True)
+        reader.connect(capture)
+        self.scheduler.schedule_on_main_event_loop(reader)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.errored)
+
+
+@unittest.skipUnless(AIOHTTP_AVAILABLE, "aiohttp not installed")
+class TestPredixReaderHttp(unittest.TestCase):
+    def test_local_server(self):
+        loop = asyncio.new_event_loop()
+        scheduler = Scheduler(loop)
+        datapoints = [(START_TIME+0.5*i, float(i)) for i in range(50)]
+        service = LocalQueryService(datapoints)
+        async def query(request):
+            query = await request.json()
+            service.record(query)
+            return aiohttp.web.json_response(service.respond(query))
+        app = aiohttp.web.Application()
+        app.router.add_post('/query', query)
+        runner = aiohttp.web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = aiohttp.web.TCPSite(runner, 'localhost', 0)
+        loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        capture = CaptureInputThing()
+        try:
+            reader = PredixReader('http://localhost:%d/query' % port, 'zone',
+                                  'token', SENSOR_ID, scheduler=scheduler,
+                                  start_time=START_TIME,
+                                  end_time=START_TIME+30, one_shot=True,
+                                  max_range=10)
+            reader.connect(capture)
+            scheduler.schedule_on_main_event_loop(reader)
+            scheduler.run_forever()
+        finally:
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+        self.assertEqual([SensorEvent(SENSOR_ID, ts, val)
+                          for (ts, val) in datapoints], capture.events)
+        self.assertEqual(4, len(service.ranges))
+
+
+if __name__ == '__main__':
+    unittest.main()
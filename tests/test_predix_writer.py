@@ -0,0 +1,195 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the PredixWriter against a local stand-in for the Predix ingest
+websocket API. The websocket is replaced by an in-process object with the
+same coroutine API, and, if aiohttp is installed, we also test against a
+local aiohttp websocket server.
+"""
+import asyncio
+import json
+import unittest
+
+from thingflow.base import Scheduler, SensorEvent, ScheduleError
+from thingflow.adapters.predix import PredixWriter
+
+try:
+    import aiohttp
+    import aiohttp.web
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+EVENTS = [SensorEvent('sensor-%d' % (i%2), 1500000000.0+i, float(i))
+          for i in range(25)]
+
+
+def datapoints(messages):
+    """Return the events in the ingest messages, ordered by timestamp.
+    """
+    events = []
+    for m in messages:
+        for tag in m['body']:
+            events.extend([SensorEvent(tag['name'], ts/1000, val)
+                           for (ts, val, quality) in tag['datapoints']])
+    return sorted(events, key=lambda e: e.ts)
+
+
+class LocalIngestSocket:
+    """Stands in for the websocket to the ingest service. Each message is
+    acknowledged after latency seconds, with every third acknowledgement
+    taking three times as long, so that acknowledgements arrive out of
+    order. If fail_message is set, that message gets an error status. If
+    lose_message is set, that message is never acknowledged.
+    """
+    def __init__(self, latency, fail_message=None, lose_message=None):
+        self.latency = latency
+        self.fail_message = fail_message
+        self.lose_message = lose_message
+        self.messages = []
+        self.unacked = 0
+        self.max_unacked = 0
+        self.acks = asyncio.Queue()
+
+    async def send_str(self, data):
+        message = json.loads(data)
+        self.messages.append(message)
+        self.unacked += 1
+        self.max_unacked = max(self.max_unacked, self.unacked)
+        n = len(self.messages)
+        delay = self.latency*(3 if n%3==0 else 1)
+        if n==self.lose_message:
+            return
+        status = 400 if n==self.fail_message else 202
+        asyncio.get_event_loop().call_later(delay, self._ack,
+                                            message['messageId'], status)
+
+    def _ack(self, mid, status):
+        self.unacked -= 1
+        self.acks.put_nowait(json.dumps({'messageId':mid,
+                                         'statusCode':status}))
+
+    async def receive_str(self):
+        ack = await self.acks.get()
+        if ack is None:
+            raise Exception("websocket closed")
+        return ack
+
+    async def close(self):
+        self.acks.put_nowait(None)
+
+
+class LocalIngestSession:
+    def __init__(self, socket):
+        self.socket = socket
+        self.headers = None
+
+    async def ws_connect(self, url, headers=None):
+        self.headers = headers
+        return self.socket
+
+
+class TestPredixWriter(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _push(self, writer, events, interval=0):
+        async def push():
+            for e in events:
+                writer.on_next(e)
+                if interval:
+                    await asyncio.sleep(interval)
+            writer.on_completed()
+        self.scheduler._schedule_coroutine(push(), lambda f: None)
+
+    def test_pipelined(self):
+        socket = LocalIngestSocket(latency=0.05)
+        session = LocalIngestSession(socket)
+        writer = PredixWriter('ws://localhost/ingest', 'zone', 'token',
+                              batch_size=2, scheduler=self.scheduler,
+                              max_unacked=4,
+                              session=session)
+        self._push(writer, EVENTS)
+        self.scheduler.run_forever()
+        self.assertEqual(13, len(socket.messages))
+        self.assertEqual(13, writer.messages_acked)
+        self.assertEqual(EVENTS, datapoints(socket.messages))
+        # several messages were awaiting acknowledgement at once, but no
+        # more than the window
+        self.assertEqual(4, socket.max_unacked)
+        self.assertEqual('Bearer token', session.headers['Authorization'])
+        self.assertEqual(13, len(set(m['messageId'] for m in socket.messages)))
+
+    def test_flush_interval(self):
+        socket = LocalIngestSocket(latency=0.01)
+        writer = PredixWriter('ws://localhost/ingest', 'zone', 'token',
+                              batch_size=100, scheduler=self.scheduler,
+                              flush_interval=0.05,
+                              session=LocalIngestSession(socket))
+        self._push(writer, EVENTS[:10], interval=0.02)
+        self.scheduler.run_forever()
+        # partial batches were sent on the timer, well before completion
+        self.assertGreater(len(socket.messages), 1)
+        self.assertLess(len(socket.messages), 10)
+        self.assertEqual(EVENTS[:10], datapoints(socket.messages))
+
+    def test_error_status(self):
+        socket = LocalIngestSocket(latency=0.01, fail_message=2)
+        writer = PredixWriter('ws://localhost/ingest', 'zone', 'token',
+                              batch_size=2, scheduler=self.scheduler,
+                              session=LocalIngestSession(socket))
+        self._push(writer, EVENTS)
+        self.assertRaises(ScheduleError, self.scheduler.run_forever)
+
+    def test_ack_timeout(self):
+        socket = LocalIngestSocket(latency=0.01, lose_message=2)
+        writer = PredixWriter('ws://localhost/ingest', 'zone', 'token',
+                              batch_size=2, scheduler=self.scheduler,
+                              ack_timeout=0.1,
+                              session=LocalIngestSession(socket))
+        self._push(writer, EVENTS)
+        self.assertRaises(ScheduleError, self.scheduler.run_forever)
+        self.assertIn('no acknowledgement', str(self.scheduler.fatal_error))
+
+
+@unittest.skipUnless(AIOHTTP_AVAILABLE, "aiohttp not installed")
+class TestPredixWriterWebsocket(unittest.TestCase):
+    def test_local_server(self):
+        loop = asyncio.new_event_loop()
+        scheduler = Scheduler(loop)
+        messages = []
+        async def ingest(request):
+            ws = aiohttp.web.WebSocketResponse()
+            await ws.prepare(request)
+            async for msg in ws:
+                message = json.loads(msg.data)
+                messages.append(message)
+                await ws.send_str(json.dumps({'messageId':message['messageId'],
+                                              'statusCode':202}))
+            return ws
+        app = aiohttp.web.Application()
+        app.router.add_get('/ingest', ingest)
+        runner = aiohttp.web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = aiohttp.web.TCPSite(runner, 'localhost', 0)
+        loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            writer = PredixWriter('http://localhost:%d/ingest' % port, 'zone',
+                                  'token', batch_size=5, scheduler=scheduler)
+            for e in EVENTS:
+                writer.on_next(e)
+            writer.on_completed()
+            scheduler.run_forever()
+        finally:
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+        self.assertEqual(5, len(messages))
+        self.assertEqual(EVENTS, datapoints(messages))
+
+
+if __name__ == '__main__':
+    unittest.main()
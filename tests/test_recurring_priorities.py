@@ -0,0 +1,89 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test priorities and weighted fair sharing between recurring schedules.
+"""
+import asyncio
+import itertools
+import time
+import unittest
+
+from thingflow.base import Scheduler, from_iterable, from_list,\
+    SensorAsOutputThing, PRIORITY_HIGH, PRIORITY_BACKGROUND
+import thingflow.filters.map
+from utils import CaptureInputThing, ValueListSensor
+
+
+def busy(x, seconds=0.0002):
+    start = time.perf_counter()
+    while time.perf_counter()-start < seconds:
+        pass
+    return x
+
+
+class TestRecurringPriorities(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_weights(self):
+        light = from_iterable(itertools.count())
+        heavy = from_iterable(itertools.count())
+        light_capture = CaptureInputThing()
+        heavy_capture = CaptureInputThing()
+        light.map(busy).connect(light_capture)
+        heavy.map(busy).connect(heavy_capture)
+        self.scheduler.schedule_recurring(light, weight=1)
+        self.scheduler.schedule_recurring(heavy, weight=3)
+        self.loop.call_later(0.5, self.scheduler.stop)
+        self.scheduler.run_forever()
+        ratio = len(heavy_capture.events)/len(light_capture.events)
+        self.assertTrue(2.0<ratio<4.5, "ratio was %s" % ratio)
+
+    def test_strict_priority(self):
+        order = []
+        high = from_list(list(range(50)))
+        background = from_list(list(range(50)))
+        high.map(busy).connect(lambda x: order.append('high'))
+        background.map(busy).connect(lambda x: order.append('background'))
+        # schedule the background first, it should still go last
+        self.scheduler.schedule_recurring(background,
+                                          priority=PRIORITY_BACKGROUND)
+        self.scheduler.schedule_recurring(high, priority=PRIORITY_HIGH)
+        self.scheduler.run_forever()
+        self.assertEqual(['high']*50 + ['background']*50, order)
+
+    def test_periodic_not_starved(self):
+        """A background replay should not delay a periodic sensor by much
+        more than the time slice.
+        """
+        replay = from_iterable(itertools.count())
+        replay.map(lambda x: busy(x, 0.001)).connect(CaptureInputThing())
+        cancel_replay = self.scheduler.schedule_recurring(
+            replay, priority=PRIORITY_BACKGROUND)
+        sensor = SensorAsOutputThing(ValueListSensor(1, list(range(10))))
+        capture = CaptureInputThing()
+        sensor.connect(capture)
+        self.scheduler.schedule_periodic(sensor, 0.02)
+        sensor.connect(lambda x: cancel_replay() if x.val==9 else None)
+        self.scheduler.run_forever()
+        self.assertEqual(list(range(10)), [e.val for e in capture.events])
+        gaps = [b.ts-a.ts for (a, b) in zip(capture.events[:-1],
+                                             capture.events[1:])]
+        self.assertLess(max(gaps), 0.02 + 0.015)
+
+    def test_cancel(self):
+        src = from_iterable(itertools.count())
+        capture = CaptureInputThing()
+        src.connect(capture)
+        cancel = self.scheduler.schedule_recurring(src)
+        self.loop.call_later(0.05, cancel)
+        self.scheduler.run_forever()
+        self.assertGreater(len(capture.events), 0)
+        self.assertEqual({}, self.scheduler.active_schedules)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the synthetic sensor fleet in thingflow.sensors.fleet
+"""
+import asyncio
+import json
+import os.path
+import tempfile
+import unittest
+
+from thingflow.base import Scheduler
+from thingflow.adapters.csv import CsvReader
+from thingflow.sensors.fleet import SensorFleet, FleetOutputThing,\
+    read_binary, sine, random_walk, uniform
+from utils import CaptureInputThing
+
+
+class RecordingClient:
+    """Stand-in for a paho MQTT client"""
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos):
+        self.messages.append((topic, payload, qos))
+
+
+class TestSensorFleet(unittest.TestCase):
+    def test_deterministic(self):
+        fleet = SensorFleet(10, rate=5, burstiness=1.0, out_of_order=0.1,
+                            dropout=0.01, seed=42)
+        e1 = list(fleet.events(max_events=500))
+        e2 = list(fleet.events(max_events=500))
+        self.assertEqual(500, len(e1))
+        self.assertEqual(e1, e2)
+        delivery = [d for (d, e) in e1]
+        self.assertEqual(sorted(delivery), delivery)
+
+    def test_rates(self):
+        fleet = SensorFleet(3, rate=[1, 10, 100], seed=1)
+        counts = {0:0, 1:0, 2:0}
+        for e in fleet.sensor_events(duration=10):
+            counts[e.sensor_id] += 1
+        self.assertTrue(9<=counts[0]<=11, counts)
+        self.assertTrue(99<=counts[1]<=101, counts)
+        self.assertTrue(999<=counts[2]<=1001, counts)
+        # bursty arrivals have about the same mean rate
+        bursty = SensorFleet(1, rate=100, burstiness=2.0, seed=1)
+        n = len(list(bursty.events(duration=100)))
+        self.assertTrue(8000<n<12000, n)
+
+    def test_out_of_order(self):
+        fleet = SensorFleet(1, rate=10, out_of_order=0.2, max_lateness=0.5,
+                            seed=3)
+        events = list(fleet.events(duration=100))
+        late = [(d, e) for (d, e) in events if e.ts<d]
+        self.assertTrue(100<len(late)<300, len(late))
+        self.assertTrue(all(d-e.ts<=0.5 for (d, e) in late))
+        ts = [e.ts for (d, e) in events]
+        self.assertNotEqual(sorted(ts), ts)
+
+    def test_dropout(self):
+        full = len(list(SensorFleet(5, rate=10, seed=3).events(duration=100)))
+        fleet = SensorFleet(5, rate=10, dropout=0.01,
+                            mean_dropout_duration=5.0, seed=3)
+        dropped = len(list(fleet.events(duration=100)))
+        self.assertLess(dropped, 0.8*full)
+
+    def test_value_models(self):
+        for model in (sine(100, 10, 5), random_walk(50, 1), uniform(0, 1)):
+            fleet = SensorFleet(2, rate=10, values=model, seed=1)
+            vals = [e.val for e in fleet.sensor_events(max_events=100)]
+            self.assertEqual(100, len(vals))
+        vals = [e.val for e in SensorFleet(1, values=sine(100, 10, 5), seed=1)\
+                                   .sensor_events(max_events=100)]
+        self.assertTrue(all(90<=v<=110 for v in vals))
+
+    def test_output_thing_batches(self):
+        scheduler = Scheduler(asyncio.new_event_loop())
+        fleet = SensorFleet(4, rate=10, seed=5)
+        o = FleetOutputThing(fleet, max_events=95, batch_size=10)
+        capture = CaptureInputThing()
+        o.connect(capture)
+        scheduler.schedule_recurring(o)
+        scheduler.run_forever()
+        scheduler.event_loop.close()
+        self.assertTrue(capture.completed)
+        self.assertEqual([10]*9 + [5], [len(b) for b in capture.events])
+        self.assertEqual(95, o.events_dispatched)
+
+    def test_output_thing_realtime(self):
+        scheduler = Scheduler(asyncio.new_event_loop())
+        fleet = SensorFleet(10, rate=20, seed=5)
+        o = FleetOutputThing(fleet, duration=0.5, realtime=True)
+        capture = CaptureInputThing()
+        o.connect(capture)
+        scheduler.schedule_periodic(o, 0.02)
+        loop_start = scheduler.event_loop.time()
+        scheduler.run_forever()
+        elapsed = scheduler.event_loop.time() - loop_start
+        scheduler.event_loop.close()
+        self.assertTrue(capture.completed)
+        self.assertTrue(90<=len(capture.events)<=110, len(capture.events))
+        self.assertGreaterEqual(elapsed, 0.45)
+
+    def test_files(self):
+        fleet = SensorFleet(3, rate=10, seed=7)
+        expected = list(fleet.sensor_events(start_ts=1000.0, max_events=50))
+        with tempfile.TemporaryDirectory() as d:
+            binfile = os.path.join(d, 'fleet.bin')
+            self.assertEqual(50, fleet.write_binary(binfile, start_ts=1000.0,
+                                                    max_events=50))
+            self.assertEqual(expected, list(read_binary(binfile)))
+            csvfile = os.path.join(d, 'fleet.csv')
+            self.assertEqual(50, fleet.write_csv(csvfile, start_ts=1000.0,
+                                                 max_events=50))
+            scheduler = Scheduler(asyncio.new_event_loop())
+            reader = CsvReader(csvfile)
+            capture = CaptureInputThing()
+            reader.connect(capture)
+            scheduler.schedule_recurring(reader)
+            scheduler.run_forever()
+            scheduler.event_loop.close()
+            self.assertEqual(expected, capture.events)
+
+    def test_publish(self):
+        fleet = SensorFleet(2, rate=10, sensor_ids=['a', 'b'], seed=7)
+        client = RecordingClient()
+        self.assertEqual(20, fleet.publish(client, max_events=20))
+        (topic, payload, qos) = client.messages[0]
+        self.assertIn(topic, ('sensors/a', 'sensors/b'))
+        self.assertEqual(topic.split('/')[1], json.loads(payload)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
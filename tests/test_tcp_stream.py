@@ -1,22 +1,147 @@
 # Copyright 2016 by MPI-SWS and Data-Ken Research.
 # Licensed under the Apache 2.0 License.
+"""Test the TCP stream sink and reader over the loopback interface.
+"""
 import asyncio
+import json
+import unittest
 
-from antevents.tcpstreamer import TcpStreamObserver
-from antevents.base import make_test_publisher, Scheduler
+from thingflow.base import Scheduler, OutputThing, SensorEvent
+from thingflow.adapters.tcpstreamer import TcpStreamInputThing,\
+    TcpStreamReader, _FrameParser, FRAMING_NEWLINE, FRAMING_LENGTH,\
+    SLOW_CLIENT_CONFLATE
+from utils import CaptureInputThing
 
+EVENTS = [SensorEvent(sensor_id=i%3, ts=float(i), val=i*0.5)
+          for i in range(50)]
 
-loop = asyncio.get_event_loop()
 
-s = make_test_publisher(1, stop_after_events=10)
+class TestFrameParser(unittest.TestCase):
+    def test_newline(self):
+        p = _FrameParser(FRAMING_NEWLINE)
+        self.assertEqual([], p.feed(b'[1, 2'))
+        self.assertEqual([b'[1, 2]', b'3'], p.feed(b']\n3\n\n4'))
+        self.assertEqual([b'45'], p.feed(b'5\n'))
 
-t = TcpStreamObserver(loop, "localhost", 2991) 
+    def test_length(self):
+        p = _FrameParser(FRAMING_LENGTH)
+        data = b'\x00\x00\x00\x03abc\x00\x00\x00\x00\x00\x00\x00\x02de'
+        payloads = []
+        for i in range(len(data)):
+            payloads.extend(p.feed(data[i:i+1]))
+        self.assertEqual([b'abc', b'', b'de'], payloads)
 
-s.subscribe(t)
+    def test_bad_framing(self):
+        self.assertRaises(ValueError, _FrameParser, 'bogus')
 
-scheduler = Scheduler(loop)
-scheduler.schedule_periodic(s, 2) # sample once every 2 seconds
 
+class TestTcpStream(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
 
-scheduler.run_forever()
-scheduler.stop()
+    def tearDown(self):
+        self.loop.close()
+
+    def _wait_for_clients(self, sink, n):
+        async def wait():
+            while len(sink.clients)<n:
+                await asyncio.sleep(0.01)
+        return wait()
+
+    def _round_trip(self, codec, framing, batches):
+        src = OutputThing()
+        sink = TcpStreamInputThing(self.scheduler, 'localhost', port=0,
+                                   codec=codec, framing=framing)
+        src.connect(sink)
+        capture = CaptureInputThing()
+        async def driver():
+            port = await sink.started
+            reader = TcpStreamReader('localhost', self.scheduler, port=port,
+                                     codec=codec, framing=framing,
+                                     batches=batches)
+            reader.connect(capture)
+            self.scheduler.schedule_on_main_event_loop(reader)
+            await self._wait_for_clients(sink, 1)
+            for e in EVENTS:
+                src._dispatch_next(e)
+                await asyncio.sleep(0)
+            src._dispatch_completed()
+        self.scheduler._schedule_coroutine(driver(), lambda f: None)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.completed)
+        return capture.events
+
+    def test_json_newline(self):
+        events = self._round_trip('json', FRAMING_NEWLINE, False)
+        self.assertEqual([list(e) for e in EVENTS], events)
+
+    def test_struct_length_batches(self):
+        batches = self._round_trip('struct', FRAMING_LENGTH, True)
+        self.assertEqual(EVENTS, [e for batch in batches for e in batch])
+
+    def _slow_client(self, sink, src, events, wait_for_evict):
+        """Push events, one per pass of the event loop, to a client that
+        does not read until all have been sent. Returns the events the
+        client then reads.
+        """
+        received = []
+        async def driver():
+            port = await sink.started
+            (reader, writer) = await asyncio.open_connection('localhost', port)
+            await self._wait_for_clients(sink, 1)
+            for e in events:
+                src._dispatch_next(e)
+                await asyncio.sleep(0)
+            if wait_for_evict:
+                while len(sink.clients)>0:
+                    await asyncio.sleep(0.01)
+            src._dispatch_completed()
+            try:
+                data = await reader.read()
+            except ConnectionResetError:
+                data = b''
+            # an evicted client may have been cut off in the middle of a frame
+            received.extend([json.loads(line)
+                             for line in data.split(b'\n')[:-1]])
+            writer.close()
+        self.scheduler._schedule_coroutine(driver(), lambda f: None)
+        self.scheduler.run_forever()
+        return received
+
+    def test_slow_client_disconnected(self):
+        src = OutputThing()
+        sink = TcpStreamInputThing(self.scheduler, 'localhost', port=0,
+                                   max_client_buffer=10,
+                                   write_buffer_limit=1024)
+        src.connect(sink)
+        events = [SensorEvent(1, float(i), 'x'*10000) for i in range(2000)]
+        received = self._slow_client(sink, src, events, True)
+        self.assertEqual(1, sink.evicted)
+        self.assertLess(len(received), len(events))
+
+    def test_slow_client_conflated(self):
+        src = OutputThing()
+        sink = TcpStreamInputThing(self.scheduler, 'localhost', port=0,
+                                   max_client_buffer=10,
+                                   write_buffer_limit=1024,
+                                   on_slow_client=SLOW_CLIENT_CONFLATE)
+        src.connect(sink)
+        events = [SensorEvent(i%5, float(i), 'x'*10000) for i in range(2000)]
+        received = self._slow_client(sink, src, events, False)
+        self.assertEqual(0, sink.evicted)
+        self.assertGreater(sink.conflated, 0)
+        self.assertLess(len(received), len(events))
+        # the client ends up with the latest event of each sensor
+        latest = dict((e[0], e) for e in received)
+        self.assertEqual(sorted([list(e) for e in events[-5:]]),
+                         sorted(latest.values()))
+
+    def test_connect_error(self):
+        reader = TcpStreamReader('localhost', self.scheduler, port=1)
+        self.scheduler.schedule_on_main_event_loop(reader)
+        self.assertRaises(Exception, self.scheduler.run_forever)
+
+
+if __name__ == '__main__':
+    unittest.main()
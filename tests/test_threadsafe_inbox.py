@@ -0,0 +1,97 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the coalesced handoff of events from other threads to the main event
+loop (see _ThreadsafeInbox in thingflow.base).
+"""
+import asyncio
+import unittest
+
+from thingflow.base import Scheduler, OutputThing, DirectOutputThingMixin,\
+    EventLoopOutputThingMixin
+from utils import CaptureInputThing
+
+BURST = 2000
+
+
+class BurstyPrivateLoopThing(OutputThing, EventLoopOutputThingMixin):
+    """Dispatch a burst of events from a private event loop thread and
+    then complete.
+    """
+    def _observe_event_loop(self):
+        for i in range(BURST):
+            self._dispatch_next(i)
+        self._dispatch_completed()
+
+    def _stop_loop(self):
+        pass
+
+
+class BurstyBlockingThing(OutputThing, DirectOutputThingMixin):
+    """Dispatch a burst of events from a worker thread on each sample, and
+    complete after the specified number of samples.
+    """
+    def __init__(self, samples):
+        super().__init__()
+        self.samples = samples
+        self.next_value = 0
+
+    def _observe(self):
+        if self.samples==0:
+            self._dispatch_completed()
+            return
+        self.samples -= 1
+        for i in range(BURST):
+            self._dispatch_next(self.next_value)
+            self.next_value += 1
+
+
+class TestThreadsafeInbox(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_private_event_loop(self):
+        o = BurstyPrivateLoopThing()
+        capture = CaptureInputThing()
+        o.connect(capture)
+        self.scheduler.schedule_on_private_event_loop(o)
+        self.scheduler.run_forever()
+        self.assertEqual(list(range(BURST)), capture.events)
+        self.assertTrue(capture.completed)
+        (stats,) = self.scheduler.metrics()['inboxes']
+        self.assertEqual(BURST+1, stats['enqueued'])
+        self.assertEqual(0, stats['depth'])
+        self.assertGreaterEqual(stats['max_depth'], 1)
+        # The burst should have been delivered by far fewer drain callbacks
+        # than events.
+        self.assertLess(stats['drains'], BURST/2)
+
+    def test_blocking_output_thing(self):
+        o = BurstyBlockingThing(3)
+        capture = CaptureInputThing()
+        o.connect(capture)
+        self.scheduler.schedule_periodic_on_separate_thread(o, 0.01)
+        self.scheduler.run_forever()
+        self.assertEqual(list(range(3*BURST)), capture.events)
+        self.assertTrue(capture.completed)
+        stats = self.scheduler.metrics()['inboxes'][0]
+        self.assertEqual(3*BURST+1, stats['enqueued'])
+        self.assertEqual(0, stats['depth'])
+
+    def test_multiple_connections(self):
+        o = BurstyPrivateLoopThing()
+        captures = [CaptureInputThing(), CaptureInputThing()]
+        for c in captures:
+            o.connect(c)
+        self.scheduler.schedule_on_private_event_loop(o)
+        self.scheduler.run_forever()
+        for c in captures:
+            self.assertEqual(list(range(BURST)), c.events)
+            self.assertTrue(c.completed)
+
+
+if __name__ == '__main__':
+    unittest.main()
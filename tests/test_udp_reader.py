@@ -0,0 +1,162 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""Test the UDP reader over the loopback interface.
+"""
+import asyncio
+import socket
+import unittest
+
+from thingflow.base import Scheduler, SensorEvent, InputThing
+from thingflow.codecs import get_codec, StructCodec
+from thingflow.adapters.udp import UdpReader, SenderStats
+from utils import CaptureInputThing
+
+
+class StopAfter(InputThing):
+    """Stop the reader after n events, counting the elements of each list
+    if batches is True.
+    """
+    def __init__(self, n, batches):
+        self.events_left = n
+        self.batches = batches
+        self.cancel_thunk = None
+
+    def on_next(self, x):
+        self.events_left -= len(x) if self.batches else 1
+        if self.events_left==0:
+            self.cancel_thunk()
+
+
+class TestSenderStats(unittest.TestCase):
+    def test_sequences(self):
+        s = SenderStats()
+        results = [s.check_sequence(seq, 8) for seq in [1, 2, 2, 5, 4, 3, 4]]
+        self.assertEqual([True, True, False, True, True, True, False], results)
+        self.assertEqual((2, 1, 0, 2), (s.duplicates, s.gaps, s.missing, s.late))
+        # far behind the window, so the sender must have restarted
+        self.assertTrue(s.check_sequence(5000, 8))
+        self.assertTrue(s.check_sequence(1, 8))
+        self.assertEqual(1, s.restarts)
+        self.assertTrue(s.check_sequence(2, 8))
+
+
+class TestUdpReader(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = Scheduler(self.loop)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sock.close()
+        self.loop.close()
+
+    def _run(self, reader, payloads, expected):
+        """Send the payloads to the reader in one burst and run until
+        expected events have been dispatched.
+        """
+        capture = CaptureInputThing()
+        reader.connect(capture)
+        stop = StopAfter(expected, reader.batches)
+        reader.connect(stop)
+        stop.cancel_thunk = self.scheduler.schedule_on_main_event_loop(reader)
+        async def send():
+            port = await reader.started
+            for payload in payloads:
+                self.sock.sendto(payload, ('127.0.0.1', port))
+        self.scheduler._schedule_coroutine(send(), lambda f: None)
+        self.scheduler.run_forever()
+        self.assertTrue(capture.completed)
+        return capture.events
+
+    def test_json(self):
+        codec = get_codec('json')
+        events = [SensorEvent(1, float(i), i*2.0) for i in range(20)]
+        reader = UdpReader(self.scheduler, '127.0.0.1', port=0)
+        received = self._run(reader, [codec.encode(e) for e in events], 20)
+        self.assertEqual([list(e) for e in events], received)
+        (stats,) = reader.stats().values()
+        self.assertEqual(20, stats['received'])
+        self.assertEqual(20, stats['events'])
+
+    def test_batches_and_errors(self):
+        codec = get_codec('struct')
+        events = [SensorEvent(i, float(i), 0.5) for i in range(100)]
+        payloads = [codec.encode(e) for e in events]
+        payloads.insert(10, b'bogus')
+        reader = UdpReader(self.scheduler, '127.0.0.1', port=0,
+                           codec='struct', batches=True, rcvbuf=1<<20)
+        batches = self._run(reader, payloads, 100)
+        self.assertEqual(events, [e for batch in batches for e in batch])
+        # several datagrams are read per wakeup
+        self.assertLess(len(batches), 100)
+        (stats,) = reader.stats().values()
+        self.assertEqual((101, 100, 1),
+                         (stats['received'], stats['events'], stats['errors']))
+
+    def test_batched_datagrams(self):
+        codec = get_codec('struct')
+        events = [SensorEvent(1, float(i), 0.5) for i in range(30)]
+        reader = UdpReader(self.scheduler, '127.0.0.1', port=0,
+                           codec='struct', batched_datagrams=True)
+        received = self._run(reader, [codec.encode_batch(events[:10]),
+                                      codec.encode_batch(events[10:])], 30)
+        self.assertEqual(events, received)
+
+    def test_dedup_by_sensor(self):
+        codec = StructCodec('<IIdd', constructor=None)
+        seqs = {1:[1, 2, 2, 3, 6, 7], 2:[1, 1, 2, 3, 4, 4]}
+        payloads = []
+        for i in range(6):
+            for sensor in (1, 2):
+                payloads.append(codec.encode((sensor, seqs[sensor][i], 0.0,
+                                              1.0)))
+        reader = UdpReader(self.scheduler, '127.0.0.1', port=0,
+                           codec=codec, sequence=lambda e: e[1],
+                           sender=lambda e, addr: e[0])
+        received = self._run(reader, payloads, 9)
+        self.assertEqual([[1, 2, 3, 6, 7], [1, 2, 3, 4]],
+                         [[e[1] for e in received if e[0]==sensor]
+                          for sensor in (1, 2)])
+        stats = reader.stats()
+        self.assertEqual((1, 1, 2), (stats[1]['duplicates'], stats[1]['gaps'],
+                                     stats[1]['missing']))
+        self.assertEqual((2, 0), (stats[2]['duplicates'], stats[2]['gaps']))
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'),
+                         "SO_REUSEPORT not supported")
+    def test_multiple_sockets(self):
+        codec = get_codec('json')
+        reader = UdpReader(self.scheduler, '127.0.0.1', port=0, num_sockets=2)
+        # use several source ports, so that the kernel can spread them
+        socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                 for i in range(4)]
+        try:
+            capture = CaptureInputThing()
+            reader.connect(capture)
+            stop = StopAfter(40, False)
+            reader.connect(stop)
+            stop.cancel_thunk = \
+                self.scheduler.schedule_on_main_event_loop(reader)
+            async def send():
+                port = await reader.started
+                for i in range(40):
+                    socks[i%4].sendto(codec.encode(i), ('127.0.0.1', port))
+            self.scheduler._schedule_coroutine(send(), lambda f: None)
+            self.scheduler.run_forever()
+        finally:
+            for s in socks:
+                s.close()
+        self.assertEqual(list(range(40)), sorted(capture.events))
+        self.assertEqual(4, len(reader.stats()))
+
+    def test_stop_before_start(self):
+        reader = UdpReader(self.scheduler, '127.0.0.1', port=0)
+        capture = CaptureInputThing()
+        reader.connect(capture)
+        self.scheduler.schedule_on_main_event_loop(reader)()
+        self.scheduler.run_forever()
+        self.assertTrue(capture.completed)
+
+
+if __name__ == '__main__':
+    unittest.main()
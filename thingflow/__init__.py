@@ -5,6 +5,9 @@ This is the main package for antevents. Directly within this package you fill
 find the following module:
 
  * `base` - the core abstractions and classes of the system.
+ * `metrics` - event counts and processing times for the things in a graph
+ * `latency` - end-to-end latencies from event ingress to the sinks
+ * `lagmonitor` - event loop lag, with slow callbacks attributed to things
 
 The rest of the functionality is in sub-packages:
 
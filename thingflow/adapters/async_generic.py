@@ -0,0 +1,407 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Generic reader and writer classes for asyncio-native libraries. Unlike
+the adapters that use schedule_on_private_event_loop(), these run directly
+on the scheduler's event loop and do not need a separate thread.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from thingflow.base import OutputThing, InputThing, EventLoopOutputThingMixin,\
+                           FatalError, ingress_clock, _monotonic_ns
+
+logger = logging.getLogger(__name__)
+
+# By default, we explicitly yield to the event loop after dispatching
+# this many events without the async iterable having suspended.
+DEFAULT_YIELD_BUDGET = 100
+
+
+class AsyncIterableAsOutputThing(OutputThing, EventLoopOutputThingMixin):
+    """Convert an async iterable (e.g. an async generator or the message
+    stream of an asyncio client library) to an OutputThing. We run an
+    ``async for`` style loop as a coroutine on the scheduler's event loop
+    and dispatch each item directly. Schedule it via
+    Scheduler.schedule_on_main_event_loop().
+
+    If batches is True, each item produced by the async iterable is
+    itself an iterable of events, which are dispatched individually. This
+    is useful for libraries that can pull many messages with a single call.
+
+    If an async iterable produces items without ever suspending, we could
+    starve the rest of the event loop. To avoid this, we yield to the event
+    loop after every yield_budget events. We stop pulling items while a
+    sink applies backpressure (see OVERFLOW_BLOCK).
+
+    When the schedule is stopped (e.g. by Scheduler.stop()), the coroutine
+    is cancelled, the async iterable is closed (if it has an aclose() method),
+    and on_completed is dispatched downstream.
+    """
+    def __init__(self, aiterable, scheduler, batches=False,
+                 yield_budget=DEFAULT_YIELD_BUDGET, name=None):
+        super().__init__()
+        self.aiterable = aiterable
+        self.scheduler = scheduler
+        self.batches = batches
+        self.yield_budget = yield_budget
+        self.name = name
+        self.task = None
+        self.stop_requested = False
+        self.fatal_error = None
+
+    def _observe_event_loop(self):
+        if self.stop_requested:
+            self._remove_schedule()
+            return
+        self.task = self.scheduler._schedule_coroutine(self._run(),
+                                                       self._run_done)
+
+    def _stop_loop(self):
+        self.stop_requested = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def _dispatch_items(self, item):
+        """Dispatch an item from the async iterable and return the number
+        of events sent downstream.
+        """
+        if self.batches:
+            cnt = 0
+            for event in item:
+                self._dispatch_next(event)
+                cnt += 1
+            return cnt
+        else:
+            self._dispatch_next(item)
+            return 1
+
+    async def _run(self):
+        iterator = self.aiterable.__aiter__()
+        budget = self.yield_budget
+        try:
+            while True:
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    self._dispatch_completed()
+                    break
+                if ingress_clock.enabled:
+                    ingress_clock.stamp()
+                budget -= self._dispatch_items(item)
+                if not self._has_connections():
+                    break
+                if len(self.scheduler.congested)>0:
+                    # backpressure from a sink with a full queue
+                    await self.scheduler._wait_for_capacity()
+                if budget<=0:
+                    budget = self.yield_budget
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            await self._close(iterator)
+            self._dispatch_completed()
+            return
+        except FatalError as e:
+            # raised in _run_done(), so that the scheduler sees it
+            self.fatal_error = e
+        except Exception as e:
+            # Errors from the async iterable are treated as non-fatal, as
+            # with IterableAsOutputThing.
+            logger.exception("Error in async iterable for %s" % self)
+            self._dispatch_error(e)
+        await self._close(iterator)
+
+    async def _close(self, iterator):
+        """Close the iterator, if it supports closing.
+        """
+        if hasattr(iterator, 'aclose'):
+            try:
+                await iterator.aclose()
+            except Exception as e:
+                logger.warning("Error closing async iterable for %s: %s" %
+                               (self, e))
+
+    def _run_done(self, future):
+        self.task = None
+        if future.cancelled() and ('default' in self.__ports__):
+            # cancelled before the coroutine had a chance to start
+            self._dispatch_completed()
+        if self.fatal_error is not None:
+            if self in self.scheduler.active_schedules:
+                del self.scheduler.active_schedules[self]
+            raise self.fatal_error
+        self._remove_schedule()
+
+    def _remove_schedule(self):
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+
+    def __str__(self):
+        if self.name:
+            return self.name
+        else:
+            return 'AsyncIterableAsOutputThing(%s)' % repr(self.aiterable)
+
+
+def from_async_iterable(aiterable, scheduler, batches=False,
+                        yield_budget=DEFAULT_YIELD_BUDGET):
+    """Create an OutputThing from an async iterable. See
+    AsyncIterableAsOutputThing for the meaning of the parameters.
+    """
+    return AsyncIterableAsOutputThing(aiterable, scheduler, batches=batches,
+                                      yield_budget=yield_budget)
+
+
+# Policies for when the queue of an AsyncInputThing is full
+OVERFLOW_ERROR = 'error'             # raise a FatalError
+OVERFLOW_DROP_OLDEST = 'drop_oldest' # drop the oldest queued event
+OVERFLOW_DROP_NEWEST = 'drop_newest' # drop the incoming event
+OVERFLOW_BLOCK = 'block'             # queue the event and pause the sources
+
+OVERFLOW_POLICIES = (OVERFLOW_ERROR, OVERFLOW_DROP_OLDEST,
+                     OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK)
+
+DEFAULT_MAX_QUEUE_SIZE = 10000
+
+
+class _BoundedQueue:
+    """The input queue of a sink that writes events asynchronously
+    (AsyncInputThing and mqtt_async.QueueWriter). When put() is called with
+    max_size items queued, the on_overflow policy is applied:
+
+    * OVERFLOW_ERROR raises a FatalError.
+    * OVERFLOW_DROP_OLDEST and OVERFLOW_DROP_NEWEST drop an item and count it
+      in the dropped attribute.
+    * OVERFLOW_BLOCK applies backpressure: the item is still queued, but the
+      owner is marked as congested on the scheduler, which holds back the
+      sources it runs (see Scheduler._set_congested()) until the queue has
+      drained to half of max_size. Events from sources that cannot be held
+      back are still queued, so the queue may exceed max_size.
+    """
+    __slots__ = ('owner', 'scheduler', 'max_size', 'on_overflow', 'items',
+                 'dropped', 'congested')
+    def __init__(self, owner, scheduler, max_size, on_overflow):
+        assert on_overflow in OVERFLOW_POLICIES
+        self.owner = owner
+        self.scheduler = scheduler
+        self.max_size = max_size
+        self.on_overflow = on_overflow
+        self.items = deque()
+        self.dropped = 0
+        self.congested = False
+
+    def put(self, item):
+        items = self.items
+        if len(items)>=self.max_size:
+            if self.on_overflow==OVERFLOW_BLOCK:
+                if not self.congested:
+                    self.congested = True
+                    self.scheduler._set_congested(self.owner, True)
+            elif self.on_overflow==OVERFLOW_DROP_OLDEST:
+                items.popleft()
+                self.dropped += 1
+            elif self.on_overflow==OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                return
+            else:
+                raise FatalError("%s: queue full (%d events)" %
+                                 (self.owner, len(items)))
+        items.append(item)
+
+    def take(self, n):
+        """Remove and return a list of the first n items.
+        """
+        items = self.items
+        batch = [items.popleft() for i in range(n)]
+        if self.congested and len(items)<=self.max_size//2:
+            self._release()
+        return batch
+
+    def clear(self):
+        self.items.clear()
+        if self.congested:
+            self._release()
+
+    def _release(self):
+        self.congested = False
+        self.scheduler._set_congested(self.owner, False)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return repr(self.items)
+
+
+class AsyncInputThing(InputThing):
+    """Base class for InputThings that write events to the outside world
+    using asyncio (e.g. network sinks). This is an alternative to
+    BlockingInputThing that does not need any threads.
+
+    on_next() just adds the event to a bounded queue. The queued events are
+    taken in batches of up to batch_size and passed to the _write_batch()
+    coroutine, which subclasses must implement. Up to max_in_flight batches
+    may be written concurrently. Events that arrive in the same pass of the
+    event loop or while the maximum number of writes is in progress are
+    coalesced into batches.
+
+    If flush_interval is specified, a batch is only written once it has
+    batch_size events or flush_interval seconds after the first event was
+    queued, whichever comes first. This gives larger batches for sinks
+    where each write is expensive.
+
+    If the queue reaches max_queue_size, the on_overflow policy is applied:
+    OVERFLOW_ERROR raises a FatalError, OVERFLOW_DROP_OLDEST and
+    OVERFLOW_DROP_NEWEST drop an event and count it in the dropped attribute,
+    and OVERFLOW_BLOCK holds back the sources until the queue has drained
+    (see _BoundedQueue).
+
+    The writes are scheduled via Scheduler._schedule_coroutine() and the
+    thing registers itself as an active schedule. Thus, when the stream
+    completes or the scheduler is stopped, the queued events are flushed
+    and the scheduler waits for the in-flight writes before exiting. A failed
+    write is treated as a fatal error.
+    """
+    # We record our own latencies, from the time an event was queued
+    # (see thingflow.latency).
+    _records_latency = True
+
+    def __init__(self, scheduler, batch_size=1, max_in_flight=1,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 on_overflow=OVERFLOW_ERROR, flush_interval=None):
+        assert batch_size>0 and max_in_flight>0
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.flush_interval = flush_interval
+        self.flush_timer = None
+        self.flush_due = False # flush_interval has passed, write partial batches
+        # Each item is an (event, stamp) pair, where the stamp is either None
+        # or the event's ingress time and the time it was queued, if latency
+        # tracking is enabled.
+        self.queue = _BoundedQueue(self, scheduler, max_queue_size,
+                                   on_overflow)
+        self.in_flight = 0
+        self.batches_written = 0
+        self.pump_scheduled = False
+        self.closing = False # no more events accepted, flush the queue
+        self.closed = False
+        self.scheduler.active_schedules[self] = self.request_stop
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def on_next(self, x):
+        if self.closing:
+            return
+        self.queue.put((x, (ingress_clock.get(), _monotonic_ns())
+                           if ingress_clock.enabled else None))
+        if self.flush_interval is not None and \
+           len(self.queue)<self.batch_size and not self.flush_due:
+            self._start_flush_timer()
+        elif not self.pump_scheduled:
+            # Defer starting writes, so that events arriving in this pass of
+            # the event loop can go into the same batch.
+            self.pump_scheduled = True
+            self.scheduler.event_loop.call_soon(self._pump)
+
+    def _start_flush_timer(self):
+        if self.flush_timer is None:
+            self.flush_timer = self.scheduler.event_loop.call_later(
+                self.flush_interval, self._flush_timeout)
+
+    def _flush_timeout(self):
+        self.flush_timer = None
+        self.flush_due = True
+        self._pump()
+
+    def on_error(self, e):
+        logger.error("%s: received on_error(%s), flushing queued events" %
+                     (self, e))
+        self.request_stop()
+
+    def on_completed(self):
+        self.request_stop()
+
+    def request_stop(self):
+        """Stop accepting events. Any queued events are still written and then
+        the _close() coroutine is called.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        self._pump()
+
+    def _pump(self):
+        self.pump_scheduled = False
+        partial_ok = self.flush_interval is None or self.flush_due or \
+                     self.closing
+        while self.in_flight<self.max_in_flight and len(self.queue)>0:
+            if len(self.queue)<self.batch_size and not partial_ok:
+                break # wait for more events or the flush timer
+            items = self.queue.take(min(self.batch_size, len(self.queue)))
+            batch = [x for (x, stamp) in items]
+            stamps = [stamp for (x, stamp) in items]
+            self.in_flight += 1
+            start_ns = _monotonic_ns() if ingress_clock.enabled else None
+            self.scheduler._schedule_coroutine(
+                self._write_batch(batch),
+                lambda f, stamps=stamps, start_ns=start_ns:
+                    self._write_done(f, stamps, start_ns))
+        if self.flush_interval is not None:
+            if len(self.queue)==0:
+                self.flush_due = False
+            elif not (self.flush_due or self.closing):
+                self._start_flush_timer()
+            if self.closing and self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+        if self.closing and (not self.closed) and self.in_flight==0 and \
+           len(self.queue)==0:
+            self.closed = True
+            self.scheduler._schedule_coroutine(self._close(), self._close_done)
+
+    def _write_done(self, future, stamps, start_ns):
+        self.in_flight -= 1
+        exc = None if future.cancelled() else future.exception()
+        if exc is not None:
+            # The scheduler will stop, so stop accepting events and close
+            # once the other writes are done. Otherwise, stop() would wait
+            # forever for anything that only finishes on _close().
+            self.closing = True
+            self._pump()
+            raise FatalError("%s: write failed with exception: %s" %
+                             (self, exc)) from exc
+        self.batches_written += 1
+        recorder = ingress_clock.recorder
+        if recorder is not None and start_ns is not None:
+            end_ns = _monotonic_ns()
+            for stamp in stamps:
+                if stamp is not None:
+                    recorder(self, stamp[0], stamp[1], start_ns, end_ns)
+        self._pump()
+
+    def _close_done(self, future):
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+        exc = None if future.cancelled() else future.exception()
+        if exc is not None:
+            raise FatalError("%s: close failed with exception: %s" %
+                             (self, exc)) from exc
+
+    async def _write_batch(self, events):
+        """Write a list of events to the outside world. To be implemented by
+        subclasses.
+        """
+        raise NotImplementedError
+
+    async def _close(self):
+        """Called after the last write has completed. Can be overridden by
+        subclasses to close connections, etc.
+        """
+        pass
+
+    def __str__(self):
+        return self.__class__.__name__ + '()'
@@ -7,6 +7,15 @@ BokehPlot objects provide the basic formatting of the plots.
 3. Call BokehPlotManager's start() routine to start the visualization
 4. Make BokehPlotManager subscribe to the event streams.
 
+Events arrive on the scheduler's thread and are just appended to a bounded
+buffer of pending points for their plot. The Bokeh thread sends the pending
+points to the browser at a fixed rate (the plot's update period). If there
+are more pending points than the plot's max_points_per_update, they are
+downsampled first (see thingflow.filters.downsample), so that the browser
+gets a bounded amount of data per update that keeps the shape of the
+series. The data sources are streamed with a rollover, so the plots hold at
+most that many points.
+
 TODO: Step 2 and step 4 should be combined into one
 
 TODO: Currently, we do not support BokehPlot's with multiple plots
@@ -27,7 +36,8 @@ import logging
 import functools
 from math import pi
 
-import threading, queue
+import threading
+from collections import deque
 
 from bokeh.plotting import figure, curdoc
 from bokeh.layouts import column # to show two or more plots arranged in a column
@@ -36,6 +46,7 @@ from bokeh.models import ColumnDataSource
 from bokeh.client import push_session
 
 from thingflow.base import Filter
+from thingflow.filters.downsample import downsample_indices, LTTB
 
 logger = logging.getLogger(__name__)
 
@@ -66,28 +77,76 @@ def bokeh_default_mapper(csv):
     return csv
 
 
+# Defaults for BokehPlot
+DEFAULT_ROLLOVER = 2000 # points kept in a plot's data source
+DEFAULT_MAX_POINTS_PER_UPDATE = 200
+DEFAULT_MAX_PENDING = 100000 # points buffered between updates
+
+
+class PendingPoints:
+    """The points received for a plot that have not been sent to Bokeh yet.
+    Points are appended by the scheduler's thread and drained by the Bokeh
+    thread. At most max_pending points are kept: if more arrive between two
+    updates, the oldest are dropped and counted in the dropped attribute.
+    """
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.xs = deque(maxlen=max_pending)
+        self.ys = deque(maxlen=max_pending)
+        self.dropped = 0
+
+    def append(self, x, y):
+        with self.lock:
+            if len(self.xs)==self.max_pending:
+                self.dropped += 1
+            self.xs.append(x)
+            self.ys.append(y)
+
+    def drain(self):
+        """Remove all the pending points and return them as a pair of lists
+        (xs, ys).
+        """
+        with self.lock:
+            (xs, ys) = (self.xs, self.ys)
+            self.xs = deque(maxlen=self.max_pending)
+            self.ys = deque(maxlen=self.max_pending)
+        return (list(xs), list(ys))
+
+    def __len__(self):
+        return len(self.xs)
+
+
+def make_update(pending, max_points, algorithm=LTTB):
+    """Drain the pending points and return lists (xs, ys) of at most
+    max_points of them, downsampled with the algorithm if necessary.
+    """
+    (xs, ys) = pending.drain()
+    if len(xs)>max_points and algorithm is not None:
+        indices = downsample_indices(xs, ys, max_points, algorithm)
+        xs = [xs[i] for i in indices]
+        ys = [ys[i] for i in indices]
+    return (xs, ys)
+
+
 
 class BokehPlotWorker(threading.Thread):
     def __init__(self, plotters):
         threading.Thread.__init__(self)
         self.plotters = plotters
 
-    def update(self, name): 
-        print("In update")
-        whichqueue = self.plotters[name]['queue']
-        whichsource = self.plotters[name]['plot_specs'].source
-        try:
-            data = whichqueue.get_nowait()
-            if data:
-                # ts = datetime.datetime.fromtimestamp(data.ts)
-                ts = (data.ts)
-                val = data.val
-                print('data = ', data)
-                new_data = dict(timestamp=[ts], value=[val]) 
-                print('newdata = ', new_data)
-                whichsource.stream(new_data) 
-        except queue.Empty:
-            pass
+    def update(self, name):
+        """Called periodically on the Bokeh thread to send the pending points
+        of a plot.
+        """
+        plot_specs = self.plotters[name]['plot_specs']
+        (xs, ys) = make_update(self.plotters[name]['pending'],
+                               plot_specs.max_points_per_update,
+                               plot_specs.downsample)
+        if len(xs)>0:
+            plot_specs.source.stream({plot_specs.x_axis_label: xs,
+                                      plot_specs.y_axis_label: ys},
+                                     rollover=plot_specs.rollover)
 
     def make_fig(self, plot_source):
         plot_specs = plot_source['plot_specs']
@@ -116,11 +175,25 @@ class BokehPlotWorker(threading.Thread):
 
 
 class BokehPlot(object):
-    def __init__(self, name, y_axis_label="", x_axis_label="timestamp", update_period_in_ms=500):
+    """Specification of a plot. The plot is updated every
+    update_period_in_ms milliseconds with at most max_points_per_update
+    points, downsampled by the downsample algorithm (LTTB or MIN_MAX from
+    thingflow.filters.downsample, or None to send all the points). The
+    plot keeps the latest rollover points. At most max_pending points are
+    buffered between updates.
+    """
+    def __init__(self, name, y_axis_label="", x_axis_label="timestamp", update_period_in_ms=500,
+                 rollover=DEFAULT_ROLLOVER,
+                 max_points_per_update=DEFAULT_MAX_POINTS_PER_UPDATE,
+                 downsample=LTTB, max_pending=DEFAULT_MAX_PENDING):
         self.name = name
         self.x_axis_label = x_axis_label
         self.y_axis_label = y_axis_label
         self.update_period = update_period_in_ms
+        self.rollover = rollover
+        self.max_points_per_update = max_points_per_update
+        self.downsample = downsample
+        self.max_pending = max_pending
         self.source = ColumnDataSource(dict({ self.x_axis_label: [], self.y_axis_label: []} ))
 
 class BokehPlotManager(Filter):
@@ -132,7 +205,8 @@ class BokehPlotManager(Filter):
 
     def register(self, plot):
         if self.open_for_registration: 
-            self.plotters[plot.name] = { 'queue' : queue.Queue(), 'plot_specs' : plot }
+            self.plotters[plot.name] = { 'pending' : PendingPoints(plot.max_pending),
+                                         'plot_specs' : plot }
         else:
             raise Exception("Bokeh Adapter: Plot manager does not dynamically add registrations.")
 
@@ -147,7 +221,7 @@ class BokehPlotManager(Filter):
         whichplot, data = t
         assert self.started, "BokehPlotManager: Data sent without initialization"
         if whichplot in self.plotters:
-            self.plotters[whichplot]['queue'].put(data)
+            self.plotters[whichplot]['pending'].append(data.ts, data.val)
         else:
             raise Exception("Plot %s not found among registered plots", whichplot)
 
@@ -163,26 +237,22 @@ class BokehPlotManager(Filter):
 
 class BokehOutputWorker(threading.Thread):
     source = ColumnDataSource(dict(timestamp=[], value=[]))
-    def __init__(self, sensor_id, datasource):
+    def __init__(self, sensor_id, datasource, rollover=300,
+                 max_points_per_update=DEFAULT_MAX_POINTS_PER_UPDATE):
         threading.Thread.__init__(self)
-        self.q = datasource
+        self.pending = datasource
         self.title = sensor_id
+        self.rollover = rollover
+        self.max_points_per_update = max_points_per_update
 
         self.counter = 0
 
     def update(self):
-        print("In update")
-        try:
-            data = self.q.get_nowait()
-            if data:
-                print('data = ', data)
-                ts = data.ts
-                val = data.val
-                new_data = dict(timestamp=[ts], value=[val]) 
-                self.source.stream(new_data, 300)
-                self.counter = 0
-        except queue.Empty:
-            pass
+        (xs, ys) = make_update(self.pending, self.max_points_per_update)
+        if len(xs)>0:
+            self.source.stream(dict(timestamp=xs, value=ys), self.rollover)
+            self.counter = 0
+        else:
             self.counter = self.counter + 1
             if self.counter == 10:
                 exit(0)
@@ -212,21 +282,18 @@ class BokehOutputWorker(threading.Thread):
 class BokehStreamer(Filter):
     def __init__(self, initial_csv, io_loop=None):
         super().__init__()
-        self.q = queue.Queue() 
-        self.bokeh_worker = BokehOutputWorker("Sensor", self.q)
+        self.pending = PendingPoints()
+        self.bokeh_worker = BokehOutputWorker("Sensor", self.pending)
         self.bokeh_worker.start()
 
     def on_next(self, x):
-        print("next:", x)
-        self.q.put(x)
+        self.pending.append(x.ts, x.val)
 
     def on_completed(self):
-        self.q.join()
         self.bokeh_worker.stop()
         self._dispatch_completed()
 
     def on_error(self, e):
-        self.q.join()
         self._dispatch_error(e)
 
 
@@ -4,7 +4,8 @@
 Generic reader and writer classes, to be subclassed for specific adapters.
 """
 
-from thingflow.base import OutputThing, DirectOutputThingMixin, FatalError
+from thingflow.base import OutputThing, DirectOutputThingMixin, FatalError,\
+                           ingress_clock
 
 class EventRowMapping:
     """Interface that converts between events and "rows"
@@ -35,6 +36,8 @@ class DirectReader(OutputThing, DirectOutputThingMixin):
     def _observe(self):
         try:
             row = self.iterable.__next__()
+            if ingress_clock.enabled:
+                ingress_clock.stamp()
             self._dispatch_next(self.mapper.row_to_event(row))
         except StopIteration:
             self._close()
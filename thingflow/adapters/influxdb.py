@@ -1,7 +1,7 @@
 import datetime
 from influxdb import InfluxDBClient, SeriesHelper
 
-from thingflow.base import OutputThing, InputThing, FatalError
+from thingflow.base import OutputThing, InputThing, FatalError, ingress_clock
 
 # class BulkUploader(SeriesHelper):
 #     def __new__(self, client, msg_format, bulk_size=10):
@@ -143,6 +143,8 @@ class InfluxDBReader(OutputThing):
     def _observe(self):
         try:
             event = self.points.__next__()
+            if ingress_clock.enabled:
+                ingress_clock.stamp()
             self._dispatch_next(event)
         except StopIteration:
             self._dispatch_completed()
@@ -1,6 +1,7 @@
 # Copyright 2016 by MPI-SWS and Data-Ken Research.
 # Licensed under the Apache 2.0 License.
 import time
+import socket
 from collections import namedtuple
 
 try:
@@ -10,7 +11,20 @@ except ImportError:
 
 import ssl
 
-from thingflow.base import InputThing, OutputThing, EventLoopOutputThingMixin
+from thingflow.base import InputThing, OutputThing, EventLoopOutputThingMixin,\
+                           ingress_clock
+from thingflow.codecs import get_codec, EventView
+
+# Timeout (in seconds) for each pass of the paho client's loop in MQTTReader.
+# This bounds how long it takes the reader to notice a stop request.
+DEFAULT_LOOP_TIMEOUT = 0.1
+
+# Maximum number of packets handled in one pass of the client's loop.
+DEFAULT_MAX_PACKETS = 100
+
+# Interval (in seconds) at which MQTTSocketReader calls the client's
+# loop_misc(), which handles keepalive pings and retries.
+MISC_INTERVAL = 1.0
 
 
 MQTTEvent = namedtuple('MQTTEvent', ['timestamp', 'state', 'mid', 'topic', 'payload', 'qos', 'dup', 'retain' ])
@@ -46,28 +60,62 @@ class MockMQTTClient(object):
     def loop(self, timeout=1.0, max_packets=1):
         s = random.randint(1, max_packets)
         for i in range(0, s):
-            msg = MQTTEvent(datetime.datetime.now(), 0, i, 'bogus/bogus', 'xxx', 0, False, False)
+            msg = MQTTEvent(datetime.datetime.now(), 0, i, 'bogus/bogus', b'xxx', 0, False, False)
             if self.on_message:
                 self.on_message(self, self.userdata, msg)
         time.sleep(timeout)
         return 0
 
+    # The methods below support running the client from an external event
+    # loop (see MQTTSocketReader). The mock's socket is always readable and
+    # each call to loop_read() delivers max_packets messages.
+    _sockets = None
+
+    def socket(self):
+        if self._sockets is None:
+            self._sockets = socket.socketpair()
+            self._sockets[1].send(b'x')
+        return self._sockets[0]
+
+    def loop_read(self, max_packets=1):
+        for i in range(max_packets):
+            msg = MQTTEvent(datetime.datetime.now(), 0, i, 'bogus/bogus', b'xxx', 0, False, False)
+            if self.on_message:
+                self.on_message(self, self.userdata, msg)
+        return 0
+
+    def loop_write(self, max_packets=1):
+        return 0
+
+    def want_write(self):
+        return False
+
+    def loop_misc(self):
+        return 0
+
     def disconnect(self):
-        pass
+        if self._sockets is not None:
+            for s in self._sockets:
+                s.close()
+            self._sockets = None
 
 class MQTTWriter(InputThing):
     """Subscribes to internal events and pushes them out to MQTT.
     The topics parameter is a list of (topic, qos) pairs.
 
-    Events should be serialized before passing them to the writer.
+    Events should be serialized before passing them to the writer, or a
+    codec (a name or instance from thingflow.codecs) should be specified,
+    in which case the writer encodes each event.
     """
-    def __init__(self, host, port=1883, client_id="", client_username="", client_password=None, server_tls=False, server_cert=None, topics=[], mock_class=None):
+    def __init__(self, host, port=1883, client_id="", client_username="", client_password=None, server_tls=False, server_cert=None, topics=[], mock_class=None,
+                 codec=None):
         self.host = host
         self.port = port
         self.client_id = client_id
         self.client_username = client_id
         self.client_password = client_password
         self.topics = topics
+        self.codec = get_codec(codec) if codec is not None else None
 
         self.server_tls =  server_tls
         self.server_cert = server_cert
@@ -108,6 +156,8 @@ class MQTTWriter(InputThing):
         """
         # publish the message to the topics
         retain = msg.retain if hasattr(msg, 'retain') else False
+        if self.codec is not None:
+            msg = self.codec.encode(msg)
         for (topic, qos) in self.topics:
             self.client.publish(topic, msg, qos, retain) 
 
@@ -126,10 +176,29 @@ class MQTTReader(OutputThing, EventLoopOutputThingMixin):
        reader with a list of topics to subscribe to. The topics parameter
        is a list of (topic, qos) pairs.
 
+       The paho client's loop runs in a private event loop thread, so
+       schedule the reader via Scheduler.schedule_on_private_event_loop().
+       Each pass of the loop waits up to loop_timeout seconds for messages,
+       which bounds the time it takes to stop. The messages received in a
+       pass are handed to the scheduler together. If batches is True, they
+       are dispatched downstream as a single list of MQTTEvents, otherwise
+       they are dispatched one at a time.
+
+       If codec (a name or instance from thingflow.codecs) is specified, the
+       message payloads are decoded and the resulting events are dispatched
+       instead of MQTTEvents. If lazy is True, we dispatch an EventView of
+       each message instead, which references the payload and topic without
+       copying them and only decodes the fields that are accessed (see
+       thingflow.codecs). This lets a where() on the topic or on a single
+       field drop messages before they are decoded.
+
        Pre-requisites: An MQTT broker (on host:port) --- tested with mosquitto
                    The paho.mqtt python client for mqtt (pip install paho-mqtt)
     """
-    def __init__(self, host, port=1883, client_id="", client_username="", client_password=None, server_tls=False, server_cert=None, topics=[], mock_class=None):
+    def __init__(self, host, port=1883, client_id="", client_username="", client_password=None, server_tls=False, server_cert=None, topics=[], mock_class=None,
+                 loop_timeout=DEFAULT_LOOP_TIMEOUT,
+                 max_packets=DEFAULT_MAX_PACKETS, batches=False, codec=None,
+                 lazy=False):
         super().__init__()
         self.stop_requested = False
 
@@ -139,12 +208,18 @@ class MQTTReader(OutputThing, EventLoopOutputThingMixin):
         self.client_username = client_id
         self.client_password = client_password
         self.topics = topics
+        self.loop_timeout = loop_timeout
+        self.max_packets = max_packets
+        self.batches = batches
+        self.codec = get_codec(codec) if codec is not None else None
+        self.lazy = lazy
+        self.pending = [] # messages received in the current pass of the loop
 
         self.server_tls =  server_tls
         self.server_cert = server_cert
 
         if mock_class:
-            self.client = MockMQTTClient(self.client_id)
+            self.client = mock_class(self.client_id)
         else:
             self.client = paho.Client(self.client_id)
 
@@ -152,10 +227,17 @@ class MQTTReader(OutputThing, EventLoopOutputThingMixin):
             self.client.username_pw_set(self.client_username, password=self.client_password)
 
         self._connect()
- 
-        def on_message(client, userdata, msg):
-            m =  MQTTEvent(msg.timestamp, msg.state, msg.mid, msg.topic, msg.payload, msg.qos, msg.dup, msg.retain)
-            self._dispatch_next(m)
+
+        pending = self.pending
+        if lazy:
+            make_view = self.codec.make_view if self.codec is not None \
+                        else (lambda payload, topic:
+                                  EventView(payload, None, topic))
+            def on_message(client, userdata, msg):
+                pending.append(make_view(msg.payload, msg.topic))
+        else:
+            def on_message(client, userdata, msg):
+                pending.append(MQTTEvent(msg.timestamp, msg.state, msg.mid, msg.topic, msg.payload, msg.qos, msg.dup, msg.retain))
         self.client.on_message = on_message
    
     def _connect(self):
@@ -174,13 +256,32 @@ class MQTTReader(OutputThing, EventLoopOutputThingMixin):
             client.subscribe(self.topics)
         self.client.on_connect = on_connect
 
+    def _dispatch_pending(self):
+        """Dispatch the messages received since the last call.
+        """
+        if len(self.pending)==0:
+            return
+        if ingress_clock.enabled:
+            ingress_clock.stamp()
+        batch = self.pending[:]
+        del self.pending[:]
+        if self.codec is not None and not self.lazy:
+            batch = self.codec.decode_many([m.payload for m in batch])
+        if self.batches:
+            self._dispatch_next(batch)
+        else:
+            for m in batch:
+                if self.stop_requested:
+                    break # a downstream thing stopped us
+                self._dispatch_next(m)
         
     def _observe_event_loop(self):
         print("starting event loop")
         while True:
             if self.stop_requested:
                 break
-            result = self.client.loop(1)
+            result = self.client.loop(self.loop_timeout, self.max_packets)
+            self._dispatch_pending()
             if result != 0:
                 self._connect()
         self.stop_requested = False
@@ -193,3 +294,126 @@ class MQTTReader(OutputThing, EventLoopOutputThingMixin):
 
     def __str__(self):
         return 'MQTTReader(%s)' % ', '.join([topic for (topic,qos) in self.topics])
+
+
+class MQTTSocketReader(MQTTReader):
+    """A reader like MQTTReader, but which runs directly on the scheduler's
+    event loop rather than in a separate thread. We watch the paho client's
+    socket via the event loop's add_reader() and call the client's
+    loop_read(), loop_write() and loop_misc() methods as needed. Schedule it
+    via Scheduler.schedule_on_main_event_loop().
+
+    When the socket is readable, we read up to max_packets packets and then
+    dispatch the messages (as a list, if batches is True). A stop request
+    takes effect immediately: the socket is unregistered, the client is
+    disconnected, and on_completed is dispatched downstream.
+    """
+    def __init__(self, host, scheduler, port=1883, client_id="",
+                 client_username="", client_password=None, topics=[],
+                 mock_class=None, max_packets=DEFAULT_MAX_PACKETS,
+                 batches=False, codec=None, lazy=False):
+        self.scheduler = scheduler
+        self.sock = None
+        self.writing = False
+        self.misc_handle = None
+        super().__init__(host, port=port, client_id=client_id,
+                         client_username=client_username,
+                         client_password=client_password, topics=topics,
+                         mock_class=mock_class, max_packets=max_packets,
+                         batches=batches, codec=codec, lazy=lazy)
+
+    def _observe_event_loop(self):
+        if self.stop_requested:
+            self.client.disconnect()
+            self._dispatch_completed()
+            self._remove_schedule()
+            return
+        self._watch()
+
+    def _watch(self):
+        loop = self.scheduler.event_loop
+        self.sock = self.client.socket()
+        loop.add_reader(self.sock, self._on_readable)
+        self.misc_handle = loop.call_later(MISC_INTERVAL, self._on_misc)
+        self._update_writer()
+
+    def _unwatch(self):
+        loop = self.scheduler.event_loop
+        if self.sock is not None:
+            loop.remove_reader(self.sock)
+            if self.writing:
+                loop.remove_writer(self.sock)
+                self.writing = False
+            self.sock = None
+        if self.misc_handle is not None:
+            self.misc_handle.cancel()
+            self.misc_handle = None
+
+    def _update_writer(self):
+        want_write = self.client.want_write()
+        if want_write and not self.writing:
+            self.scheduler.event_loop.add_writer(self.sock, self._on_writable)
+            self.writing = True
+        elif self.writing and not want_write:
+            self.scheduler.event_loop.remove_writer(self.sock)
+            self.writing = False
+
+    def _on_readable(self):
+        # loop_read() handles a single packet per call here and does not
+        # tell us whether the socket is drained, so we stop when a call did
+        # not produce a message.
+        pending = self.pending
+        result = 0
+        for i in range(self.max_packets):
+            n = len(pending)
+            result = self.client.loop_read()
+            if result!=0 or len(pending)==n:
+                break
+        self._dispatch_pending()
+        if self.sock is None:
+            return # stopped while dispatching
+        if not self._has_connections():
+            self._stop_loop()
+        elif result!=0:
+            self._reconnect()
+        else:
+            self._update_writer()
+
+    def _on_writable(self):
+        if self.client.loop_write()!=0:
+            self._reconnect()
+        else:
+            self._update_writer()
+
+    def _on_misc(self):
+        self.misc_handle = None
+        if self.client.loop_misc()!=0:
+            self._reconnect()
+            return
+        self._update_writer()
+        self.misc_handle = self.scheduler.event_loop.call_later(MISC_INTERVAL,
+                                                                self._on_misc)
+
+    def _reconnect(self):
+        self._unwatch()
+        self._connect()
+        self._watch()
+
+    def _stop_loop(self):
+        if self.stop_requested:
+            return
+        self.stop_requested = True
+        if self.sock is None:
+            return # not started yet, see _observe_event_loop()
+        self._unwatch()
+        self.client.disconnect()
+        self._dispatch_completed()
+        self._remove_schedule()
+
+    def _remove_schedule(self):
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+
+    def __str__(self):
+        return 'MQTTSocketReader(%s)' % \
+            ', '.join([topic for (topic,qos) in self.topics])
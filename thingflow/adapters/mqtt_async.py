@@ -6,139 +6,244 @@ up the connect request instead.
 """
 import hbmqtt.client
 import hbmqtt.session
-import json
 import asyncio
 from collections import deque
 
 from thingflow.base import InputThing, FatalError, OutputThing, \
-                           filtermethod, EventLoopOutputThingMixin
+                           filtermethod, EventLoopOutputThingMixin, ingress_clock
+from thingflow.adapters.async_generic import DEFAULT_MAX_QUEUE_SIZE, \
+    OVERFLOW_ERROR, _BoundedQueue
+from thingflow.codecs import get_codec
+
+
+# By default, up to this many publish requests may be outstanding at once.
+DEFAULT_MAX_IN_FLIGHT = 8
 
 
 class QueueWriter(OutputThing, InputThing):
-    def __init__(self, previous_in_chain, uri, topic, scheduler):
+    """Publish each event to an MQTT topic and then pass it downstream.
+
+    Up to max_in_flight publish requests may be outstanding at once, so that
+    throughput is not bounded by the round trip time to the broker. If
+    batch_size is greater than one, queued events are combined into messages
+    of up to batch_size events, each message being a JSON list of events
+    (see QueueReader's batched_messages parameter). Events that arrive in the
+    same pass of the event loop are coalesced into batches. Regardless of the
+    order in which the publishes complete, events are dispatched downstream
+    in the order they were received.
+
+    Messages are encoded with codec, a name or instance from
+    thingflow.codecs. The default, 'json', sends each event as a JSON list.
+
+    Events wait in request_queue while the connection is being made or the
+    window is full. If the queue reaches max_queue_size, the on_overflow
+    policy is applied, as for AsyncInputThing in
+    thingflow.adapters.async_generic (OVERFLOW_BLOCK holds back the sources
+    until the queue has drained). The queue depth can also drive a
+    SheddingController (see thingflow.filters.shedding).
+
+    As with AsyncInputThing, the writer registers itself as an active
+    schedule, so that the scheduler waits for the queued events to be
+    published and the client to be disconnected before exiting.
+
+    By default, we create an hbmqtt client. Another client with the same
+    coroutine API can be passed via the client parameter.
+    """
+    def __init__(self, previous_in_chain, uri, topic, scheduler,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, batch_size=1,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 on_overflow=OVERFLOW_ERROR, codec='json', client=None):
         super().__init__()
+        assert max_in_flight>0 and batch_size>0
         self.uri = uri
         self.topic = topic
         self.scheduler = scheduler
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.codec = get_codec(codec)
+        self.connect_task = None
         self.connected = False
-        self.pending_task = None
-        self.pending_message = None
+        self.in_flight = deque() # (task, events) pairs, in publish order
+        self.disconnect_task = None
+        self.closing = False # no more events accepted, flush and disconnect
         self.pending_error = None
-        self.request_queue = deque()
-        self.client = hbmqtt.client.MQTTClient(loop=scheduler.event_loop)
+        self.pump_scheduled = False
+        self.request_queue = _BoundedQueue(self, scheduler, max_queue_size,
+                                           on_overflow)
+        self.messages_published = 0
+        if client is not None:
+            self.client = client
+        else:
+            self.client = hbmqtt.client.MQTTClient(loop=scheduler.event_loop)
         self.dispose = previous_in_chain.connect(self)
+        self.scheduler.active_schedules[self] = self.request_stop
+
+    @property
+    def dropped(self):
+        return self.request_queue.dropped
 
     def has_pending_requests(self):
         """Return True if there are pending requests. Useful for tests
-        without having to expose internal state. Note that, in the event
-        of a diconnect(), we don't remove the pending task, as we will be
-        calling on_error() or on_completed() directly intead of _process_queue().
+        without having to expose internal state.
         """
-        return ((self.pending_task is not None) and  (not self.pending_task.done())) or \
-            (self.pending_message is not None) or \
-            len(self.request_queue)>0
+        def running(task):
+            return (task is not None) and (not task.done())
+        return running(self.connect_task) or running(self.disconnect_task) or \
+            len(self.in_flight)>0 or len(self.request_queue)>0
 
     def dump_state(self):
         """Return a string representing the internal state
         (for debugging).
         """
-        return "QueueWriter(pending_task=%s,pending_message=%s,queue=%s)" %\
-            (repr(self.pending_task), repr(self.pending_message),
-             repr(self.request_queue))
+        return "QueueWriter(connected=%s,in_flight=%d,queue=%s,closing=%s)" %\
+            (self.connected, len(self.in_flight), repr(self.request_queue),
+             self.closing)
     
     def _to_message(self, x):
-        return bytes(json.dumps((x.sensor_id, x.ts, x.val),), encoding='utf-8')
-    
-    def _process_queue(self, future):
-        assert future == self.pending_task
-        exc = future.exception()
+        return self.codec.encode(x)
+
+    def _to_batch_message(self, events):
+        return self.codec.encode_batch(events)
+
+    def _schedule_pump(self):
+        if not self.pump_scheduled:
+            # Defer publishing, so that events arriving in this pass of the
+            # event loop can go into the same batch.
+            self.pump_scheduled = True
+            self.scheduler.event_loop.call_soon(self._pump)
+
+    def _pump(self):
+        self.pump_scheduled = False
+        if not self.connected:
+            return # _connect_done() will call us
+        queue = self.request_queue
+        in_flight = self.in_flight
+        while len(in_flight)<self.max_in_flight and len(queue)>0:
+            events = queue.take(min(self.batch_size, len(queue)))
+            if self.batch_size==1:
+                message = self._to_message(events[0])
+            else:
+                message = self._to_batch_message(events)
+            task = self.scheduler._schedule_coroutine(
+                self.client.publish(self.topic, message), self._publish_done)
+            in_flight.append((task, events))
+        if self.closing and len(in_flight)==0 and len(queue)==0 and \
+           self.disconnect_task is None:
+            self.disconnect_task = \
+                self.scheduler._schedule_coroutine(self.client.disconnect(),
+                                                   self._disconnect_done)
+
+    def _connect_done(self, future):
+        exc = None if future.cancelled() else future.exception()
         if exc:
             raise FatalError("mqtt request failed with exception: %s" % exc)
-        if self.pending_message:
-            self._dispatch_next(self.pending_message)
-            self.pending_message = None
-        if len(self.request_queue)==0:
-            self.pending_task = None
-            #print("Completed last task")
+        self.connected = True
+        self._pump()
+
+    def _publish_done(self, future):
+        # Publishes may complete out of order. We only dispatch the events of
+        # the oldest publishes, once they are done.
+        in_flight = self.in_flight
+        while len(in_flight)>0 and in_flight[0][0].done():
+            (task, events) = in_flight.popleft()
+            if task.cancelled():
+                continue
+            exc = task.exception()
+            if exc:
+                raise FatalError("mqtt request failed with exception: %s" % exc)
+            self.messages_published += 1
+            for x in events:
+                self._dispatch_next(x)
+        self._pump()
+
+    def _disconnect_done(self, future):
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+        if self.pending_error is not None:
+            self._dispatch_error(self.pending_error)
         else:
-            x = self.request_queue.popleft()
-            if x is not None:
-                self.pending_message = x
-                self.pending_task = \
-                    self.scheduler._schedule_coroutine(self.client.publish(self.topic,
-                                                                           self._to_message(x)),
-                                                       self._process_queue)
-                #print("enqueuing message %s on %s (from request_q)" %
-                #      (repr(x), self.topic))
-            else:
-                e = self.pending_error
-                self.pending_task = \
-                    self.scheduler._schedule_coroutine(self.client.disconnect(),
-                                                       lambda f: self._dispatch_error(e) if e is not None
-                                                       else lambda f: self._dispatch_completed)
-                #print("initiated disconnect (pending_error=%s)" % e)
-        
+            self._dispatch_completed()
+
     def on_next(self, x):
-        if self.connected == False:
-            self.request_queue.append(x)
-            self.pending_task = \
+        if self.closing:
+            return
+        self.request_queue.put(x)
+        if self.connect_task is None:
+            self.connect_task = \
                 self.scheduler._schedule_coroutine(self.client.connect(self.uri),
-                                                   self._process_queue)
-            self.connected = True
-            #print("connection in progress, put message %s on request_queue"
-            #      % repr(x))
-        elif self.pending_task is not None:
-            self.request_queue.append(x)
-            #print("put message %s on request_queue" % repr(x))
+                                                   self._connect_done)
         else:
-            self.pending_message = x
-            self.pending_task = \
-                self.scheduler._schedule_coroutine(self.client.publish(self.topic, self._to_message(x)),
-                                                   self._process_queue)
-            #print("enqueuing message %s on %s" % (repr(x), self.topic))
+            self._schedule_pump()
 
     def on_error(self, e):
-        if len(self.request_queue)>0:
-            # empty the pending request queue, we won't try to
-            # send these.
-            self.request_queue = deque()
-            #print("on_error: dropped pending requests")
-        if self.pending_task is None:
-            self.pending_task = \
-                self.scheduler._schedule_coroutine(self.client.disconnect(),
-                                                   lambda f: self._dispatch_error(e))
-            #print("on_error: initiated disconnect")
-        else:
-            self.pending_error = e
-            self.request_queue.append(None)
-            #print("on_error: queued disconnect")
+        if self.closing:
+            return
+        # empty the pending request queue, we won't try to send these.
+        self.request_queue.clear()
+        self.pending_error = e
+        self.request_stop()
     
     def on_completed(self):
-        if self.pending_task is None:
-            self.pending_task = \
-                self.scheduler._schedule_coroutine(self.client.disconnect(),
-                                                   self._process_queue)
-            #print("on_completed: initiated disconnect")
+        self.request_stop()
+
+    def request_stop(self):
+        """Stop accepting events. Any queued events are still published and
+        then the client is disconnected.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        if self.connect_task is None:
+            # never connected, so there is nothing to disconnect
+            self._disconnect_done(None)
         else:
-            self.request_queue.append(None)
-            #print("on_completed: queued disconnect")
+            self._pump()
+
+    def __str__(self):
+        return 'QueueWriter(%s)' % self.topic
 
 
 @filtermethod(OutputThing)
-def mqtt_async_send(this, uri, topic, scheduler):
+def mqtt_async_send(this, uri, topic, scheduler,
+                    max_in_flight=DEFAULT_MAX_IN_FLIGHT, batch_size=1,
+                    max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                    on_overflow=OVERFLOW_ERROR, codec='json'):
     """
     Filter method to send a message on the specified uri and topic. It is
-    added to the output_thing.
+    added to the output_thing. See QueueWriter for the other parameters.
     """
-    return QueueWriter(this, uri, topic, scheduler)
-
-
-DELIVER_TIMEOUT=2 # seconds
+    return QueueWriter(this, uri, topic, scheduler,
+                       max_in_flight=max_in_flight, batch_size=batch_size,
+                       max_queue_size=max_queue_size, on_overflow=on_overflow,
+                       codec=codec)
 
 
 class QueueReader(OutputThing, EventLoopOutputThingMixin):
     """Subscribe to a topic, wait for incoming messages,
-    and push them downstream.
+    and push them downstream. Schedule via
+    Scheduler.schedule_on_main_event_loop().
+
+    A single coroutine connects, subscribes, and then keeps receiving
+    messages via the client's deliver_message() until the reader is
+    stopped. Each time it wakes up for a message, it also takes all the
+    other messages already delivered to the client (see _delivered_queue()),
+    decodes them together, and dispatches them. If
+    batches is True, the decoded messages are dispatched as one list,
+    otherwise they are dispatched one at a time. If batched_messages is True,
+    each message is itself a list of events (see the batch_size parameter of
+    QueueWriter), and the events are dispatched as if they had been sent
+    individually.
+
+    Messages are decoded with codec, a name or instance from
+    thingflow.codecs. With the default, 'json', all the messages of a batch
+    are decoded with a single JSON parse.
+
+    _stop_loop() cancels the wait for the next message right away. We then
+    unsubscribe, disconnect, and dispatch on_completed. The timeout parameter
+    is no longer needed for this and is ignored.
+
+    By default, we create an hbmqtt client. Another client with the same
+    coroutine API can be passed via the client parameter.
     """
     # state constants
     INITIAL_STATE       = "INITIAL"
@@ -150,85 +255,122 @@ class QueueReader(OutputThing, EventLoopOutputThingMixin):
     FINAL_STATE         = "FINAL"
     
     def __init__(self, uri, topic, scheduler, qos=hbmqtt.client.QOS_1,
-                 timeout=DELIVER_TIMEOUT):
+                 timeout=None, batches=False, batched_messages=False,
+                 codec='json', client=None):
         super().__init__()
         self.uri = uri
         self.topic = topic
         self.qos = qos
         self.scheduler = scheduler
+        self.batches = batches
+        self.batched_messages = batched_messages
+        self.codec = get_codec(codec)
         self.state = QueueReader.INITIAL_STATE
-        self.pending_task = None
+        self.task = None
+        self.receiving = False # True while waiting for a message
         self.stop_requested = False
-        self.client = hbmqtt.client.MQTTClient(loop=scheduler.event_loop)
-        self.timeout = timeout # no need to change, overridable just for testing
-
-    def _start_task(self, call, next_state):
-        #print("_start_task: %s, next_state=%s" % (repr(call), next_state))
-        self.state = next_state
-        self.pending_task = self.scheduler._schedule_coroutine(call,
-                                                               self._process_event)
-
-    def _process_stop_request(self):
-        if self.stop_requested:
-            #print("stop requested")
-            self._start_task(self.client.unsubscribe([self.topic,]),
-                             QueueReader.UNSUBSCRIBING_STATE)
-            return True
+        self.messages_received = 0
+        self.batches_received = 0
+        if client is not None:
+            self.client = client
         else:
-            return False
-            
-    def _process_event(self, future):
-        assert future == self.pending_task
-        #print("_process_event state=%s" % self.state)
-        exc = future.exception()
-        if exc and isinstance(exc, asyncio.TimeoutError) and\
-           self.state==QueueReader.ACTIVE_STATE:
-            # we timeout every few seconds to check for stop requests
-            if not self._process_stop_request():
-                self._start_task(self.client.deliver_message(self.timeout),
-                                 QueueReader.ACTIVE_STATE)
-        elif exc:
-            raise FatalError("mqtt request failed with exception: %s" % exc)
-        elif self.state==QueueReader.CONNECTING_STATE:
-            if not self._process_stop_request():
-                self._start_task(self.client.subscribe([(self.topic, self.qos),]),
-                                                       QueueReader.SUBSCRIBING_STATE)
-        elif self.state==QueueReader.SUBSCRIBING_STATE:
-            if not self._process_stop_request():
-                self._start_task(self.client.deliver_message(self.timeout),
-                                 QueueReader.ACTIVE_STATE)
-        elif self.state==QueueReader.ACTIVE_STATE:
-            result = future.result()
-            assert isinstance(result, hbmqtt.session.ApplicationMessage)
-            message = str(result.data, encoding='utf-8')
-            self._dispatch_next(json.loads(message))
-            if not self._process_stop_request():
-                self._start_task(self.client.deliver_message(self.timeout),
-                                 QueueReader.ACTIVE_STATE)
-        elif self.state==QueueReader.UNSUBSCRIBING_STATE:
-            self._start_task(self.client.disconnect(),
-                             QueueReader.DISCONNECTING_STATE)
-        elif self.state==QueueReader.DISCONNECTING_STATE:
-            self._dispatch_completed()
-            self.state = QueueReader.FINAL_STATE
-            self.pending_task = None
-            self.scheduler._remove_from_active_schedules(self)
-            print("QueueReader in FINAL state")
-        elif self.state==QueueReader.FINAL_STATE:
-            raise Exception("_process_event should not be called in final state")
+            self.client = hbmqtt.client.MQTTClient(loop=scheduler.event_loop)
+
+    def _delivered_queue(self):
+        """Return the client's queue of delivered messages, or None if we
+        cannot get at it.
+
+        hbmqtt's public API has no way to take the messages that have already
+        been delivered without waiting: deliver_message() always runs a new
+        task, so even with a zero timeout it returns nothing. All it does is
+        take the next message from client.session.delivered_message_queue,
+        an asyncio.Queue, so we drain that queue directly with get_nowait().
+        This is a private part of hbmqtt (as of 0.9), so we check that it is
+        there and is an asyncio.Queue. If not, we just call deliver_message()
+        for each message.
+        """
+        session = getattr(self.client, 'session', None)
+        queue = getattr(session, 'delivered_message_queue', None)
+        return queue if isinstance(queue, asyncio.Queue) else None
+
+    async def _run(self):
+        client = self.client
+        self.state = QueueReader.CONNECTING_STATE
+        await client.connect(self.uri)
+        if not self.stop_requested:
+            self.state = QueueReader.SUBSCRIBING_STATE
+            await client.subscribe([(self.topic, self.qos),])
+            if not self.stop_requested:
+                self.state = QueueReader.ACTIVE_STATE
+                try:
+                    await self._receive()
+                except asyncio.CancelledError:
+                    pass # stop requested while waiting for a message
+            self.state = QueueReader.UNSUBSCRIBING_STATE
+            await client.unsubscribe([self.topic,])
+        self.state = QueueReader.DISCONNECTING_STATE
+        await client.disconnect()
+
+    async def _receive(self):
+        client = self.client
+        while True:
+            self.receiving = True
+            try:
+                message = await client.deliver_message()
+            finally:
+                self.receiving = False
+            messages = [message]
+            queue = self._delivered_queue()
+            if queue is not None:
+                while True:
+                    try:
+                        messages.append(queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+            if ingress_clock.enabled:
+                ingress_clock.stamp()
+            self._dispatch_messages(messages)
+            if self.stop_requested or (not self._has_connections()):
+                return
+
+    def _dispatch_messages(self, messages):
+        self.messages_received += len(messages)
+        self.batches_received += 1
+        if self.batched_messages:
+            decode_batch = self.codec.decode_batch
+            values = [v for m in messages for v in decode_batch(m.data)]
+        else:
+            values = self.codec.decode_many([m.data for m in messages])
+        if self.batches:
+            self._dispatch_next(values)
         else:
-            raise Exception("_process_event: invalidate state %s" % self.state)
+            for v in values:
+                if self.stop_requested:
+                    break # a downstream thing stopped us
+                self._dispatch_next(v)
+
+    def _run_done(self, future):
+        self.task = None
+        exc = None if future.cancelled() else future.exception()
+        if exc:
+            raise FatalError("mqtt request failed with exception: %s" % exc)
+        self._dispatch_completed()
+        self.state = QueueReader.FINAL_STATE
+        self.scheduler._remove_from_active_schedules(self)
+        print("QueueReader in FINAL state")
             
     def _observe_event_loop(self):
         """This gets things kicked off. Most of the real
-        action will occur in _process_event().
+        action will occur in _run().
         """
         assert self.state == QueueReader.INITIAL_STATE,\
             "_observe_event_loop called when in state %s" % self.state
-        self._start_task(self.client.connect(self.uri), QueueReader.CONNECTING_STATE)
+        self.task = self.scheduler._schedule_coroutine(self._run(),
+                                                       self._run_done)
         
     def _stop_loop(self):
-        """Stop listening for new messages, processing any pending messages, and
-        move to the final state.
+        """Stop listening for new messages and move to the final state.
         """
         self.stop_requested = True
+        if self.task is not None and self.receiving:
+            self.task.cancel()
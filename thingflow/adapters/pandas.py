@@ -4,27 +4,287 @@
 Pandas (http://pandas.pydata.org) is a data analysis library.
 This module contains adapters for converting between thingflow
 event streams and Pandas data types.
+
+DataFrameAsOutputThing goes the other way, replaying the rows of a
+DataFrame (or NumPy arrays, via from_arrays()) into a pipeline in chunks,
+optionally paced in real time from the timestamps.
+
+The writers store the timestamps and values in NumPy arrays, which are
+grown geometrically as events arrive, rather than in Python lists of
+objects. The timestamps are kept as nanoseconds since the epoch and are
+converted to a DatetimeIndex in one vectorized step when a result or
+snapshot is built.
 """
+import asyncio
 import datetime
+import dateutil.tz
+import numpy as np
 import pandas as pd
 
-from thingflow.base import InputThing
+from thingflow.base import InputThing, SensorEvent
+from thingflow.adapters.async_generic import AsyncIterableAsOutputThing
+
+# Number of events for which the arrays are initially allocated
+DEFAULT_INITIAL_CAPACITY = 1024
+
+# Number of rows converted to events at a time by DataFrameAsOutputThing
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class _GrowableArray:
+    """A one dimensional NumPy array that we can append to in amortized
+    constant time. The first n elements are never modified once written, so
+    views returned by view() stay valid, even after the array is grown.
+
+    If dtype is None, it is taken from the first value, and the array is
+    converted to a wider type if a later value does not fit (e.g. a float
+    following integers).
+    """
+    __slots__ = ('array', 'n', 'dtype_fixed', 'last_type')
+
+    def __init__(self, dtype=None, capacity=DEFAULT_INITIAL_CAPACITY):
+        self.array = np.empty(max(capacity, 1),
+                              dtype=dtype if dtype is not None else np.int64)
+        self.n = 0
+        self.dtype_fixed = dtype is not None
+        self.last_type = None # type of the last value, if dtype not fixed
+
+    def _realloc(self, capacity, dtype):
+        array = np.empty(capacity, dtype=dtype)
+        array[:self.n] = self.array[:self.n]
+        self.array = array
+
+    def _check_dtype(self, value):
+        dtype = np.asarray(value).dtype
+        if dtype.kind in 'US':
+            dtype = np.dtype(object) # don't truncate strings
+        if self.n>0:
+            dtype = np.result_type(self.array.dtype, dtype)
+        if dtype!=self.array.dtype:
+            self._realloc(len(self.array), dtype)
+        self.last_type = type(value)
+
+    def append(self, value):
+        if (not self.dtype_fixed) and type(value) is not self.last_type:
+            self._check_dtype(value)
+        if self.n==len(self.array):
+            self._realloc(2*len(self.array), self.array.dtype)
+        self.array[self.n] = value
+        self.n += 1
+
+    def view(self, start=0):
+        return self.array[start:self.n]
+
+    def __len__(self):
+        return self.n
+
+
+def _to_datetime_index(ts_ns, tz):
+    """Convert an array of nanoseconds since the epoch to a DatetimeIndex in
+    timezone tz (or local time without a timezone, if tz is None).
+    """
+    index = pd.DatetimeIndex(ts_ns.view('datetime64[ns]')).tz_localize('UTC')
+    if tz is None:
+        # tzlocal() applies the offset in effect at each timestamp, so
+        # daylight saving time changes are handled
+        return index.tz_convert(dateutil.tz.tzlocal()).tz_localize(None)
+    return index.tz_convert(tz)
+
 
 class PandasSeriesWriter(InputThing):
     """Create a pandas Series object corresponding to the
-    event stream passed to this subscriber.
+    event stream passed to this subscriber. The result is stored in
+    self.result when the stream completes.
+
+    snapshot() returns a Series of the events received so far, and can be
+    called at any time. The Series values are a view of the stored
+    values, not a copy, so they should not be modified. If incremental is
+    True, only the events received since the previous snapshot are included.
     """
-    def __init__(self, tz=datetime.timezone.utc):
-        self.data= []
-        self.index = []
+    def __init__(self, tz=datetime.timezone.utc,
+                 initial_capacity=DEFAULT_INITIAL_CAPACITY):
+        self.ts = _GrowableArray(np.int64, initial_capacity)
+        self.data = _GrowableArray(None, initial_capacity)
         self.tz = tz
+        self.snapshot_pos = 0 # number of events in the last snapshot
         self.result = None # we will store the series here when done
-        
+
     def on_next(self, x):
+        self.ts.append(int(round(x.ts*1e9)))
         self.data.append(x.val)
-        self.index.append(datetime.datetime.fromtimestamp(x.ts, tz=self.tz))
+
+    def _series(self, start):
+        return pd.Series(self.data.view(start),
+                         index=_to_datetime_index(self.ts.view(start), self.tz),
+                         copy=False)
+
+    def snapshot(self, incremental=False):
+        start = self.snapshot_pos if incremental else 0
+        self.snapshot_pos = len(self.ts)
+        return self._series(start)
 
     def on_completed(self):
-        self.result = pd.Series(self.data, index=self.index)
+        self.result = self._series(0)
+
 
+class PandasDataFrameWriter(InputThing):
+    """Create a pandas DataFrame from a stream of events from many sensors,
+    with a row per timestamp and a column per sensor id (in the order
+    the sensors were first seen). Where a sensor has no value at a
+    timestamp, the value is NaN. The values are converted to floats.
+    The result is stored in self.result when the stream completes.
 
+    snapshot() returns a DataFrame of the events received so far. If
+    incremental is True, only the events received since the previous
+    snapshot are included, so the cost of each call depends only on the
+    number of new events.
+    """
+    def __init__(self, tz=datetime.timezone.utc,
+                 initial_capacity=DEFAULT_INITIAL_CAPACITY):
+        self.ts = _GrowableArray(np.int64, initial_capacity)
+        self.columns = _GrowableArray(np.int32, initial_capacity)
+        self.data = _GrowableArray(np.float64, initial_capacity)
+        self.sensor_ids = [] # the column names
+        self.column_for_sensor = {}
+        self.tz = tz
+        self.snapshot_pos = 0
+        self.result = None
+
+    def on_next(self, x):
+        column = self.column_for_sensor.get(x.sensor_id)
+        if column is None:
+            column = self.column_for_sensor[x.sensor_id] = \
+                len(self.sensor_ids)
+            self.sensor_ids.append(x.sensor_id)
+        self.ts.append(int(round(x.ts*1e9)))
+        self.columns.append(column)
+        self.data.append(x.val)
+
+    def _frame(self, start):
+        (ts, rows) = np.unique(self.ts.view(start), return_inverse=True)
+        columns = self.columns.view(start)
+        values = np.full((len(ts), len(self.sensor_ids)), np.nan)
+        values[rows, columns] = self.data.view(start)
+        if start>0:
+            # only the sensors that have events in this range
+            used = np.unique(columns)
+            values = values[:, used]
+            sensor_ids = [self.sensor_ids[c] for c in used]
+        else:
+            sensor_ids = list(self.sensor_ids)
+        return pd.DataFrame(values, index=_to_datetime_index(ts, self.tz),
+                            columns=sensor_ids, copy=False)
+
+    def snapshot(self, incremental=False):
+        start = self.snapshot_pos if incremental else 0
+        self.snapshot_pos = len(self.ts)
+        return self._frame(start)
+
+    def on_completed(self):
+        self.result = self._frame(0)
+
+
+def _to_epoch_seconds(values):
+    """Convert timestamps (datetimes, or numbers of seconds since the epoch)
+    to a float array of seconds since the epoch. Datetimes without a
+    timezone are taken to be UTC.
+    """
+    values = pd.Series(values, copy=False)
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        if getattr(values.dt, 'tz', None) is not None:
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None)
+        return values.to_numpy(dtype='datetime64[ns]').view(np.int64)/1e9
+    return values.to_numpy(dtype=np.float64)
+
+
+class DataFrameAsOutputThing(AsyncIterableAsOutputThing):
+    """Replay the rows of a pandas DataFrame as SensorEvents. Schedule it via
+    Scheduler.schedule_on_main_event_loop().
+
+    The timestamps come from ts_column, or from the index if ts_column is
+    None. They may be datetimes or seconds since the epoch. The values come
+    from val_column. The sensor ids come from sensor_id_column, or, if
+    sensor_id is specified, all the events have that sensor id.
+
+    The rows are converted to events chunk_size rows at a time, using
+    vectorized column access rather than a tuple per row. If batches is
+    True, each chunk is dispatched as a single list of events, otherwise
+    the events of a chunk are dispatched individually, in a burst. We yield
+    to the event loop between chunks.
+
+    If speed is specified, the events are paced in real time from their
+    timestamps (which must be in ascending order), sped up by that factor:
+    e.g. with speed=10, an hour of data is replayed in six minutes. Each
+    chunk then contains just the rows whose time has come. If speed is
+    None, the rows are replayed as fast as possible.
+    """
+    def __init__(self, df, scheduler, sensor_id=None,
+                 sensor_id_column='sensor_id', ts_column='ts',
+                 val_column='val', chunk_size=DEFAULT_CHUNK_SIZE,
+                 batches=True, speed=None, name=None):
+        assert chunk_size>0
+        assert speed is None or speed>0
+        self.ts = _to_epoch_seconds(df.index if ts_column is None
+                                    else df[ts_column])
+        self.vals = df[val_column].to_numpy()
+        if sensor_id is None:
+            self.sensor_ids = df[sensor_id_column].to_numpy()
+        else:
+            self.sensor_ids = None
+        self.sensor_id = sensor_id
+        self.chunk_size = chunk_size
+        self.speed = speed
+        # In batch mode, the base class sees each chunk as a single item,
+        # otherwise it sees the events in a chunk. Either way, it yields to
+        # the event loop after each chunk.
+        super().__init__(self._chunks(), scheduler, batches=not batches,
+                         yield_budget=1 if batches else chunk_size,
+                         name=name)
+
+    def _events(self, start, end):
+        ts = self.ts[start:end].tolist()
+        vals = self.vals[start:end].tolist()
+        if self.sensor_ids is None:
+            sensor_ids = [self.sensor_id]*len(ts)
+        else:
+            sensor_ids = self.sensor_ids[start:end].tolist()
+        return list(map(SensorEvent, sensor_ids, ts, vals))
+
+    async def _chunks(self):
+        ts = self.ts
+        n = len(ts)
+        speed = self.speed
+        loop = self.scheduler.event_loop
+        if speed is not None and n>0:
+            first_ts = ts[0]
+            start_time = loop.time()
+        i = 0
+        while i<n:
+            end = min(i+self.chunk_size, n)
+            if speed is not None:
+                now_ts = first_ts + (loop.time()-start_time)*speed
+                due = int(np.searchsorted(ts, now_ts, side='right'))
+                if due<=i:
+                    await asyncio.sleep((ts[i]-now_ts)/speed)
+                    continue
+                end = min(end, due)
+            yield self._events(i, end)
+            i = end
+
+    def __str__(self):
+        if self.name:
+            return self.name
+        return 'DataFrameAsOutputThing(%d rows)' % len(self.ts)
+
+
+def from_arrays(ts, vals, scheduler, sensor_id=None, sensor_ids=None,
+                **kwargs):
+    """Create a DataFrameAsOutputThing from NumPy arrays (or sequences) of
+    timestamps, values and, unless sensor_id is specified, sensor ids. See
+    DataFrameAsOutputThing for the other parameters.
+    """
+    columns = {'ts':ts, 'val':vals}
+    if sensor_id is None:
+        columns['sensor_id'] = sensor_ids
+    return DataFrameAsOutputThing(pd.DataFrame(columns, copy=False),
+                                  scheduler, sensor_id=sensor_id, **kwargs)
@@ -1,7 +1,7 @@
 # Copyright 2016 by MPI-SWS and Data-Ken Research.
 # Licensed under the Apache 2.0 License.
 from thingflow.base import BlockingInputThing, OutputThing, DirectOutputThingMixin,\
-                           FatalError, SensorEvent
+                           FatalError, SensorEvent, ingress_clock
 from thingflow.adapters.generic import EventRowMapping
 
 import datetime
@@ -133,6 +133,8 @@ class PostgresReader(OutputThing, DirectOutputThingMixin):
                 self.cur.execute(self.mapping.query_sql)
             row = self.cur.fetchone()
             if row is not None:
+                if ingress_clock.enabled:
+                    ingress_clock.stamp()
                 self._dispatch_next(self.mapping.row_to_event(row))
                 return True
             else:
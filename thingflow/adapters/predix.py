@@ -1,17 +1,25 @@
 """
 Adapters to Predix TimeSeries API
 
-Library dependencies: websocket-client requests
+Library dependencies: aiohttp
 """
+import asyncio
+import itertools
 import logging
 import json
 import time
 import os
+from collections import deque
 
-from websocket import create_connection
-import requests
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-from thingflow.base import SensorEvent, InputThing, OutputThing, FatalError
+from thingflow.base import SensorEvent, OutputThing, FatalError,\
+                           EventLoopOutputThingMixin, ingress_clock
+from thingflow.adapters.async_generic import AsyncInputThing, \
+    DEFAULT_MAX_QUEUE_SIZE, OVERFLOW_ERROR
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +28,7 @@ def ts_to_predix_ts(ts):
 
 # we use this to generate unique message ids
 _PIDSTR = str(os.getpid())
+_message_counter = itertools.count()
 
 class EventExtractor:
     """Methods to access data from an event for use in a
@@ -37,8 +46,11 @@ class EventExtractor:
         
     def get_message_id(self):
         """Not associated with the event, but with the message that will be sent.
+        The ids must be unique, as they are used to match the acknowledgements
+        to the messages.
         """
-        return _PIDSTR + str(int(round(1000*time.time())))
+        return _PIDSTR + str(int(round(1000*time.time()))) + '-' + \
+            str(next(_message_counter))
 
     def get_attributes(self, sensor_id):
         """Attributes are a property of the sensor, not the individual event.
@@ -91,59 +103,134 @@ def _create_ingest_body(events, extractor):
 class PredixError(Exception):
     pass
 
-class PredixWriter(InputThing):
-    """Adapter that sends mesages to the Predix TimeSeries service via the
-    Ingest websocket API.
 
-    The batch_size is used to determine how many events go into a message.
+# Defaults for PredixWriter
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_MAX_UNACKED = 8
+DEFAULT_FLUSH_INTERVAL = 1.0 # seconds
+DEFAULT_ACK_TIMEOUT = 30.0 # seconds
+
+
+class PredixWriter(AsyncInputThing):
+    """Adapter that sends mesages to the Predix TimeSeries service via the
+    Ingest websocket API. This runs on the scheduler's event loop (see
+    AsyncInputThing) and uses an aiohttp websocket.
+
+    Events are sent in messages of up to batch_size events. A partial batch
+    is sent flush_interval seconds after its first event arrived. We do not
+    wait for each message to be acknowledged before sending the next one:
+    up to max_unacked messages may be awaiting their acknowledgement, which
+    is matched to the message via its message id. A negative
+    acknowledgement, an acknowledgement that does not arrive within
+    ack_timeout seconds, or losing the connection with messages
+    unacknowledged, is a fatal error. See AsyncInputThing for
+    max_queue_size and on_overflow. The scheduler and the parameters after
+    it must be passed as keyword arguments. Since the default batch_size
+    is 1, pass a larger batch_size to send fewer, larger messages.
 
     The extractor parameter specifies a class to map from internal events to
     Predix events. The default value maps from thingflow.base.SensorEvent.
+
+    By default, we create an aiohttp.ClientSession, which is closed when the
+    writer is done. Another session (or an object with a compatible
+    ws_connect() method) can be passed via the session parameter.
     """
-    def __init__(self, ingest_url, predix_zone_id, token, batch_size=1,
-                 extractor=EventExtractor()):
+    def __init__(self, ingest_url, predix_zone_id, token,
+                 batch_size=DEFAULT_BATCH_SIZE, extractor=EventExtractor(),
+                 *, scheduler, max_unacked=DEFAULT_MAX_UNACKED,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 ack_timeout=DEFAULT_ACK_TIMEOUT,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 on_overflow=OVERFLOW_ERROR, session=None):
+        super().__init__(scheduler, batch_size=batch_size,
+                         max_in_flight=max_unacked,
+                         max_queue_size=max_queue_size,
+                         on_overflow=on_overflow,
+                         flush_interval=flush_interval)
+        if session is None and aiohttp is None:
+            raise ImportError("PredixWriter requires the aiohttp package")
         self.ingest_url = ingest_url
-        self.batch_size = batch_size
         self.extractor = extractor
+        self.ack_timeout = ack_timeout
         self.headers = {'Predix-Zone-Id': predix_zone_id,
                         'Authorization': 'Bearer ' + token,
                         'Content-Type': 'application/json'}
+        self.session = session
+        self.own_session = session is None
         self.ws = None
-        self.pending_events = []
-
-    def _send(self):
-        if self.ws is None:
-            logging.info("Connecting to Predix...")
-            self.ws = create_connection(self.ingest_url, header=self.headers)
-            logging.info("Connected")
-        body = json.dumps(_create_ingest_body(self.pending_events, extractor=self.extractor))
-        #print(body)
-        self.ws.send(body)
-        result = self.ws.recv()
-        rdata = json.loads(result)
-        if rdata['statusCode']!=202:
-            raise PredixError("Unexpected websocket response: %s" % result)
-        self.pending_events = []
-
-    def on_next(self, msg):
-        self.pending_events.append(msg)
-        if len(self.pending_events)==self.batch_size:
-            self._send()
-
-    def on_completed(self):
-        if len(self.pending_events)>0:
-            self._send()
-        if self.ws:
-            self.ws.close()
-
-    def on_error(self, e):
-        if len(self.pending_events)>0:
+        self.connect_task = None
+        self.unacked = {} # map from message id to the future for its ack
+        self.messages_acked = 0
+
+    async def _connect(self):
+        logger.info("Connecting to Predix...")
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        self.ws = await self.session.ws_connect(self.ingest_url,
+                                                headers=self.headers)
+        logger.info("Connected")
+        self.scheduler._schedule_coroutine(self._receive_acks(),
+                                           self._receive_done)
+
+    async def _receive_acks(self):
+        ws = self.ws
+        while True:
             try:
-                self._send()
+                result = await ws.receive_str()
             except Exception as e:
-                logger.exception("Error in attemping to flush pending messages to predix", e)
-        if self.ws:
-            self.ws.close()
+                # the connection was closed
+                if len(self.unacked)>0:
+                    error = PredixError("Connection closed with %d messages "
+                                        "unacknowledged: %s" %
+                                        (len(self.unacked), e))
+                    for ack in self.unacked.values():
+                        if not ack.done():
+                            ack.set_exception(error)
+                    self.unacked.clear()
+                return
+            rdata = json.loads(result)
+            ack = self.unacked.pop(str(rdata.get('messageId')), None)
+            if ack is None:
+                logger.warning("Unexpected websocket response: %s" % result)
+            elif rdata.get('statusCode')!=202:
+                ack.set_exception(
+                    PredixError("Unexpected websocket response: %s" % result))
+            else:
+                self.messages_acked += 1
+                ack.set_result(rdata)
+
+    def _receive_done(self, future):
+        if not future.cancelled() and future.exception():
+            logger.error("%s: error receiving acknowledgements: %s" %
+                         (self, future.exception()))
+
+    async def _write_batch(self, events):
+        if self.connect_task is None:
+            # shared by all the writes that are waiting for the connection
+            self.connect_task = \
+                self.scheduler._schedule_coroutine(self._connect(),
+                                                   lambda f: None)
+        await self.connect_task
+        body = _create_ingest_body(events, extractor=self.extractor)
+        ack = self.scheduler.event_loop.create_future()
+        mid = str(body['messageId'])
+        self.unacked[mid] = ack
+        await self.ws.send_str(json.dumps(body))
+        try:
+            await asyncio.wait_for(ack, self.ack_timeout)
+        except asyncio.TimeoutError:
+            self.unacked.pop(mid, None)
+            raise FatalError("%s: no acknowledgement for message %s after %s "
+                             "seconds" % (self, mid, self.ack_timeout))
+
+    async def _close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.own_session and self.session is not None:
+            await self.session.close()
+
+    def __str__(self):
+        return 'PredixWriter(%s)' % self.ingest_url
 
 
 
@@ -166,92 +253,267 @@ def build_sensor_event(sensor_id, predix_timestamp, value, quality):
     """
     return SensorEvent(sensor_id, predix_timestamp/1000, value)
 
+
 def _parse_query_response(resp, build_event_fn=build_sensor_event):
     try:
         l = resp['tags'][0]
         results = l['results']
         sensor_id=l['name']
-        values = [build_sensor_event(sensor_id, v[0], v[1], v[2]) for v in
-                  results[0]['values']]
+        values = results[0]['values'] if len(results)>0 else []
+        if build_event_fn is build_sensor_event:
+            # avoid a function call per datapoint in the common case
+            events = [SensorEvent(sensor_id, v[0]/1000, v[1]) for v in values]
+        else:
+            events = [build_event_fn(sensor_id, v[0], v[1], v[2])
+                      for v in values]
         count = l['stats']['rawCount']
         if count>0:
-            last_timestamp_ms = results[0]['values'][-1][0]
+            last_timestamp_ms = values[-1][0]
         else:
             last_timestamp_ms = None
-        return count, values, last_timestamp_ms
-    except Exception as e:
-        logger.exception("Parse error for query response %s" % resp, e)
+        return count, events, last_timestamp_ms
+    except Exception:
+        logger.exception("Parse error for query response %s" % resp)
         raise Exception("Parse error for query response %s" % resp)
-    
 
-class PredixReader(OutputThing):
+
+def _split_range(start_time_ms, end_time_ms, max_range_ms):
+    """Split the (inclusive) range of timestamps into consecutive sub-ranges
+    of at most max_range_ms milliseconds.
+    """
+    if max_range_ms is None:
+        return [(start_time_ms, end_time_ms)]
+    ranges = []
+    start = start_time_ms
+    while start<=end_time_ms:
+        end = min(start+max_range_ms-1, end_time_ms)
+        ranges.append((start, end))
+        start = end+1
+    return ranges
+
+
+# Defaults for PredixReader
+DEFAULT_POLL_INTERVAL = 5.0 # seconds
+DEFAULT_MIN_POLL_INTERVAL = 1.0
+DEFAULT_MAX_POLL_INTERVAL = 60.0
+DEFAULT_TARGET_EVENTS = 1000 # events per poll that we aim for
+DEFAULT_MAX_QUERY_RANGE = 3600.0 # seconds
+DEFAULT_MAX_PARALLEL_QUERIES = 4
+DEFAULT_YIELD_BUDGET = 100
+
+
+class PredixReader(OutputThing, EventLoopOutputThingMixin):
     """Query the Predix time series service for events and inject them
-    into thingflow.
+    into thingflow. This runs as a coroutine on the scheduler's event loop
+    and uses an aiohttp session, so the connections to the service are
+    reused across queries. Schedule it via
+    Scheduler.schedule_on_main_event_loop().
 
     The query API is a little problematic for ongoing event
     queries, as it is stateless and does not have a concept of event ids.
     Thus, we have to query for events within specific ranges. We can work
     around this by querying for one millisecond more than the last event.
+
+    The polling interval adapts to the density of the data: we aim to get
+    about target_events events per query, staying within min_interval and
+    max_interval seconds, and back off when a query returns no events. To
+    poll at a fixed rate, set min_interval and max_interval to the same value.
+
+    A time range longer than max_range seconds (e.g. when catching up on
+    old data) is split into sub-ranges, which are queried in parallel, up
+    to max_parallel at a time. The events are dispatched in order, and the
+    queries for the later sub-ranges proceed while the earlier ones are
+    dispatched. The scheduler and the parameters after it must be passed as
+    keyword arguments.
     """
-    def __init__(self, query_url, predix_zone_id, token, sensor_id, start_time=None,
-                 one_shot=False, build_event_fn=build_sensor_event):
+    def __init__(self, query_url, predix_zone_id, token, sensor_id,
+                 start_time=None, one_shot=False,
+                 build_event_fn=build_sensor_event, *, scheduler,
+                 end_time=None, interval=DEFAULT_POLL_INTERVAL,
+                 min_interval=DEFAULT_MIN_POLL_INTERVAL,
+                 max_interval=DEFAULT_MAX_POLL_INTERVAL,
+                 target_events=DEFAULT_TARGET_EVENTS,
+                 max_range=DEFAULT_MAX_QUERY_RANGE,
+                 max_parallel=DEFAULT_MAX_PARALLEL_QUERIES,
+                 yield_budget=DEFAULT_YIELD_BUDGET, session=None):
         """start_time is the starting time for the first query. If not specified,
         the time that the reader object was constructed is used. The end time
-        for queries is always the current time.
+        for queries is the current time, unless end_time is specified. In that
+        case, the stream is closed once an event at end_time has been read.
 
-        If one_shot is True, we just do a single query and close the stream.
+        If one_shot is True, we just query once (possibly split into
+        sub-ranges) and close the stream.
 
         build_event_fn is a function mapping from fields of a predix timeseries
         event to internal events to be used within ThingFlow. By default, it
         maps to thingflow.base.SensorEvent tuples.
+
+        By default, we create an aiohttp.ClientSession, which is closed when
+        the reader is done. Another session (or an object with a compatible
+        post() method) can be passed via the session parameter.
         """
         super().__init__()
+        assert min_interval<=max_interval and max_parallel>0
+        if session is None and aiohttp is None:
+            raise ImportError("PredixReader requires the aiohttp package")
         self.query_url = query_url
         self.headers = {'Predix-Zone-Id': predix_zone_id,
                         'Authorization': 'Bearer ' + token,
                         'Content-Type': 'application/json'}
         self.sensor_id = sensor_id
+        self.scheduler = scheduler
         if start_time:
             self.start_time_ms = ts_to_predix_ts(start_time)
         else:
             self.start_time_ms = ts_to_predix_ts(time.time())
+        self.end_time_ms = ts_to_predix_ts(end_time) if end_time else None
         self.one_shot = one_shot
-        self.build_event_fn = build_sensor_event
-        
-
-    def _query(self, start_time_ms, end_time_ms):
+        self.build_event_fn = build_event_fn
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.target_events = target_events
+        self.max_range_ms = int(1000*max_range) if max_range else None
+        self.max_parallel = max_parallel
+        self.yield_budget = yield_budget
+        self.session = session
+        self.own_session = session is None
+        self.task = None
+        self.stop_requested = False
+        self.fatal_error = None
+        self.queries = 0
+
+    async def _query(self, start_time_ms, end_time_ms):
         body = _create_query_body(self.sensor_id, start_time_ms, end_time_ms)
-        #print(body)
-        r = requests.post(self.query_url, data=bytes(json.dumps(body), encoding='utf-8'),
-                          headers=self.headers)
-        resp = r.json()
+        async with self.session.post(self.query_url,
+                                     data=json.dumps(body).encode('utf-8'),
+                                     headers=self.headers) as r:
+            data = await r.read()
+            if r.status!=200:
+                raise PredixError("Query failed with status %s: %s" %
+                                  (r.status, data[:200]))
+        self.queries += 1
+        resp = json.loads(data)
         logger.debug("response: %s", resp)
         (count, events, last_timestamp_ms) = \
             _parse_query_response(resp, build_event_fn=self.build_event_fn)
         assert count==len(events)
-        r.close()
         return events, last_timestamp_ms
-        
-    def _observe(self):
-        query_time_ms = ts_to_predix_ts(time.time())
+
+    async def _query_ranges(self, start_time_ms, end_time_ms):
+        """Query the range, split into sub-ranges of at most max_range, and
+        yield the results of each sub-range in order. Up to max_parallel
+        queries are in progress at once, including while the caller is
+        dispatching the events of a previous sub-range.
+        """
+        loop = self.scheduler.event_loop
+        pending = deque()
+        try:
+            for (start, end) in _split_range(start_time_ms, end_time_ms,
+                                             self.max_range_ms):
+                if len(pending)==self.max_parallel:
+                    yield await pending.popleft()
+                pending.append(loop.create_task(self._query(start, end)))
+            while len(pending)>0:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _dispatch_events(self, events):
+        """Dispatch the events, yielding to the event loop periodically so
+        that the queries in progress are not held up, and waiting while a
+        sink applies backpressure.
+        """
+        budget = self.yield_budget
+        for event in events:
+            if ingress_clock.enabled:
+                ingress_clock.stamp()
+            self._dispatch_next(event)
+            budget -= 1
+            if len(self.scheduler.congested)>0:
+                await self.scheduler._wait_for_capacity()
+            if budget==0:
+                budget = self.yield_budget
+                await asyncio.sleep(0)
+
+    def _adapt_interval(self, count, span_ms):
+        if count==0:
+            self.interval = min(2*self.interval, self.max_interval)
+        else:
+            rate = count/max(span_ms/1000, 0.001) # events per second
+            self.interval = min(max(self.target_events/rate,
+                                    self.min_interval), self.max_interval)
+
+    async def _poll(self):
+        loop = self.scheduler.event_loop
+        while True:
+            poll_time = loop.time()
+            query_start_ms = self.start_time_ms
+            query_end_ms = self.end_time_ms if self.end_time_ms \
+                           else ts_to_predix_ts(time.time())
+            count = 0
+            results = self._query_ranges(query_start_ms, query_end_ms)
+            try:
+                async for (events, last_timestamp_ms) in results:
+                    # we use the last timestamp time + 1 tick as the next
+                    # start time. If no events were found, we leave the same
+                    # start time
+                    if len(events)>0:
+                        self.start_time_ms = last_timestamp_ms + 1
+                        count += len(events)
+                        await self._dispatch_events(events)
+            finally:
+                await results.aclose() # cancels the queries in progress
+            if self.one_shot or (self.end_time_ms and
+                                 self.start_time_ms>self.end_time_ms):
+                logger.info("Done with data from %s" % self.sensor_id)
+                return
+            self._adapt_interval(count, query_end_ms-query_start_ms)
+            # the interval includes the time taken by the queries and dispatch
+            await asyncio.sleep(max(poll_time+self.interval-loop.time(), 0))
+
+    async def _run(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
         try:
-            (events, last_timestamp_ms) = self._query(self.start_time_ms, query_time_ms)
-            for event in events:
-                self._dispatch_next(event)
-        except FatalError:
-            raise
+            await self._poll()
+            self._dispatch_completed()
+        except asyncio.CancelledError:
+            self._dispatch_completed()
+        except FatalError as e:
+            # raised in _run_done(), so that the scheduler sees it
+            self.fatal_error = e
         except Exception as e:
-            logger.exception("Got an error during query", e)
+            logger.exception("Got an error during query")
             self._dispatch_error(e)
+        finally:
+            if self.own_session:
+                await self.session.close()
+
+    def _observe_event_loop(self):
+        if self.stop_requested:
+            self._remove_schedule()
             return
-        if self.one_shot:
-            logger.info("Done with data from %s" % self.sensor_id)
-            self._dispatch_completed()
-            return
-        # if not one shot, we use the last timestamp time + 1 tick
-        # as the next start time.
-        # If no events were found, we leave the same start time
-        if len(events)>0:
-            self.start_time_ms =  last_timestamp_ms + 1
-            
-            
+        self.task = self.scheduler._schedule_coroutine(self._run(),
+                                                       self._run_done)
+
+    def _stop_loop(self):
+        self.stop_requested = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def _run_done(self, future):
+        self.task = None
+        if self.fatal_error is not None:
+            if self in self.scheduler.active_schedules:
+                del self.scheduler.active_schedules[self]
+            raise self.fatal_error
+        self._remove_schedule()
+
+    def _remove_schedule(self):
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+
+    def __str__(self):
+        return 'PredixReader(%s)' % self.sensor_id
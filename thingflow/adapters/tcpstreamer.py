@@ -1,77 +1,445 @@
 # Copyright 2016 by MPI-SWS and Data-Ken Research.
 # Licensed under the Apache 2.0 License.
-"""TODO: This needs to be updated to match the latest base.py!
+"""
+Stream events over TCP, using asyncio on the scheduler's event loop.
+
+TcpStreamInputThing is a server that sends each event it receives to all of
+its connected clients. TcpStreamReader is an OutputThing that connects to
+such a server and dispatches the events it receives.
+
+Each event is encoded once, with a codec from thingflow.codecs, and then
+framed in one of two ways:
+
+ * ``FRAMING_NEWLINE`` - the payload followed by a newline. This is the
+   default and, with the default json codec, gives newline-delimited JSON
+   that can be read by other tools (e.g. ``nc localhost 2991``). It should
+   only be used with text codecs.
+ * ``FRAMING_LENGTH`` - the payload prefixed by its length, as a four byte
+   big-endian integer. This works for any codec (e.g. 'struct').
+
+The frames of the events received in one pass of the event loop are written
+to each client together. Writes go to the client's transport, which sends
+them as the socket permits. If a client falls behind and its transport's
+buffer goes over write_buffer_limit, we hold its frames in a per-client
+buffer of at most max_client_buffer frames until the transport drains. If
+that buffer fills up, the slow client is handled according to on_slow_client:
+
+ * ``SLOW_CLIENT_DISCONNECT`` - the client is disconnected, so that it
+   cannot hold up the other clients or use unbounded memory.
+ * ``SLOW_CLIENT_CONFLATE`` - only the latest frame for each key (by default
+   the sensor_id of the event) is kept, so that the client gets the latest
+   value of each sensor when it catches up. Events with different keys may
+   then arrive out of order. The client is only disconnected if there are
+   more than max_client_buffer distinct keys.
 """
 import asyncio
-# log = logging.getLogger(__name__)
-# formatter = logging.Formatter("%(asctime)s %(levelname)s " +
-#                               "[%(module)s:%(lineno)d] %(message)s")
-# log.setLevel(logging.DEBUG)
+import logging
+import struct
+from collections import deque, OrderedDict
 
-from thingflow.base import InputThing
+from thingflow.base import InputThing, OutputThing, EventLoopOutputThingMixin,\
+                           FatalError, ingress_clock
+from thingflow.codecs import get_codec
 
-clients = {}  # task -> (reader, writer)
+logger = logging.getLogger(__name__)
 
+DEFAULT_PORT = 2991
 
-class TcpStreamInputThing(InputThing):
-    
-    def __init__(self, loop, host=None, port=2991):
-        self.server = None
-        self.task = 0
-        self.clients = { }
-        self.host = host
-        self.port = 2991
+FRAMING_NEWLINE = 'newline'
+FRAMING_LENGTH = 'length'
 
-        self.loop = loop # TODO REMOVE
-        # set up tcp stream
-        self.server = loop.run_until_complete(
-            asyncio.streams.start_server(self._accept_client,
-                                         host, port, loop=loop))
+SLOW_CLIENT_DISCONNECT = 'disconnect'
+SLOW_CLIENT_CONFLATE = 'conflate'
 
-    def __str__(self):
-        return "TcpStreamInputThing[{0}, {1}]".format(self.host, self.port)
+# Number of frames held for a client whose transport buffer is full
+DEFAULT_MAX_CLIENT_BUFFER = 1000
 
-    def _accept_client(self, client_reader, client_writer):
-        """
-        This method accepts a new client connection and creates a Task
-        to handle this client.  self.clients is updated to keep track
-        of the new client.
+# High water mark (in bytes) for the transport buffer of each client
+DEFAULT_WRITE_BUFFER_LIMIT = 64*1024
+
+# Seconds to wait for clients to drain when the sink is closed, after which
+# they are disconnected.
+DEFAULT_CLOSE_TIMEOUT = 5.0
+
+_LENGTH = struct.Struct('!I')
+
+
+def _make_framer(framing):
+    if framing==FRAMING_NEWLINE:
+        return lambda payload: payload + b'\n'
+    elif framing==FRAMING_LENGTH:
+        pack = _LENGTH.pack
+        return lambda payload: pack(len(payload)) + payload
+    else:
+        raise ValueError("Unknown framing '%s', must be '%s' or '%s'" %
+                         (framing, FRAMING_NEWLINE, FRAMING_LENGTH))
+
+
+class _FrameParser:
+    """Split a byte stream into payloads. Data may be fed in arbitrary
+    chunks: partial frames are kept until the rest arrives.
+    """
+    def __init__(self, framing):
+        _make_framer(framing) # validate
+        self.framing = framing
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return the list of complete payloads after adding data.
         """
-        print("Accepting new client")
-        self.task = self.task + 1
-        self.clients[self.task] = (client_reader, client_writer)
+        buffer = self.buffer
+        buffer += data
+        if self.framing==FRAMING_NEWLINE:
+            end = buffer.rfind(b'\n')
+            if end<0:
+                return []
+            payloads = [line for line in bytes(buffer[:end]).split(b'\n')
+                        if line]
+            del buffer[:end+1]
+            return payloads
+        payloads = []
+        pos = 0
+        size = len(buffer)
+        unpack_from = _LENGTH.unpack_from
+        while size-pos>=4:
+            length = unpack_from(buffer, pos)[0]
+            if size-pos-4<length:
+                break
+            payloads.append(bytes(buffer[pos+4:pos+4+length]))
+            pos += 4+length
+        del buffer[:pos]
+        return payloads
+
+
+class _StreamClient(asyncio.Protocol):
+    """The connection to one client of a TcpStreamInputThing.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.transport = None
+        self.paused = False # transport buffer over the limit
+        self.closed = False
+        self.pending = OrderedDict() \
+                       if sink.on_slow_client==SLOW_CLIENT_CONFLATE else deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.sink.write_buffer_limit)
+        self.sink._client_connected(self)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.sink._client_disconnected(self)
 
-    def stop(self):
+    def data_received(self, data):
+        pass # clients do not send us anything
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._write_pending()
+
+    def send(self, frames, data):
+        """Send data, which is the concatenation of frames, a list of
+        (key, frame) pairs.
         """
-        Stops the TCP server, i.e. closes the listening socket(s).
-        This method runs the loop until the server sockets are closed.
+        if self.closed:
+            return
+        if not self.paused and len(self.pending)==0:
+            self.transport.write(data)
+            return
+        pending = self.pending
+        sink = self.sink
+        if sink.on_slow_client==SLOW_CLIENT_CONFLATE:
+            for (key, frame) in frames:
+                if key in pending:
+                    sink.conflated += 1
+                pending[key] = frame
+        else:
+            pending.extend([frame for (key, frame) in frames])
+        if len(pending)>sink.max_client_buffer:
+            sink._evict(self)
+
+    def _write_pending(self):
+        if self.closed or len(self.pending)==0:
+            return
+        pending = self.pending
+        frames = pending.values() if isinstance(pending, OrderedDict) \
+                 else pending
+        data = b''.join(frames)
+        pending.clear()
+        self.transport.write(data)
+
+    def close(self):
+        """Write the pending frames and close once the transport is drained.
         """
-        if self.server is not None:
-            self.server.close()
-            # TODO: do not have access to loop
-            self.loop.run_until_complete(self.server.wait_closed())
-            self.server = None
-
-    def on_next(self, msg):
-        # send message on tcp stream
-        print("tcp: on_next")
-        for task, (reader, writer) in self.clients.items():
-            try:
-                print("tcp: writing to client")
-                writer.write(str(msg).encode('utf-8'))
-                writer.write('\n'.encode('utf-8')) 
-                asyncio.async(writer.drain()) # can this raise exception?
-            except ConnectionResetError:
-                print("tcp: client disconnected")
-                del self.clients[task]
-        print("tcp: on_next done")
+        if not self.closed:
+            self._write_pending()
+            self.transport.close()
+
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self.pending.clear()
+            self.transport.abort()
+
+    def __str__(self):
+        if self.transport is None:
+            return 'client'
+        return 'client %s' % (self.transport.get_extra_info('peername'),)
+
+
+class TcpStreamInputThing(InputThing):
+    """A TCP server that sends each event it receives to all connected
+    clients. The server is started on the scheduler's event loop when the
+    scheduler runs. If port is 0, a free port is chosen: self.started is a
+    future whose result is the port, once the server is listening.
+
+    Events are encoded with codec (a name or instance from
+    thingflow.codecs) and framed as specified by framing. See the module
+    documentation for the framing options and the handling of slow clients
+    (max_client_buffer, on_slow_client, and write_buffer_limit). key
+    returns the conflation key of an event and defaults to its sensor_id.
+
+    As with AsyncInputThing, the sink registers itself as an active schedule.
+    When the stream completes (or the scheduler is stopped), we stop
+    accepting connections, send the buffered frames, and close the client
+    connections. Clients that have not drained after close_timeout seconds
+    are disconnected.
+
+    The evicted attribute counts the clients that were disconnected for
+    being too slow and conflated counts the frames that were replaced by a
+    later frame with the same key.
+    """
+    def __init__(self, scheduler, host=None, port=DEFAULT_PORT, codec='json',
+                 framing=FRAMING_NEWLINE,
+                 max_client_buffer=DEFAULT_MAX_CLIENT_BUFFER,
+                 on_slow_client=SLOW_CLIENT_DISCONNECT, key=None,
+                 write_buffer_limit=DEFAULT_WRITE_BUFFER_LIMIT,
+                 close_timeout=DEFAULT_CLOSE_TIMEOUT):
+        assert on_slow_client in (SLOW_CLIENT_DISCONNECT, SLOW_CLIENT_CONFLATE)
+        self.scheduler = scheduler
+        self.host = host
+        self.port = port
+        self.codec = get_codec(codec)
+        self.framer = _make_framer(framing)
+        self.max_client_buffer = max_client_buffer
+        self.on_slow_client = on_slow_client
+        self.key = key if key is not None else (lambda event: event.sensor_id)
+        self.write_buffer_limit = write_buffer_limit
+        self.close_timeout = close_timeout
+        self.clients = set()
+        self.frames = [] # (key, frame) pairs received in this loop pass
+        self.flush_scheduled = False
+        self.server = None
+        self.closing = False
+        self.done = False
+        self.close_timer = None
+        self.evicted = 0
+        self.conflated = 0
+        loop = scheduler.event_loop
+        self.started = loop.create_future()
+        scheduler._schedule_coroutine(
+            loop.create_server(lambda: _StreamClient(self), host, port),
+            self._server_started)
+        scheduler.active_schedules[self] = self.request_stop
+
+    def _server_started(self, future):
+        exc = None if future.cancelled() else future.exception()
+        if exc:
+            if self in self.scheduler.active_schedules:
+                del self.scheduler.active_schedules[self]
+            raise FatalError("%s: unable to start server: %s" % (self, exc))
+        self.server = future.result()
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set_result(self.port)
+        if self.closing:
+            self._close()
+
+    def _client_connected(self, client):
+        if self.closing:
+            client.transport.close()
+            return
+        self.clients.add(client)
+
+    def _client_disconnected(self, client):
+        self.clients.discard(client)
+        if self.closing:
+            self._check_done()
+
+    def _evict(self, client):
+        logger.warning("%s: disconnecting slow %s, %d frames buffered" %
+                       (self, client, len(client.pending)))
+        self.evicted += 1
+        self.clients.discard(client)
+        client.abort()
+
+    def _flush(self):
+        self.flush_scheduled = False
+        frames = self.frames
+        if len(frames)==0:
+            return
+        self.frames = []
+        if len(self.clients)==0:
+            return
+        data = b''.join([frame for (key, frame) in frames])
+        for client in list(self.clients):
+            client.send(frames, data)
+
+    def on_next(self, x):
+        if self.closing:
+            return
+        frame = self.framer(self.codec.encode(x))
+        key = self.key(x) if self.on_slow_client==SLOW_CLIENT_CONFLATE \
+              else None
+        self.frames.append((key, frame))
+        if not self.flush_scheduled:
+            # Defer writing, so that the events of this pass of the event
+            # loop are written together.
+            self.flush_scheduled = True
+            self.scheduler.event_loop.call_soon(self._flush)
 
     def on_error(self, e):
-        # close tcp connection
-        self.stop()
-        print(e)
+        logger.error("%s: closing due to error in stream: %s" % (self, e))
+        self.request_stop()
 
     def on_completed(self):
-        # close tcp connection 
-        self.stop()
+        self.request_stop()
+
+    def request_stop(self):
+        """Stop accepting events and connections, and close the client
+        connections once the buffered frames have been sent.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        self._flush()
+        if self.server is not None:
+            self._close()
+        # otherwise, _server_started() will call _close()
+
+    def _close(self):
+        self.server.close()
+        for client in list(self.clients):
+            client.close()
+        if len(self.clients)>0:
+            self.close_timer = self.scheduler.event_loop.call_later(
+                self.close_timeout, self._abort_clients)
+        self._check_done()
+
+    def _abort_clients(self):
+        self.close_timer = None
+        for client in list(self.clients):
+            logger.warning("%s: %s did not drain, disconnecting" %
+                           (self, client))
+            client.abort()
+        self.clients.clear()
+        self._check_done()
+
+    def _check_done(self):
+        if self.done or len(self.clients)>0 or self.server is None:
+            return
+        self.done = True
+        if self.close_timer is not None:
+            self.close_timer.cancel()
+            self.close_timer = None
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
 
+    def __str__(self):
+        return 'TcpStreamInputThing(%s, %s)' % (self.host, self.port)
+
+
+class _ReaderProtocol(asyncio.Protocol):
+    def __init__(self, reader):
+        self.reader = reader
+
+    def data_received(self, data):
+        self.reader._data_received(data)
+
+    def connection_lost(self, exc):
+        self.reader._connection_lost(exc)
+
+
+class TcpStreamReader(OutputThing, EventLoopOutputThingMixin):
+    """Connect to a TCP stream (e.g. from TcpStreamInputThing) and dispatch
+    the events it contains. codec and framing must match those of the
+    sender. Schedule via Scheduler.schedule_on_main_event_loop().
+
+    The events of each chunk of data read from the socket are decoded
+    together. If batches is True, they are dispatched as a single list,
+    otherwise they are dispatched one at a time.
+
+    When the server closes the connection, on_completed is dispatched. If
+    the connection is lost due to an error, the error is dispatched instead.
+    Stopping the schedule closes the connection.
+    """
+    def __init__(self, host, scheduler, port=DEFAULT_PORT, codec='json',
+                 framing=FRAMING_NEWLINE, batches=False):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.scheduler = scheduler
+        self.codec = get_codec(codec)
+        self.parser = _FrameParser(framing)
+        self.batches = batches
+        self.transport = None
+        self.stop_requested = False
+        self.events_received = 0
+
+    def _observe_event_loop(self):
+        if self.stop_requested:
+            self._connection_lost(None)
+            return
+        loop = self.scheduler.event_loop
+        self.scheduler._schedule_coroutine(
+            loop.create_connection(lambda: _ReaderProtocol(self), self.host,
+                                   self.port),
+            self._connect_done)
+
+    def _connect_done(self, future):
+        exc = None if future.cancelled() else future.exception()
+        if exc:
+            if self in self.scheduler.active_schedules:
+                del self.scheduler.active_schedules[self]
+            raise FatalError("%s: unable to connect: %s" % (self, exc))
+        (self.transport, protocol) = future.result()
+        if self.stop_requested:
+            self.transport.close()
+
+    def _data_received(self, data):
+        payloads = self.parser.feed(data)
+        if len(payloads)==0 or self.stop_requested:
+            return
+        if ingress_clock.enabled:
+            ingress_clock.stamp()
+        events = self.codec.decode_many(payloads)
+        self.events_received += len(events)
+        if self.batches:
+            self._dispatch_next(events)
+        else:
+            for event in events:
+                if self.stop_requested:
+                    break # a downstream thing stopped us
+                self._dispatch_next(event)
+
+    def _connection_lost(self, exc):
+        self.transport = None
+        if exc is not None and not self.stop_requested:
+            self._dispatch_error(exc)
+        else:
+            self._dispatch_completed()
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+
+    def _stop_loop(self):
+        if self.stop_requested:
+            return
+        self.stop_requested = True
+        if self.transport is not None:
+            self.transport.close() # calls _connection_lost()
+
+    def __str__(self):
+        return 'TcpStreamReader(%s, %s)' % (self.host, self.port)
@@ -0,0 +1,343 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Receive events sent as UDP datagrams, e.g. by low-power sensors.
+
+UdpReader listens on one or more UDP sockets, using the scheduler's event
+loop. Each time a socket becomes readable, we read all the datagrams that
+are ready (up to max_batch), and the datagrams read in a pass of the event
+loop are decoded and dispatched together.
+
+If the events carry a sequence number, pass a function that extracts it as
+the sequence parameter. We then drop duplicate datagrams (within a window
+of recent sequence numbers) and track sequence gaps, late arrivals, and
+sender restarts. The statistics are kept per sender (by default, the source
+address of the datagrams) and are available via UdpReader.stats().
+"""
+import asyncio
+import logging
+import socket
+from collections import deque
+
+from thingflow.base import OutputThing, EventLoopOutputThingMixin,\
+                           FatalError, ingress_clock
+from thingflow.codecs import get_codec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 2992
+
+# Maximum number of datagrams read in one wakeup of a socket
+DEFAULT_MAX_BATCH = 256
+
+# Size of the receive buffer for each datagram
+DEFAULT_MAX_DATAGRAM_SIZE = 65535
+
+# Number of recent sequence numbers remembered per sender for
+# deduplication. A sequence number that is further behind than this is
+# taken to mean that the sender restarted.
+DEFAULT_DEDUP_WINDOW = 1024
+
+
+class SenderStats:
+    """Statistics for the datagrams received from one sender.
+
+    received - datagrams received, including duplicates and errors (if
+               UdpReader's sender function is used, events received)
+    events - events dispatched
+    duplicates - events dropped because their sequence number was seen
+    gaps - number of times the sequence number skipped ahead
+    missing - sequence numbers skipped and not (yet) received
+    late - events that arrived after a later sequence number
+    restarts - times the sequence number went back beyond the window
+    errors - datagrams that could not be decoded
+    """
+    __slots__ = ('received', 'events', 'duplicates', 'gaps', 'missing',
+                 'late', 'restarts', 'errors', 'highest', 'seen', 'seen_order')
+
+    def __init__(self):
+        self.received = 0
+        self.events = 0
+        self.duplicates = 0
+        self.gaps = 0
+        self.missing = 0
+        self.late = 0
+        self.restarts = 0
+        self.errors = 0
+        self.highest = None # highest sequence number received
+        self.seen = set() # sequence numbers in the window
+        self.seen_order = deque() # same, in the order received
+
+    def check_sequence(self, seq, window):
+        """Update the statistics for sequence number seq and return True if
+        the event should be dispatched, False if it is a duplicate.
+        """
+        highest = self.highest
+        if highest is None or seq>highest:
+            if highest is not None and seq>highest+1:
+                self.gaps += 1
+                self.missing += seq-highest-1
+            self.highest = seq
+        elif highest-seq>=window:
+            self.restarts += 1
+            self.highest = seq
+            self.seen.clear()
+            self.seen_order.clear()
+        elif seq in self.seen:
+            self.duplicates += 1
+            return False
+        else:
+            self.late += 1
+            if self.missing>0:
+                self.missing -= 1
+        seen = self.seen
+        order = self.seen_order
+        seen.add(seq)
+        order.append(seq)
+        while len(order)>window:
+            seen.discard(order.popleft())
+        return True
+
+    def to_dict(self):
+        return {'received':self.received, 'events':self.events,
+                'duplicates':self.duplicates, 'gaps':self.gaps,
+                'missing':self.missing, 'late':self.late,
+                'restarts':self.restarts, 'errors':self.errors}
+
+    def __repr__(self):
+        return 'SenderStats(%s)' % \
+            ', '.join(['%s=%s' % (k, v)
+                       for (k, v) in sorted(self.to_dict().items())])
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, reader, sock):
+        self.reader = reader
+        self.sock = sock
+
+    def datagram_received(self, data, addr):
+        self.reader._datagram_received(self.sock, data, addr)
+
+    def error_received(self, exc):
+        logger.warning("%s: error on socket: %s" % (self.reader, exc))
+
+
+class UdpReader(OutputThing, EventLoopOutputThingMixin):
+    """Dispatch the events received as UDP datagrams on host:port. Schedule
+    via Scheduler.schedule_on_main_event_loop(). If port is 0, a free port
+    is chosen: self.started is a future whose result is the port, once the
+    sockets are bound.
+
+    Each datagram is decoded with codec (a name or instance from
+    thingflow.codecs). If batched_datagrams is True, each datagram contains
+    a batch of events (see Codec.encode_batch()). Datagrams that cannot be
+    decoded are counted and dropped. If batches is True, the events read in
+    a pass of the event loop are dispatched as a single list, otherwise they
+    are dispatched one at a time.
+
+    If sequence is specified, it is called on each event to get its
+    sequence number, which is used for deduplication and gap tracking (see
+    SenderStats). sender is called on each event and its source address to
+    get the key for the statistics; by default the source address is used.
+
+    rcvbuf sets the size of the kernel receive buffer of each socket
+    (SO_RCVBUF), so that bursts are not dropped while the event loop is
+    busy. If num_sockets is greater than one, or reuse_port is True, the
+    sockets are bound with SO_REUSEPORT, and the kernel spreads the
+    datagrams across them. This also lets several worker processes, each
+    with its own UdpReader, share a port.
+    """
+    def __init__(self, scheduler, host='0.0.0.0', port=DEFAULT_PORT,
+                 codec='json', batched_datagrams=False, batches=False,
+                 sequence=None, sender=None, dedup_window=DEFAULT_DEDUP_WINDOW,
+                 rcvbuf=None, num_sockets=1, reuse_port=False,
+                 max_batch=DEFAULT_MAX_BATCH,
+                 max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+        super().__init__()
+        assert num_sockets>=1
+        self.reuse_port = reuse_port or num_sockets>1
+        if self.reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        self.scheduler = scheduler
+        self.host = host
+        self.port = port
+        self.codec = get_codec(codec)
+        self.batched_datagrams = batched_datagrams
+        self.batches = batches
+        self.sequence = sequence
+        self.sender = sender
+        self.dedup_window = dedup_window
+        self.rcvbuf = rcvbuf
+        self.num_sockets = num_sockets
+        self.max_batch = max_batch
+        self.max_datagram_size = max_datagram_size
+        self.transports = []
+        self.pending = [] # (data, addr) pairs read in this loop pass
+        self.flush_scheduled = False
+        self.stop_requested = False
+        self.senders = {} # map from sender key to SenderStats
+        self.started = scheduler.event_loop.create_future()
+
+    def _make_socket(self, port):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if self.rcvbuf is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                self.rcvbuf)
+            sock.bind((self.host, port))
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    async def _open(self):
+        loop = self.scheduler.event_loop
+        port = self.port
+        for i in range(self.num_sockets):
+            sock = self._make_socket(port)
+            port = sock.getsockname()[1] # use the same port for the rest
+            (transport, protocol) = await loop.create_datagram_endpoint(
+                lambda: _UdpProtocol(self, sock), sock=sock)
+            self.transports.append(transport)
+        return port
+
+    def _observe_event_loop(self):
+        if self.stop_requested:
+            self._finish()
+            return
+        self.scheduler._schedule_coroutine(self._open(), self._open_done)
+
+    def _open_done(self, future):
+        exc = None if future.cancelled() else future.exception()
+        if exc:
+            self._close_transports()
+            if self in self.scheduler.active_schedules:
+                del self.scheduler.active_schedules[self]
+            raise FatalError("%s: unable to open socket: %s" % (self, exc))
+        self.port = future.result()
+        self.started.set_result(self.port)
+        if self.stop_requested:
+            self._finish()
+
+    def _datagram_received(self, sock, data, addr):
+        if self.stop_requested:
+            return
+        pending = self.pending
+        pending.append((data, addr))
+        # Drain the other datagrams that are ready on this socket, rather
+        # than waiting for the event loop to call us once for each.
+        recvfrom = sock.recvfrom
+        max_size = self.max_datagram_size
+        max_batch = self.max_batch
+        while len(pending)<max_batch:
+            try:
+                pending.append(recvfrom(max_size))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.warning("%s: error on socket: %s" % (self, e))
+                break
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.scheduler.event_loop.call_soon(self._flush)
+
+    def _stats_for(self, key):
+        stats = self.senders.get(key)
+        if stats is None:
+            stats = self.senders[key] = SenderStats()
+        return stats
+
+    def _decode(self, datagrams):
+        """Return a list of (event, addr) pairs.
+        """
+        codec = self.codec
+        if not self.batched_datagrams:
+            try:
+                events = codec.decode_many([data for (data, addr) in datagrams])
+                return list(zip(events, [addr for (data, addr) in datagrams]))
+            except Exception:
+                pass # find the bad datagrams below
+        decode = codec.decode_batch if self.batched_datagrams else codec.decode
+        result = []
+        for (data, addr) in datagrams:
+            try:
+                value = decode(data)
+            except Exception as e:
+                self._stats_for(addr).errors += 1
+                logger.debug("%s: unable to decode datagram from %s: %s" %
+                             (self, addr, e))
+                continue
+            if self.batched_datagrams:
+                result.extend([(event, addr) for event in value])
+            else:
+                result.append((value, addr))
+        return result
+
+    def _flush(self):
+        self.flush_scheduled = False
+        datagrams = self.pending
+        if len(datagrams)==0:
+            return
+        self.pending = []
+        if ingress_clock.enabled:
+            ingress_clock.stamp()
+        sender = self.sender
+        sequence = self.sequence
+        window = self.dedup_window
+        if sender is None:
+            for (data, addr) in datagrams:
+                self._stats_for(addr).received += 1
+        events = []
+        for (event, addr) in self._decode(datagrams):
+            if sender is None:
+                stats = self._stats_for(addr)
+            else:
+                stats = self._stats_for(sender(event, addr))
+                stats.received += 1
+            if sequence is not None and \
+               not stats.check_sequence(sequence(event), window):
+                continue
+            stats.events += 1
+            events.append(event)
+        if len(events)==0:
+            return
+        if self.batches:
+            self._dispatch_next(events)
+        else:
+            for event in events:
+                if self.stop_requested:
+                    break # a downstream thing stopped us
+                self._dispatch_next(event)
+
+    def stats(self):
+        """Return a map from sender key to a dict of its statistics.
+        """
+        return dict([(key, stats.to_dict())
+                     for (key, stats) in self.senders.items()])
+
+    def _close_transports(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def _finish(self):
+        self._close_transports()
+        self._dispatch_completed()
+        if self in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self)
+
+    def _stop_loop(self):
+        if self.stop_requested:
+            return
+        self._flush() # dispatch what we have already read
+        self.stop_requested = True
+        if len(self.transports)>0 or self.started.done():
+            self._finish()
+        # otherwise, _observe_event_loop() or _open_done() will finish
+
+    def __str__(self):
+        return 'UdpReader(%s, %s)' % (self.host, self.port)
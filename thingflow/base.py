@@ -30,10 +30,10 @@ The key abstractions are:
 See the README.rst file for more details.
 """
 
-from collections import namedtuple
+from collections import namedtuple, deque
 import threading
 import time
-import queue
+import concurrent.futures
 import traceback as tb
 import logging
 logger = logging.getLogger(__name__)
@@ -160,6 +160,107 @@ class _Connection:
         return '_Connection(%s,%s)' % \
              (str(self.input_thing), str(self.input_port))
 
+
+
+class _WrappedConnection(_Connection):
+    """A connection that wraps another connection, e.g. to collect metrics.
+    original is the wrapped connection. rewrap(connection) creates the
+    same kind of wrapper around another connection, which lets us remove a
+    wrapper from the middle of a chain of wrappers (see _unwrap_connection()).
+    The handlers that are not specified are taken from the original.
+    """
+    __slots__ = ('original', 'rewrap')
+    def __init__(self, original, on_next=None, on_completed=None,
+                 on_error=None):
+        super().__init__(on_next if on_next else original.on_next,
+                         on_completed if on_completed else original.on_completed,
+                         on_error if on_error else original.on_error,
+                         original.input_thing, original.input_port)
+        self.original = original
+        self.rewrap = None
+
+
+def _has_wrapper(connection, wrapper_class):
+    """Return True if wrapper_class appears anywhere in the chain of
+    wrappers of the connection.
+    """
+    while isinstance(connection, _WrappedConnection):
+        if isinstance(connection, wrapper_class):
+            return True
+        connection = connection.original
+    return False
+
+
+def _unwrap_connection(connection, wrapper_class):
+    """Return the connection with all the wrappers of wrapper_class removed,
+    wherever they are in the chain. The wrappers above a removed one are
+    recreated around the connection below it.
+    """
+    if not isinstance(connection, _WrappedConnection):
+        return connection
+    inner = _unwrap_connection(connection.original, wrapper_class)
+    if isinstance(connection, wrapper_class):
+        return inner
+    elif inner is connection.original:
+        return connection
+    else:
+        return connection.rewrap(inner)
+
+
+def _wrap_connections(roots, wrapper_class, wrap_fn):
+    """Wrap the connections reachable from the roots that are not already
+    wrapped by wrapper_class. wrap_fn(output_thing, port, connection, path)
+    should return a wrapper_class instance around the connection, or None to
+    leave the connection alone. The path describes the connection, in the
+    format of OutputThing.print_downstream().
+
+    Returns a map from id(output_thing) to output_thing for all the things
+    visited, to be passed to _unwrap_connections().
+    """
+    visited = {}
+    def wrap(thing, port, connection, path):
+        wrapped = wrap_fn(thing, port, connection, path)
+        if wrapped is not None:
+            wrapped.rewrap = lambda inner: \
+                wrap(thing, port, inner, path) or inner
+        return wrapped
+    def wrap_from(thing, path):
+        if (not hasattr(thing, '__connections__')) or id(thing) in visited:
+            return
+        visited[id(thing)] = thing
+        new_connections = {}
+        for (port, connections) in thing.__connections__.items():
+            connections_for_port = []
+            for connection in connections:
+                if port=='default' and connection.input_port=='default':
+                    input_path = '%s => %s' % (path, connection.input_thing)
+                else:
+                    input_path = '%s [%s]=>[%s] %s' % \
+                                 (path, port, connection.input_port,
+                                  connection.input_thing)
+                wrap_from(connection.input_thing, input_path)
+                if not _has_wrapper(connection, wrapper_class):
+                    wrapped = wrap(thing, port, connection, input_path)
+                    if wrapped is not None:
+                        connection = wrapped
+                connections_for_port.append(connection)
+            new_connections[port] = connections_for_port
+        thing.__connections__ = new_connections
+    for root in roots:
+        wrap_from(root, str(root))
+    return visited
+
+
+def _unwrap_connections(things, wrapper_class):
+    """Remove the wrappers of wrapper_class from the connections of the
+    things (an iterable of OutputThings).
+    """
+    for thing in things:
+        thing.__connections__ = \
+            dict([(port, [_unwrap_connection(c, wrapper_class)
+                          for c in connections])
+                  for (port, connections) in thing.__connections__.items()])
+
     
 class OutputThing:
     """Base class for event generators (output things). The non-underscore
@@ -726,6 +827,8 @@ class IterableAsOutputThing(OutputThing, DirectOutputThingMixin):
     def _observe(self):
         try:
             event = self.iterable.__next__()
+            if ingress_clock.enabled:
+                ingress_clock.stamp()
         except StopIteration:
             self._close()
             self._dispatch_completed()
@@ -812,6 +915,137 @@ def from_func(init, cond, iter, selector):
 
 
 
+# time.monotonic_ns() is not available before Python 3.7
+_monotonic_ns = getattr(time, 'monotonic_ns', None) or \
+                (lambda: int(time.monotonic()*1000000000))
+
+
+class IngressClock:
+    """Side channel for end-to-end latency tracking (see thingflow.latency).
+    When enabled, sources call stamp() just before dispatching an event, to
+    record the (monotonic) time at which the event entered the system. The
+    stamp is kept per-thread rather than in the event itself, and remains
+    current while the event, and anything derived from it by filters, is
+    dispatched downstream. Sinks report their latencies by calling the
+    recorder with the stamp.
+
+    The stamp is cleared before the scheduler calls an OutputThing's
+    _observe() and is replaced for each call handed off to the event loop
+    thread, so that an event from a source which does not call stamp() is
+    never attributed to the ingress time of an earlier event.
+
+    When disabled (the default), the only cost to sources is a check
+    of the enabled attribute.
+    """
+    def __init__(self):
+        self.enabled = False
+        # Called as recorder(sink, ingress_ns, enqueue_ns, start_ns, end_ns)
+        self.recorder = None
+        self._local = threading.local()
+
+    def stamp(self):
+        self._local.ns = _monotonic_ns()
+
+    def get(self):
+        """Return the ingress time of the event currently being dispatched
+        on this thread, or None if not known.
+        """
+        return getattr(self._local, 'ns', None)
+
+    def set(self, ns):
+        self._local.ns = ns
+
+    def clear(self):
+        self._local.ns = None
+
+ingress_clock = IngressClock()
+
+
+# Maximum number of handed-off calls run by one drain of an inbox before
+# yielding to the event loop.
+_MAX_INBOX_DRAIN = 256
+
+
+class _ThreadsafeInbox:
+    """Hands off calls from a thread other than the event loop's (e.g. from
+    a blocking OutputThing running on a worker or an OutputThing with a
+    private event loop) to the event loop thread. The calls are appended to a
+    deque, which is safe without locking. Only the first call into an empty
+    inbox wakes up the event loop (via call_soon_threadsafe()), and a single
+    drain callback then runs all the pending calls, so bursts of events do
+    not cost one wakeup and one Handle each.
+
+    The enqueue() method is the enqueue function passed to
+    OutputThing._schedule(). If latency tracking is enabled, the ingress time
+    of each event is passed along to the event loop thread. If the lag
+    monitor is enabled, each call is timed on behalf of the owner.
+    """
+    def __init__(self, scheduler, owner):
+        self.scheduler = scheduler
+        self.owner = owner
+        self.items = deque()
+        self.drain_scheduled = False
+        self.enqueued = 0
+        self.drains = 0
+        self.max_depth = 0
+
+    def enqueue(self, fn, *args):
+        items = self.items
+        items.append((fn, args,
+                      ingress_clock.get() if ingress_clock.enabled else None))
+        self.enqueued += 1
+        depth = len(items)
+        if depth>self.max_depth:
+            self.max_depth = depth
+        # We check the flag after appending and the drain clears it before
+        # taking items, so an item is never left without a drain pending.
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.scheduler.event_loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        self.drain_scheduled = False
+        self.drains += 1
+        try:
+            self._run(_MAX_INBOX_DRAIN)
+        finally:
+            if len(self.items)>0 and not self.drain_scheduled:
+                self.drain_scheduled = True
+                self.scheduler.event_loop.call_soon(self._drain)
+
+    def _run(self, max_calls):
+        items = self.items
+        monitor = self.scheduler.lag_monitor
+        n = 0
+        while max_calls is None or n<max_calls:
+            try:
+                (fn, args, ingress_ns) = items.popleft()
+            except IndexError:
+                return
+            n += 1
+            # always replace the stamp (None if the event had none), so we
+            # don't leave the one from the previous call in place
+            ingress_clock.set(ingress_ns)
+            if monitor is None:
+                fn(*args)
+            else:
+                monitor.timed_call(self.owner, fn, *args)
+
+    def flush(self):
+        """Run all the pending calls now. This must be called from the event
+        loop thread. It is used to deliver any remaining events before the
+        owner's schedule is checked or removed.
+        """
+        self._run(None)
+
+    def stats(self):
+        return {'thing':str(self.owner), 'depth':len(self.items),
+                'max_depth':self.max_depth, 'enqueued':self.enqueued,
+                'drains':self.drains,
+                'mean_batch':self.enqueued/self.drains if self.drains>0
+                             else None}
+
+
 # Define a default sensor event as a tuple of sensor id, timestamp, and value.
 SensorEvent = namedtuple('SensorEvent', ['sensor_id', 'ts', 'val'])
 
@@ -839,8 +1073,10 @@ class SensorAsOutputThing(OutputThing, DirectOutputThingMixin):
         
     def _observe(self):
         try:
-            self._dispatch_next(self.make_event_fn(self.sensor,
-                                                   self.sensor.sample()))
+            sample = self.sensor.sample()
+            if ingress_clock.enabled:
+                ingress_clock.stamp()
+            self._dispatch_next(self.make_event_fn(self.sensor, sample))
         except FatalError:
             raise
         except StopIteration:
@@ -854,9 +1090,12 @@ class SensorAsOutputThing(OutputThing, DirectOutputThingMixin):
 
 class BlockingInputThing:
     """This implements a InputThing which may potential block when sending an
-    event outside the system. The InputThing is run on a separate thread. We
+    event outside the system. The InputThing's work is run on the scheduler's
+    shared pool of blocking workers (see Scheduler.max_blocking_workers). We
     create proxy methods for each port that can be called directly - these
-    methods just queue up the call to run in the worker thread. 
+    methods just queue up the call to run on a worker. Requests for a given
+    InputThing are processed in order and by at most one worker at a time, so
+    the implementation does not need to be thread-safe.
 
     The actual implementation of the InputThing goes in the _on_next,
     _on_completed, and _on_error methods. Note that we don't dispatch to separate
@@ -864,6 +1103,10 @@ class BlockingInputThing:
     just a message field rather than as a separate destination in the lower
     layers.
     """
+    # We record our own latencies, from the time a request was queued
+    # (see thingflow.latency).
+    _records_latency = True
+
     def __init__(self, scheduler, ports=None):
         if ports==None:
             self.ports = ['default',]
@@ -873,37 +1116,54 @@ class BlockingInputThing:
         # create local proxy methods for each port
         for port in self.ports:
             setattr(self, _on_next_name(port),
-                    lambda x: self.__queue__.put((self._on_next, False,
-                                                     [port, x]),))
+                    lambda x, port=port: self._enqueue_request((self._on_next, False,
+                                                                [port, x]),))
             setattr(self, _on_completed_name(port),
-                    lambda: self.__queue__.put((self._on_completed, True,
-                                                [port]),))
+                    lambda port=port: self._enqueue_request((self._on_completed, True,
+                                                             [port]),))
             setattr(self, _on_error_name(port),
-                    lambda e: self.__queue__.put((self._on_error, True,
-                                                  [port, e]),))
-        self.__queue__ = queue.Queue()
+                    lambda e, port=port: self._enqueue_request((self._on_error, True,
+                                                                [port, e]),))
+        self.__queue__ = deque()
+        self.__lock__ = threading.Lock()
+        self.__draining__ = False # True while a worker owns the queue
+        self.stopped = False
         self.scheduler = scheduler
-        self.thread = _ThreadForBlockingInputThing(self, scheduler)
         self.scheduler.active_schedules[self] = self.request_stop
-        def start():
-            self.thread.start()
-        self.scheduler.event_loop.call_soon(start)
 
     def request_stop(self):
-        """This can be called to stop the thread before it is automatically
+        """This can be called to stop processing before it is automatically
         stopped when all ports are closed. The close() method will be
         called and the InputThing cannot be restarted later.
         """
-        if self.thread==None:
-            return # no thread to stop
-        self.__queue__.put(None) # special stop token
-
-    def _wait_and_dispatch(self):
-        """Called by main loop of blocking thread to block for a request
-        and then dispatch it. Returns True if it processed a normal request
-        and False if it got a stop message or there is no more events possible.
+        if self.stopped:
+            return # nothing to stop
+        self._enqueue_request(None) # special stop token
+
+    def _enqueue_request(self, action):
+        """Add a request to our queue. If no worker is currently processing
+        the queue, submit a drain job to the scheduler's blocking worker pool.
+        If latency tracking is enabled, we also queue the event's ingress time
+        and the time it was queued.
+        """
+        if ingress_clock.enabled:
+            stamp = (ingress_clock.get(), _monotonic_ns())
+        else:
+            stamp = None
+        with self.__lock__:
+            if self.stopped:
+                return
+            self.__queue__.append((action, stamp))
+            if self.__draining__:
+                return
+            self.__draining__ = True
+        self.scheduler._get_blocking_executor().submit(self._drain)
+
+    def _dispatch_request(self, action):
+        """Dispatch a single request from our queue. Returns True if it
+        processed a normal request and False if it got a stop message or there
+        are no more events possible.
         """
-        action = self.__queue__.get()
         if action is not None:
             (method, closing_port, args) = action
             method(*args)
@@ -917,18 +1177,70 @@ class BlockingInputThing:
             return True # more work possible
         else:
             return False # stop requested
-        
-        
+
+    def _drain(self):
+        """Called on a blocking worker to process the queued requests. To be
+        fair to the other blocking things sharing the pool, we process at most
+        _MAX_REQUESTS_PER_DRAIN requests and then resubmit ourself to the back
+        of the pool's work queue.
+        """
+        scheduler = self.scheduler
+        try:
+            for i in range(_MAX_REQUESTS_PER_DRAIN):
+                with self.__lock__:
+                    if len(self.__queue__)==0:
+                        self.__draining__ = False
+                        return
+                    (action, stamp) = self.__queue__.popleft()
+                if stamp is None:
+                    more = self._dispatch_request(action)
+                else:
+                    start_ns = _monotonic_ns()
+                    more = self._dispatch_request(action)
+                    recorder = ingress_clock.recorder
+                    if recorder is not None and action is not None and \
+                       not action[1]: # only record on_next requests
+                        recorder(self, stamp[0], stamp[1], start_ns,
+                                 _monotonic_ns())
+                if not more:
+                    break
+            else:
+                scheduler._get_blocking_executor().submit(self._drain)
+                return
+        except Exception as e:
+            msg = "_drain for %s exited with error: %s" % (self, e)
+            logger.exception(msg)
+            self._stop_draining()
+            # e is deleted at the end of the except block, so save it for die()
+            error = e
+            def die(): # need to stop the scheduler in the main loop
+                del scheduler.active_schedules[self]
+                raise ScheduleError(msg) from error
+            scheduler.event_loop.call_soon_threadsafe(die)
+        else:
+            self._stop_draining()
+            def done():
+                if self in scheduler.active_schedules:
+                    scheduler._remove_from_active_schedules(self)
+            scheduler.event_loop.call_soon_threadsafe(done)
+
+    def _stop_draining(self):
+        with self.__lock__:
+            self.stopped = True
+            self.__queue__.clear()
+            self.__draining__ = False
+        self._close()
+
     def _on_next(self, port, x):
-        """Process the on_next event. Called in blocking thread."""
+        """Process the on_next event. Called in a blocking worker."""
         pass
 
     def _on_completed(self, port):
-        """Process the on_completed event. Called in blocking thread."""
+        """Process the on_completed event. Called in a blocking worker."""
         pass
 
     def _on_error(self, port, e):
-        """Process the on_error event. Called in blocking thread."""
+        """Process the on_error event. Called in a blocking worker."""
         pass
 
     def _close(self):
@@ -937,96 +1249,251 @@ class BlockingInputThing:
         """
         pass
 
-    
-class _ThreadForBlockingInputThing(threading.Thread):
-    """Background thread for a InputThing that passes events to the
-    external world and might block.
-    """
-    def __init__(self, input_thing, scheduler):
-        self.input_thing = input_thing
-        self.scheduler= scheduler
-        self.stop_requested = False
-        super().__init__()
+# Maximum number of requests a BlockingInputThing processes before yielding
+# its worker to the other things sharing the blocking worker pool.
+_MAX_REQUESTS_PER_DRAIN = 64
 
-    def run(self):
-        try:
-            more = True
-            while more:
-                more = self.input_thing._wait_and_dispatch()                
-        except Exception as e:
-            msg = "_wait_and_dispatch for %s exited with error: %s" % \
-                  (self.input_thing, e)
-            logger.exception(msg)
-            self.input_thing._close()
-            self.input_thing.thread = None # disassociate this thread
-            def die(): # need to stop the scheduler in the main loop
-                del self.scheduler.active_schedules[self.input_thing]
-                raise ScheduleError(msg) from e
-            self.scheduler.event_loop.call_soon_threadsafe(die)
-        else:
-            self.input_thing._close()
-            self.input_thing.thread = None # disassociate this thread
-            def done():
-                self.scheduler._remove_from_active_schedules(self.input_thing)
-            self.scheduler.event_loop.call_soon_threadsafe(done)
-                
 
-
-class _ThreadForBlockingOutputThing(threading.Thread):
-    """Background thread for OutputThings that might block.
+class _BlockingOutputThingSchedule:
+    """Runs the _observe() calls of an OutputThing that might block on
+    the scheduler's shared pool of blocking workers. The event loop acts as
+    the deadline scheduler: when a sample completes, we arm the next one
+    via call_at() for one interval after the start of the previous sample.
+    There is at most one outstanding _observe() call per OutputThing.
     """
     def __init__(self, output_thing, interval, scheduler):
         self.output_thing = output_thing
         self.interval = interval
         self.scheduler = scheduler
         self.stop_requested = False
-        super().__init__()
+        self.handle = None # timer for the next sample
+        self.running = False # True while _observe() is running on a worker
+        self.inbox = None # created in start()
+        self.start_time = None
 
     def _stop_loop(self):
         self.stop_requested = True
+        if self.handle is not None:
+            # waiting for the next deadline, no sample in progress
+            self.handle.cancel()
+            self.handle = None
+            self.scheduler.event_loop.call_soon(self._done)
+
+    def start(self):
+        self.inbox = self.scheduler._make_inbox(self.output_thing)
+        self.output_thing._schedule(enqueue_fn=self.inbox.enqueue)
+        self._sample()
+
+    def _sample(self):
+        self.handle = None
+        if self.stop_requested:
+            self._done()
+            return
+        loop = self.scheduler.event_loop
+        self.start_time = loop.time()
+        self.running = True
+        f = loop.run_in_executor(self.scheduler._get_blocking_executor(),
+                                 self._observe)
+        f.add_done_callback(self._sample_done)
 
-    def run(self):
-        def enqueue_fn(fn, *args):
-            self.scheduler.event_loop.call_soon_threadsafe(fn, *args)
-        self.output_thing._schedule(enqueue_fn=enqueue_fn)
-            
-        try:
-            while True:
-                if self.stop_requested:
-                    break
-                start = time.time()
-                self.output_thing._observe()
-                if self.output_thing._has_connections():
-                    break
-                time_left = self.interval - (time.time() - start)
-                if time_left > 0 and (not self.stop_requested):
-                    time.sleep(time_left)
-        except Exception as e:
+    def _observe(self):
+        # Runs on a worker thread, which may still have the stamp of an
+        # event from the previous OutputThing that it ran.
+        if ingress_clock.enabled:
+            ingress_clock.clear()
+        self.output_thing._observe()
+
+    def _sample_done(self, f):
+        # Deliver any events dispatched by _observe() that are still in the
+        # inbox, so they are seen before we check the connections.
+        self.inbox.flush()
+        self.running = False
+        if f.cancelled():
+            self._done()
+            return
+        e = f.exception()
+        if e is not None:
             msg = "_observe for %s exited with error" % self.output_thing
-            logger.exception(msg)
-            def die(): # need to stop the scheduler in the main loop
+            logger.error(msg, exc_info=e)
+            if self.output_thing in self.scheduler.active_schedules:
                 del self.scheduler.active_schedules[self.output_thing]
-                raise ScheduleError(msg) from e
-            self.scheduler.event_loop.call_soon_threadsafe(die)
+            raise ScheduleError(msg) from e
+        if self.stop_requested or (not self.output_thing._has_connections()):
+            self._done()
         else:
-            def done():
-                self.scheduler._remove_from_active_schedules(self.output_thing)
-            self.scheduler.event_loop.call_soon_threadsafe(done)
-            
-            
+            self.handle = self.scheduler.event_loop.call_at(
+                self.start_time + self.interval, self._sample)
+
+    def _done(self):
+        if self.output_thing in self.scheduler.active_schedules:
+            self.scheduler._remove_from_active_schedules(self.output_thing)
+
+
 class ScheduleError(FatalError):
     pass
 
 
+# Default size of the worker pool shared by blocking OutputThings and
+# InputThings.
+DEFAULT_MAX_BLOCKING_WORKERS = 8
+
+# Priority classes for Scheduler.schedule_recurring(). A class is only run
+# when all the classes with lower numbers have nothing to run.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# The recurring OutputThings are run for at most this many seconds before
+# yielding to the event loop, so that timer-based schedules (e.g. periodic
+# sensors) and I/O callbacks are not delayed by more than this.
+DEFAULT_RECURRING_TIME_SLICE = 0.005
+
+# Each time a recurring OutputThing gets its turn, it may run for
+# weight*quantum seconds (deficit round-robin).
+DEFAULT_RECURRING_QUANTUM = 0.001
+
+
+class _RecurringSchedule:
+    """The state of an OutputThing scheduled by schedule_recurring().
+    """
+    __slots__ = ('output_thing', 'priority', 'weight', 'deficit', 'in_turn',
+                 'cancelled')
+    def __init__(self, output_thing, priority, weight):
+        self.output_thing = output_thing
+        self.priority = priority
+        self.weight = weight
+        self.deficit = 0     # nanoseconds of run time remaining in this turn
+        self.in_turn = False
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _RecurringRunQueue:
+    """Runs the OutputThings scheduled via Scheduler.schedule_recurring().
+    Rather than each OutputThing re-arming itself with call_soon(), a single
+    callback runs the OutputThings for up to time_slice seconds and then
+    yields to the event loop.
+
+    Priority classes are served in strict priority order. Within a class, we
+    use deficit round-robin, where the cost of an _observe() call is its
+    measured run time: when an OutputThing gets its turn, its deficit is
+    increased by weight*quantum and it is observed until the deficit is used
+    up. Any overrun is carried over to its next turn. Thus, over time, each
+    OutputThing in a class gets a share of the run time proportional to its
+    weight, regardless of how expensive its events are.
+    """
+    def __init__(self, scheduler, time_slice, quantum):
+        self.scheduler = scheduler
+        self.time_slice_ns = int(time_slice*1000000000)
+        self.quantum_ns = int(quantum*1000000000)
+        self.queues = {} # map from priority to deque of _RecurringSchedules
+        self.priorities = [] # sorted list of the priorities in queues
+        self.handle = None
+
+    def add(self, schedule):
+        if schedule.priority not in self.queues:
+            self.queues[schedule.priority] = deque()
+            self.priorities = sorted(self.queues.keys())
+        self.queues[schedule.priority].append(schedule)
+        if self.handle is None:
+            self.handle = self.scheduler.event_loop.call_soon(self._run)
+
+    def _next_queue(self):
+        for priority in self.priorities:
+            queue = self.queues[priority]
+            if len(queue)>0:
+                return queue
+        return None
+
+    def resume(self):
+        """Start running the OutputThings again after a sink's queue has
+        drained (see Scheduler._set_congested()).
+        """
+        if self.handle is None and self._next_queue() is not None:
+            self.handle = self.scheduler.event_loop.call_soon(self._run)
+
+    def _run(self):
+        self.handle = None
+        deadline = _monotonic_ns() + self.time_slice_ns
+        congested = self.scheduler.congested
+        while True:
+            if len(congested)>0:
+                return # resume() is called once the sinks have caught up
+            queue = self._next_queue()
+            if queue is None:
+                return
+            if _monotonic_ns()>=deadline:
+                self.handle = self.scheduler.event_loop.call_soon(self._run)
+                return
+            schedule = queue[0]
+            if schedule.cancelled:
+                queue.popleft()
+                continue
+            if not schedule.in_turn:
+                schedule.deficit += schedule.weight*self.quantum_ns
+                if schedule.deficit<=0:
+                    # still paying off an earlier overrun
+                    queue.rotate(-1)
+                    continue
+                schedule.in_turn = True
+            self._observe(schedule)
+            if schedule.cancelled:
+                queue.popleft()
+            elif schedule.deficit<=0:
+                schedule.in_turn = False
+                queue.rotate(-1)
+
+    def _observe(self, schedule):
+        output_thing = schedule.output_thing
+        scheduler = self.scheduler
+        start = _monotonic_ns()
+        if ingress_clock.enabled:
+            ingress_clock.clear()
+        try:
+            if scheduler.lag_monitor is None:
+                output_thing._observe()
+            else:
+                scheduler.lag_monitor.timed_call(output_thing,
+                                                 output_thing._observe)
+        except:
+            schedule.cancel()
+            raise
+        schedule.deficit -= _monotonic_ns() - start
+        if (not schedule.cancelled) and \
+           (not output_thing._has_connections()):
+            schedule.cancel()
+            if scheduler.active_schedules.get(output_thing) is schedule:
+                scheduler._remove_from_active_schedules(output_thing)
+
 class Scheduler:
     """Wrap an asyncio event loop and provide methods for various kinds of
     periodic scheduling.
+
+    OutputThings and InputThings that might block (scheduled through
+    schedule_periodic_on_separate_thread(), schedule_sensor_on_separate_thread(),
+    or subclassing BlockingInputThing) do not get their own threads. Instead,
+    they share a pool of at most max_blocking_workers threads.
     """
-    def __init__(self, event_loop):
+    def __init__(self, event_loop, max_blocking_workers=DEFAULT_MAX_BLOCKING_WORKERS,
+                 recurring_time_slice=DEFAULT_RECURRING_TIME_SLICE,
+                 recurring_quantum=DEFAULT_RECURRING_QUANTUM):
         self.event_loop = event_loop
+        self.max_blocking_workers = max_blocking_workers
+        self.recurring = _RecurringRunQueue(self, recurring_time_slice,
+                                            recurring_quantum)
+        self.blocking_executor = None # created on first use
+        self.graph_metrics = None # see enable_metrics()
+        self.latency_tracker = None # see enable_latency_tracking()
+        self.lag_monitor = None # see enable_lag_monitor()
+        self.inboxes = [] # see _make_inbox()
         self.active_schedules = {} # mapping from task to schedule handle
         self.pending_futures = {}
         self.next_future_id = 1
+        # Sinks whose bounded queues are full, see _set_congested()
+        self.congested = set()
+        self.capacity_waiters = []
         # Set the following to an exception if we are exiting the loop due to
         # an exception. We will then raise a SchedulerError when the event loop
         # exits.
@@ -1035,10 +1502,61 @@ class Scheduler:
         # break out of the event loop if we get an unexpected error.
         def exception_handler(loop, context):
             assert loop==self.event_loop
+            if 'exception' not in context:
+                # just a warning from the event loop
+                loop.default_exception_handler(context)
+                return
             self.fatal_error = context['exception']
             self.stop()
         self.event_loop.set_exception_handler(exception_handler)
 
+    def _make_inbox(self, owner):
+        """Create the inbox used to hand off the calls of an OutputThing
+        running on another thread. The inboxes are kept for metrics().
+        """
+        inbox = _ThreadsafeInbox(self, owner)
+        self.inboxes.append(inbox)
+        return inbox
+
+    def _set_congested(self, sink, congested):
+        """Called by sinks with bounded queues that apply backpressure (see
+        OVERFLOW_BLOCK in thingflow.adapters.async_generic) when their queue
+        fills up and when it has drained again. While any sink is congested,
+        the OutputThings scheduled via schedule_recurring() are not run and
+        the coroutines of the asyncio-based sources wait in
+        _wait_for_capacity(). Sources driven by timers or running on other
+        threads are not held back.
+        """
+        if congested:
+            self.congested.add(sink)
+            return
+        self.congested.discard(sink)
+        if len(self.congested)==0:
+            self.recurring.resume()
+            waiters = self.capacity_waiters
+            self.capacity_waiters = []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def _wait_for_capacity(self):
+        """Wait until no sink is congested. To avoid the cost of a coroutine
+        call per event, callers should check the congested set first.
+        """
+        while len(self.congested)>0:
+            waiter = self.event_loop.create_future()
+            self.capacity_waiters.append(waiter)
+            await waiter
+
+    def _get_blocking_executor(self):
+        """Return the thread pool shared by blocking OutputThings and
+        InputThings, creating it if needed.
+        """
+        if self.blocking_executor is None:
+            self.blocking_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_blocking_workers)
+        return self.blocking_executor
+
     def _remove_from_active_schedules(self, output_thing):
         """Remove the specified OutputThing from the active_schedules map.
         If there are no more active schedules, we will request exiting of
@@ -1063,7 +1581,13 @@ class Scheduler:
             self._remove_from_active_schedules(output_thing)
         def run():
             assert output_thing in self.active_schedules
-            output_thing._observe()
+            if ingress_clock.enabled:
+                ingress_clock.clear()
+            if self.lag_monitor is None:
+                output_thing._observe()
+            else:
+                self.lag_monitor.timed_call(output_thing,
+                                            output_thing._observe)
             more = output_thing._has_connections()
             if not more and output_thing in self.active_schedules:
                 self._remove_from_active_schedules(output_thing)
@@ -1095,7 +1619,8 @@ class Scheduler:
             output_thing.print_downstream() # just for debugging
         return self.schedule_periodic(output_thing, interval)
     
-    def schedule_recurring(self, output_thing):
+    def schedule_recurring(self, output_thing, priority=PRIORITY_NORMAL,
+                           weight=1):
         """Takes a DirectOutputThingMixin and calls _observe() to get events. If,
         after the call, there are no downstream connections, the scheduler will
         deschedule the output thing.
@@ -1105,31 +1630,33 @@ class Scheduler:
         that runs in a separate thread (e.g. schedule_recuring_separate_thread()
         or schedule_periodic_separate_thread()).
 
+        The recurring OutputThings share the event loop as follows: they are
+        run in time slices (see DEFAULT_RECURRING_TIME_SLICE), between which
+        timer-based schedules such as schedule_periodic() and I/O callbacks
+        run. Within a time slice, an OutputThing is only run if no OutputThings
+        in a higher priority class (PRIORITY_HIGH, PRIORITY_NORMAL, or
+        PRIORITY_BACKGROUND) are waiting, and OutputThings of the same
+        priority get a share of the run time proportional to their weight.
+        Thus, a bulk replay scheduled with PRIORITY_BACKGROUND only uses the
+        capacity left over by the other schedules.
+
         Returns a callable that can be used to remove the OutputThing from the
         scheduler.
         """
+        assert weight>0, "weight must be positive"
         def cancel():
             print("canceling schedule of %s" % output_thing)
             try:
-                handle = self.active_schedules[output_thing]
+                schedule = self.active_schedules[output_thing]
             except KeyError:
                 raise ScheduleError("Attempt to de-schedule OutputThing %s, which does not have an active schedule" %
                                     output_thing)
-            handle.cancel()
+            schedule.cancel()
             self._remove_from_active_schedules(output_thing)
-        def run():
-            assert output_thing in self.active_schedules
-            output_thing._observe()
-            more = output_thing._has_connections()
-            if not more and output_thing in self.active_schedules:
-                self._remove_from_active_schedules(output_thing)
-            elif output_thing in self.active_schedules:
-                handle = self.event_loop.call_soon(run)
-                self.active_schedules[output_thing] = handle
-                output_thing._schedule(enqueue_fn=None)
-        handle = self.event_loop.call_soon(run)
-        self.active_schedules[output_thing] = handle
+        schedule = _RecurringSchedule(output_thing, priority, weight)
+        self.active_schedules[output_thing] = schedule
         output_thing._schedule(enqueue_fn=None)
+        self.recurring.add(schedule)
         return cancel
 
     def schedule_on_main_event_loop(self, output_thing):
@@ -1152,22 +1679,26 @@ class Scheduler:
         Returns a callable that can be used to unschedule the OutputThing, by
         requesting that the event loop stop.
         """
-        def enqueue_fn(fn, *args):
-            self.event_loop.call_soon_threadsafe(fn, *args)
+        inbox = self._make_inbox(output_thing)
         def thread_main():
             try:
-                output_thing._schedule(enqueue_fn=enqueue_fn)
+                output_thing._schedule(enqueue_fn=inbox.enqueue)
                 # ok, lets run the event loop
                 output_thing._observe_event_loop()
             except Exception as e:
                 msg = "Event loop for %s exited with error" % output_thing
                 logger.exception(msg)
+                # e is deleted at the end of the except block, so save it
+                # for die()
+                error = e
                 def die(): # need to stop the scheduler in the main loop
+                    inbox.flush()
                     del self.active_schedules[output_thing]
-                    raise ScheduleError(msg) from e
+                    raise ScheduleError(msg) from error
                 self.event_loop.call_soon_threadsafe(die)
             else:
                 def loop_done():
+                    inbox.flush()
                     self._remove_from_active_schedules(output_thing)
                 self.event_loop.call_soon_threadsafe(loop_done)
                     
@@ -1177,15 +1708,16 @@ class Scheduler:
         return output_thing._stop_loop
 
     def schedule_periodic_on_separate_thread(self, output_thing, interval):
-        """Schedule an OutputThing to run in a separate thread. It should
-        implement the DirectOutputThingMixin.
-        Returns a callable that can be used to unschedule the OutputThing, by
-        requesting that the child thread stop.
+        """Schedule an OutputThing whose _observe() method might block. It should
+        implement the DirectOutputThingMixin. The _observe() calls are run on
+        the scheduler's shared pool of blocking workers and the events are
+        dispatched to the connected InputThings on the main thread.
+        Returns a callable that can be used to unschedule the OutputThing.
         """
-        t = _ThreadForBlockingOutputThing(output_thing, interval, self)
-        self.active_schedules[output_thing] = t._stop_loop
-        self.event_loop.call_soon(t.start)
-        return t._stop_loop
+        s = _BlockingOutputThingSchedule(output_thing, interval, self)
+        self.active_schedules[output_thing] = s._stop_loop
+        self.event_loop.call_soon(s.start)
+        return s._stop_loop
 
     def schedule_sensor_on_separate_thread(self, sensor, interval, *input_thing_sequence,
                                            make_event_fn=make_sensor_event):
@@ -1219,12 +1751,110 @@ class Scheduler:
             # Note that the _observe() call could potentially reschedule the
             # OutputThing through another call to the scheduler.
             self._remove_from_active_schedules(output_thing)
+            if ingress_clock.enabled:
+                ingress_clock.clear()
             output_thing._observe()
         handle = self.event_loop.call_later(interval, run)
         self.active_schedules[output_thing] = handle
         output_thing._schedule(enqueue_fn=None)
         return cancel
     
+    def enable_metrics(self, *roots):
+        """Start collecting metrics (event counts and processing times) for all
+        the things reachable from the active schedules, plus any additional
+        OutputThings passed as roots. Call this after setting up the graph, or
+        call it again to include connections made since the last call. See
+        thingflow.metrics for details.
+        """
+        from thingflow.metrics import GraphMetrics
+        if self.graph_metrics is None:
+            self.graph_metrics = GraphMetrics()
+        self.graph_metrics.instrument(list(self.active_schedules.keys()) +
+                                      list(roots))
+
+    def disable_metrics(self):
+        """Stop collecting metrics. This removes all instrumentation, so there
+        is no runtime cost. The metrics collected so far are still available
+        through metrics().
+        """
+        if self.graph_metrics is not None:
+            self.graph_metrics.uninstrument()
+
+    def metrics(self):
+        """Return a snapshot of the metrics collected since enable_metrics()
+        was first called. See GraphMetrics.snapshot() in thingflow.metrics.
+        """
+        if self.graph_metrics is None:
+            snapshot = {'enabled':False, 'inputs':[], 'outputs':[]}
+        else:
+            snapshot = self.graph_metrics.snapshot()
+        # the cross-thread inboxes are always tracked
+        snapshot['inboxes'] = [inbox.stats() for inbox in self.inboxes]
+        return snapshot
+
+    def enable_latency_tracking(self, *roots):
+        """Start tracking the end-to-end latency of events, from the time a
+        source produces them to the time a sink has handled them. The sinks
+        reachable from the active schedules (plus any additional OutputThings
+        passed as roots) are tracked. Since the ingress timestamps are
+        process-wide, only one scheduler should track latencies at a time.
+        See thingflow.latency for details.
+        """
+        from thingflow.latency import LatencyTracker
+        if self.latency_tracker is None:
+            self.latency_tracker = LatencyTracker()
+        self.latency_tracker.enable(list(self.active_schedules.keys()) +
+                                    list(roots))
+
+    def disable_latency_tracking(self):
+        """Stop tracking latencies. The latencies recorded so far are still
+        available through latencies().
+        """
+        if self.latency_tracker is not None:
+            self.latency_tracker.disable()
+
+    def latencies(self):
+        """Return a snapshot of the per-sink latencies. See
+        LatencyTracker.snapshot() in thingflow.latency.
+        """
+        if self.latency_tracker is None:
+            return {'enabled':False, 'sinks':[]}
+        return self.latency_tracker.snapshot()
+
+    def enable_lag_monitor(self, *roots, **kwargs):
+        """Start monitoring the lag of the event loop and attributing slow
+        callbacks to the things reachable from the active schedules (plus any
+        additional OutputThings passed as roots). The keyword arguments
+        (probe_interval, slow_callback_threshold, window, and
+        attribute_downstream) are passed to the LagMonitor on the first
+        call. Returns the LagMonitor, to which listeners can be added. See
+        thingflow.lagmonitor for details.
+        """
+        from thingflow.lagmonitor import LagMonitor
+        if self.lag_monitor is None:
+            self.lag_monitor = LagMonitor(self, **kwargs)
+        self.lag_monitor.start(list(self.active_schedules.keys()) +
+                               list(roots))
+        return self.lag_monitor
+
+    def disable_lag_monitor(self):
+        """Stop monitoring the event loop lag and remove the instrumentation.
+        The monitor (and its report) is discarded.
+        """
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+            self.lag_monitor = None
+
+    def lag_report(self):
+        """Return a report of the event loop lag and the slow callbacks over
+        the monitor's rolling window. See LagMonitor.report() in
+        thingflow.lagmonitor.
+        """
+        if self.lag_monitor is None:
+            return {'enabled':False, 'probes':0, 'slow_callbacks':[],
+                    'slow_output_things':[], 'slow_input_things':[]}
+        return self.lag_monitor.report()
+
     def run_forever(self):
         """Call the event loop's run_forever(). We don't really run forever:
         the event loop is exited if we run out of scheduled events or if stop()
@@ -1252,10 +1882,14 @@ class Scheduler:
         fid = self.next_future_id
         future = self.event_loop.create_task(coro)
         # the combined callback. To avoid race conditions, always
-        # call the provided done callback before we remove the future.
+        # call the provided done callback before we remove the future. We
+        # remove the future even if the callback raises an error, so that
+        # stop() does not wait on it.
         def cb(f):
-            done_callback(f)
-            del self.pending_futures[fid]
+            try:
+                done_callback(f)
+            finally:
+                del self.pending_futures[fid]
         self.pending_futures[fid] = future
         future.add_done_callback(cb)
         self.next_future_id += 1
@@ -1265,7 +1899,9 @@ class Scheduler:
         """Stop any active schedules for output things and then call stop() on
         the event loop.
         """
-        for (task, handle) in self.active_schedules.items():
+        # Iterate over a copy, as some handles (e.g. those of sinks that have
+        # nothing left to flush) remove themselves from active_schedules.
+        for (task, handle) in list(self.active_schedules.items()):
             #print("Stopping %s" % task)
             # The handles are either event scheduler handles (with a cancel
             # method) or just callables to be called directly.
@@ -1284,13 +1920,25 @@ class Scheduler:
                 # completed.
                 #print("Waiting for future %d (%s)" % (fid, repr(f)))
                 def recheck_stop(f):
-                    exc = f.exception()
+                    exc = None if f.cancelled() else f.exception()
                     if exc:
                         raise FatalError("Exception in coroutine %s" % repr(f)) from exc
                     else:
                         self.stop()
                 f.add_done_callback(recheck_stop)
                 return
-            elif f.exception():
-                raise FatalError("Exception in coroutine %s" %  repr(f)) from exc
+            elif (not f.cancelled()) and f.exception():
+                raise FatalError("Exception in coroutine %s" %  repr(f)) \
+                    from f.exception()
+            else:
+                # The future is done, but its done callback (which removes
+                # it from pending_futures) has not run yet. That callback is
+                # already queued on the event loop, so check again after it.
+                self.event_loop.call_soon(self.stop)
+                return
+        if self.blocking_executor is not None:
+            # Don't block the event loop: the workers are idle or finishing
+            # up, and a new pool is created if the scheduler is run again.
+            self.blocking_executor.shutdown(wait=False)
+            self.blocking_executor = None
         self.event_loop.stop()
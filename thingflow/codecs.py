@@ -0,0 +1,460 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Codecs for serializing events to bytes, for use by the adapters and the
+encode() and decode() filters (see thingflow.filters.codec).
+
+A codec converts a single event to and from a bytes payload, and a batch
+(list) of events to and from a single payload. Codecs are registered by name,
+so that adapters can take either a name or a Codec instance::
+
+    writer = QueueWriter(sensor, uri, topic, scheduler, codec='struct')
+
+The following codecs are provided:
+
+ * ``json`` - JSON text, encoded as UTF-8. A batch is a JSON list. This is
+   the format used by the adapters before codecs were added.
+ * ``struct`` - a fixed binary layout for SensorEvents with integer sensor
+   ids (see SENSOR_EVENT_FORMAT). A batch is just the records packed back to
+   back into one buffer, which is far more compact than JSON.
+ * ``msgpack`` and ``cbor`` - if the msgpack or cbor2 packages are installed.
+
+To use other layouts, create a StructCodec (e.g. ``StructCodec('<16sdd')``
+for sensor ids of up to 16 characters) and pass it to the adapter, or
+register it via register_codec().
+
+An EventView wraps a payload without decoding it. Its fields are decoded on
+first access (individually, for codecs that support it, such as struct) and
+cached, so a where() or dispatch() that only looks at the topic or at one
+field can drop most events before they are decoded. Call materialize() (or
+use the materialize() filter) to get the decoded event::
+
+    reader = MQTTReader(host, topics=topics, codec='struct', lazy=True)
+    reader.where(lambda e: e.sensor_id==1).materialize().connect(writer)
+"""
+import json
+import re
+import struct
+
+from thingflow.base import SensorEvent
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class Codec:
+    """Base class for codecs. Subclasses must implement encode() and
+    decode(). The default batch methods encode a batch as a list, so they
+    only work for codecs that can encode lists.
+    """
+    name = None
+    fields = None # names of the fields of a decoded event, if known
+    decodes_fields = False # True if decode_field() is implemented
+    _view_class = None # created by the first call to make_view()
+
+    def encode(self, event):
+        """Return the payload (bytes) for a single event.
+        """
+        raise NotImplementedError
+
+    def decode(self, payload):
+        """Return the event for a payload (bytes, bytearray, or memoryview).
+        """
+        raise NotImplementedError
+
+    def encode_batch(self, events):
+        """Return a single payload for a list of events.
+        """
+        return self.encode(list(events))
+
+    def decode_batch(self, payload):
+        """Return the list of events in a payload from encode_batch().
+        """
+        return self.decode(payload)
+
+    def decode_many(self, payloads):
+        """Decode a list of payloads, each containing one event. Codecs can
+        override this to decode the payloads in one pass.
+        """
+        decode = self.decode
+        return [decode(p) for p in payloads]
+
+    def decode_field(self, payload, index):
+        """Return field index of the event in payload, without decoding the
+        other fields. Only available if decodes_fields is True.
+        """
+        raise NotImplementedError
+
+    def make_view(self, payload, topic=None):
+        """Return an EventView of the event in payload, which decodes fields
+        only as they are accessed.
+        """
+        view_class = self._view_class
+        if view_class is None:
+            view_class = self._view_class = _make_view_class(self.fields)
+        return view_class(payload, self, topic)
+
+    def views(self, payload, topic=None):
+        """Return the events in a payload from encode_batch(), as
+        EventViews. Codecs that cannot locate an event in a batch without
+        decoding it return the decoded events, which have the same fields.
+        """
+        return self.decode_batch(payload)
+
+    def __repr__(self):
+        return '%s()' % self.__class__.__name__
+
+
+class JsonCodec(Codec):
+    """JSON text, encoded as UTF-8. If constructor is specified, each
+    decoded value is passed as *args to the constructor (e.g. SensorEvent),
+    as with the from_json() filter. If a schema (see
+    thingflow.filters.json.JsonSchema) is specified instead, we use its
+    generated encoder and the fastest installed JSON backend.
+    """
+    name = 'json'
+
+    def __init__(self, constructor=None, schema=None):
+        self.schema = schema
+        if schema is not None:
+            from thingflow.filters.json import BACKENDS, FASTEST_BACKEND
+            self.loads = BACKENDS[FASTEST_BACKEND][0]
+            self.dumps = schema.encode
+            self.make = schema.make
+        else:
+            self.loads = json.loads
+            self.dumps = json.dumps
+            self.make = (lambda obj: constructor(*obj)) if constructor \
+                        else None
+        constructor = schema.constructor if schema is not None \
+                      else constructor
+        self.fields = getattr(constructor, '_fields', None)
+
+    def encode(self, event):
+        return self.dumps(event).encode('utf-8')
+
+    def decode(self, payload):
+        obj = self.loads(str(payload, encoding='utf-8'))
+        if self.make:
+            obj = self.make(obj)
+        return obj
+
+    def encode_batch(self, events):
+        if self.schema is not None:
+            encode = self.dumps
+            return ('[' + ', '.join([encode(e) for e in events]) +
+                    ']').encode('utf-8')
+        return self.dumps(list(events)).encode('utf-8')
+
+    def decode_batch(self, payload):
+        objs = self.loads(str(payload, encoding='utf-8'))
+        if self.make:
+            make = self.make
+            objs = [make(obj) for obj in objs]
+        return objs
+
+    def decode_many(self, payloads):
+        # Join the payloads into a single JSON list, so that we parse them
+        # with one call.
+        return self.decode_batch(b'[' + b','.join(payloads) + b']')
+
+
+# The default layout for StructCodec: a SensorEvent with an unsigned 32 bit
+# integer sensor id and double precision timestamp and value, little-endian.
+# This is the same layout as the binary files of thingflow.sensors.fleet.
+SENSOR_EVENT_FORMAT = '<Idd'
+
+
+def _string_fields(fmt):
+    """Return the indexes of the fields of a struct format that are
+    strings ('s' or 'p').
+    """
+    indexes = []
+    field = 0
+    for (count, code) in re.findall(r'(\d*)([a-zA-Z?])', fmt):
+        if code=='x':
+            continue # padding, no field
+        elif code in 'sp':
+            indexes.append(field)
+            field += 1
+        else:
+            field += int(count) if count else 1
+    return indexes
+
+
+def _field_structs(fmt):
+    """Return a (Struct, offset) pair for each field of a struct format, so
+    that a single field can be unpacked from a record.
+    """
+    order = fmt[0] if fmt[:1] in ('@', '=', '<', '>', '!') else ''
+    prefix = order
+    result = []
+    for (count, code) in re.findall(r'(\d*)([a-zA-Z?])', fmt):
+        if code=='x' or code in 'sp':
+            tokens = [count + code]
+        else:
+            tokens = [code]*(int(count) if count else 1)
+        for token in tokens:
+            # the field's offset, including any alignment padding before it
+            offset = struct.calcsize(prefix + token) - \
+                     struct.calcsize(order + token)
+            if code!='x':
+                result.append((struct.Struct(order + token), offset))
+            prefix += token
+    return result
+
+
+class StructCodec(Codec):
+    """A fixed binary layout for tuples (by default, SensorEvents with
+    integer sensor ids). fmt is the struct format of one event. String
+    fields ('Ns') are encoded as UTF-8 and their padding is removed when
+    decoding. Each decoded tuple is passed as *args to the constructor.
+
+    A batch is encoded as the records packed back to back, with no other
+    framing, since the size of each record is fixed.
+    """
+    name = 'struct'
+
+    decodes_fields = True
+
+    def __init__(self, fmt=SENSOR_EVENT_FORMAT, constructor=SensorEvent):
+        self.struct = struct.Struct(fmt)
+        self.constructor = constructor
+        self.string_fields = _string_fields(fmt)
+        self.field_decoders = [self._field_decoder(i, field_struct, offset)
+                               for (i, (field_struct, offset))
+                               in enumerate(_field_structs(fmt))]
+        self.fields = getattr(constructor, '_fields', None)
+
+    def _to_fields(self, event):
+        if len(self.string_fields)==0:
+            return event
+        fields = list(event)
+        for i in self.string_fields:
+            if isinstance(fields[i], str):
+                fields[i] = fields[i].encode('utf-8')
+        return fields
+
+    def _from_fields(self, fields):
+        if len(self.string_fields)>0:
+            fields = list(fields)
+            for i in self.string_fields:
+                fields[i] = fields[i].rstrip(b'\0').decode('utf-8')
+        return self.constructor(*fields) if self.constructor else fields
+
+    def encode(self, event):
+        return self.struct.pack(*self._to_fields(event))
+
+    def decode(self, payload):
+        return self._from_fields(self.struct.unpack(payload))
+
+    def encode_batch(self, events):
+        size = self.struct.size
+        buf = bytearray(size*len(events))
+        pack_into = self.struct.pack_into
+        offset = 0
+        for event in events:
+            pack_into(buf, offset, *self._to_fields(event))
+            offset += size
+        return bytes(buf)
+
+    def decode_batch(self, payload):
+        from_fields = self._from_fields
+        return [from_fields(fields)
+                for fields in self.struct.iter_unpack(payload)]
+
+    def decode_many(self, payloads):
+        return self.decode_batch(b''.join(payloads))
+
+    def _field_decoder(self, index, field_struct, offset):
+        unpack_from = field_struct.unpack_from
+        if index in self.string_fields:
+            return lambda payload: \
+                unpack_from(payload, offset)[0].rstrip(b'\0').decode('utf-8')
+        return lambda payload: unpack_from(payload, offset)[0]
+
+    def decode_field(self, payload, index):
+        return self.field_decoders[index](payload)
+
+    def views(self, payload, topic=None):
+        # slices of a memoryview share the payload's buffer
+        payload = memoryview(payload)
+        size = self.struct.size
+        if len(payload)%size!=0:
+            raise struct.error("Batch of %d bytes is not a multiple of the "
+                               "record size %d" % (len(payload), size))
+        make_view = self.make_view
+        return [make_view(payload[offset:offset+size], topic)
+                for offset in range(0, len(payload), size)]
+
+    def __repr__(self):
+        return 'StructCodec(%r)' % self.struct.format
+
+
+class MsgpackCodec(Codec):
+    """MessagePack, via the msgpack package. Tuples (including SensorEvents)
+    are encoded as arrays. If constructor is specified, each decoded value is
+    passed as *args to the constructor.
+    """
+    name = 'msgpack'
+
+    def __init__(self, constructor=None):
+        if msgpack is None:
+            raise ImportError("The msgpack codec requires the msgpack package")
+        self.constructor = constructor
+
+    def encode(self, event):
+        return msgpack.packb(event, use_bin_type=True)
+
+    def decode(self, payload):
+        obj = msgpack.unpackb(payload, raw=False)
+        return self.constructor(*obj) if self.constructor else obj
+
+    def decode_batch(self, payload):
+        objs = msgpack.unpackb(payload, raw=False)
+        if self.constructor:
+            constructor = self.constructor
+            objs = [constructor(*obj) for obj in objs]
+        return objs
+
+
+class CborCodec(Codec):
+    """CBOR, via the cbor2 package. If constructor is specified, each
+    decoded value is passed as *args to the constructor.
+    """
+    name = 'cbor'
+
+    def __init__(self, constructor=None):
+        if cbor2 is None:
+            raise ImportError("The cbor codec requires the cbor2 package")
+        self.constructor = constructor
+
+    def encode(self, event):
+        return cbor2.dumps(list(event) if isinstance(event, tuple) else event)
+
+    def encode_batch(self, events):
+        return cbor2.dumps([list(e) if isinstance(e, tuple) else e
+                            for e in events])
+
+    def decode(self, payload):
+        obj = cbor2.loads(bytes(payload))
+        return self.constructor(*obj) if self.constructor else obj
+
+    def decode_batch(self, payload):
+        objs = cbor2.loads(bytes(payload))
+        if self.constructor:
+            constructor = self.constructor
+            objs = [constructor(*obj) for obj in objs]
+        return objs
+
+
+class EventView:
+    """A lazily decoded event. We keep a reference to the payload (and the
+    topic it was received on, if any) and decode fields as they are accessed,
+    either by name (view.val) or by index (view[2]). Each field is decoded
+    at most once. If the codec cannot decode fields individually, the first
+    access decodes the whole event. If codec is None, only the topic and
+    payload are available.
+
+    Views are normally created via Codec.make_view(), which returns an
+    instance of a subclass with a property for each field of the codec's
+    events. The payload is always held as a memoryview, so the bytes are
+    never copied. The views of a batch (see Codec.views()) reference slices
+    of a memoryview of the batch payload.
+    """
+    __slots__ = ('payload', 'codec', 'topic', '_values', '_event')
+
+    def __init__(self, payload, codec, topic=None):
+        # the slices from Codec.views() are already memoryviews
+        self.payload = payload if type(payload) is memoryview \
+                       else memoryview(payload)
+        self.codec = codec
+        self.topic = topic
+        self._values = None # cache of decoded fields, by index
+        self._event = None
+
+    def materialize(self):
+        """Return the decoded event (the payload as bytes if there is no
+        codec).
+        """
+        if self._event is None:
+            if self.codec is None:
+                self._event = bytes(self.payload)
+            else:
+                self._event = self.codec.decode(self.payload)
+        return self._event
+
+    def __getitem__(self, index):
+        values = self._values
+        if values is not None and index in values:
+            return values[index]
+        if self._event is not None or self.codec is None or \
+           not self.codec.decodes_fields:
+            return self.materialize()[index]
+        if values is None:
+            values = self._values = {}
+        value = values[index] = self.codec.decode_field(self.payload, index)
+        return value
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        return 'EventView(%r)' % (self.materialize(),)
+
+
+def _field_property(index, name):
+    def get(self):
+        return self[index]
+    return property(get, doc="Field %d (%s) of the event" % (index, name))
+
+
+def _make_view_class(fields):
+    """Return a subclass of EventView with a property for each field name.
+    """
+    namespace = {'__slots__':()}
+    for (index, name) in enumerate(fields or []):
+        namespace[name] = _field_property(index, name)
+    return type('EventView', (EventView,), namespace)
+
+
+CODECS = {} # map from name to Codec
+
+
+def register_codec(codec, name=None):
+    """Register a codec instance under the specified name (by default, the
+    codec's name attribute), replacing any codec with that name.
+    """
+    CODECS[name or codec.name] = codec
+
+
+def get_codec(codec):
+    """Return the Codec for codec, which is either a name registered via
+    register_codec() or a Codec instance. Raises ValueError for unknown
+    names.
+    """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError("Unknown codec '%s', registered codecs are: %s" %
+                         (codec, ', '.join(sorted(CODECS.keys()))))
+
+
+register_codec(JsonCodec())
+register_codec(StructCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+if cbor2 is not None:
+    register_codec(CborCodec())
@@ -0,0 +1,65 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Serialize events to bytes and back, using the codecs of thingflow.codecs.
+"""
+from thingflow.base import OutputThing, FunctionFilter, filtermethod
+from thingflow.codecs import get_codec, EventView
+
+
+@filtermethod(OutputThing)
+def encode(this, codec='json', batch=False):
+    """Encode each event in the stream to a bytes payload, using the codec
+    (a name or a Codec instance). If batch is True, each event is a list of
+    events, which is encoded into a single payload.
+    """
+    codec = get_codec(codec)
+    encode_fn = codec.encode_batch if batch else codec.encode
+    def on_next(self, x):
+        self._dispatch_next(encode_fn(x))
+
+    return FunctionFilter(this, on_next=on_next, name='encode(%s)' % codec.name)
+
+
+@filtermethod(OutputThing)
+def decode(this, codec='json', batch=False, lazy=False):
+    """Decode each bytes payload in the stream, using the codec (a name or a
+    Codec instance). If batch is True, each payload contains a batch of
+    events, which are dispatched one at a time.
+
+    If lazy is True, we dispatch an EventView of each event instead, whose
+    fields are only decoded when accessed. Use materialize() after the
+    filters that drop events to get the decoded events.
+    """
+    codec = get_codec(codec)
+    if lazy and batch:
+        views = codec.views
+        def on_next(self, x):
+            for event in views(x):
+                self._dispatch_next(event)
+    elif lazy:
+        make_view = codec.make_view
+        def on_next(self, x):
+            self._dispatch_next(make_view(x))
+    elif batch:
+        decode_batch = codec.decode_batch
+        def on_next(self, x):
+            for event in decode_batch(x):
+                self._dispatch_next(event)
+    else:
+        decode_fn = codec.decode
+        def on_next(self, x):
+            self._dispatch_next(decode_fn(x))
+
+    return FunctionFilter(this, on_next=on_next, name='decode(%s)' % codec.name)
+
+
+@filtermethod(OutputThing)
+def materialize(this):
+    """Replace each EventView in the stream with its decoded event. Other
+    events are passed through unchanged.
+    """
+    def on_next(self, x):
+        self._dispatch_next(x.materialize() if isinstance(x, EventView) else x)
+
+    return FunctionFilter(this, on_next=on_next, name='materialize')
@@ -0,0 +1,120 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Reduce the number of points in a time series while keeping its visual
+shape, e.g. before plotting.
+
+Two algorithms are provided:
+
+* LTTB (Largest-Triangle-Three-Buckets) divides the points into buckets
+  and picks the point of each bucket that forms the largest triangle with
+  the point picked from the previous bucket and the average of the next.
+* MIN_MAX divides the x range into buckets (e.g. one per pixel) and keeps
+  the points with the smallest and largest y value of each bucket, so that
+  spikes are never lost.
+
+The functions work on sequences of x and y values and return the indices
+of the points to keep, in order. The downsample() filter applies them to
+batches (lists) of events.
+"""
+from thingflow.base import OutputThing, FunctionFilter, filtermethod
+
+LTTB = 'lttb'
+MIN_MAX = 'min_max'
+
+
+def lttb_indices(xs, ys, max_points):
+    """Return the indices of at most max_points points selected from the
+    points (xs[i], ys[i]) by the Largest-Triangle-Three-Buckets algorithm.
+    The first and last points are always kept.
+    """
+    n = len(xs)
+    if n<=max_points or n<=2:
+        return list(range(n))
+    if max_points<3:
+        return [0, n-1][:max(max_points, 1)]
+    every = (n-2)/(max_points-2) # bucket size, excluding the end points
+    selected = [0]
+    a = 0
+    for i in range(max_points-2):
+        # the average of the next bucket (the last point, for the last one)
+        avg_start = int((i+1)*every)+1
+        avg_end = min(int((i+2)*every)+1, n)
+        cnt = avg_end-avg_start
+        avg_x = sum(xs[avg_start:avg_end])/cnt
+        avg_y = sum(ys[avg_start:avg_end])/cnt
+        # pick the point of this bucket with the largest triangle
+        ax = xs[a]
+        ay = ys[a]
+        max_area = -1.0
+        for j in range(int(i*every)+1, int((i+1)*every)+1):
+            area = abs((ax-avg_x)*(ys[j]-ay) - (ax-xs[j])*(avg_y-ay))
+            if area>max_area:
+                max_area = area
+                a = j
+        selected.append(a)
+    selected.append(n-1)
+    return selected
+
+
+def min_max_indices(xs, ys, num_buckets):
+    """Divide the range of the x values (which must be in ascending order)
+    into num_buckets buckets of equal width and return the indices of the
+    points with the minimum and maximum y value in each bucket, in order
+    and without duplicates. At most 2*num_buckets indices are returned.
+    """
+    n = len(xs)
+    if n<=2*num_buckets:
+        return list(range(n))
+    x0 = xs[0]
+    width = (xs[-1]-x0)/num_buckets
+    if width<=0:
+        # all the points have the same x value: a single bucket
+        return sorted(set((min(range(n), key=ys.__getitem__),
+                           max(range(n), key=ys.__getitem__))))
+    selected = []
+    bucket = 0
+    lo = hi = 0
+    for i in range(1, n):
+        b = min(int((xs[i]-x0)/width), num_buckets-1)
+        if b!=bucket:
+            selected.extend(sorted(set((lo, hi))))
+            bucket = b
+            lo = hi = i
+        elif ys[i]<ys[lo]:
+            lo = i
+        elif ys[i]>ys[hi]:
+            hi = i
+    selected.extend(sorted(set((lo, hi))))
+    # already in order for ascending x values, but make sure of it
+    return sorted(set(selected))
+
+
+def downsample_indices(xs, ys, max_points, algorithm=LTTB):
+    """Return the indices of at most max_points points to keep, using the
+    specified algorithm (LTTB or MIN_MAX).
+    """
+    if algorithm==LTTB:
+        return lttb_indices(xs, ys, max_points)
+    elif algorithm==MIN_MAX:
+        return min_max_indices(xs, ys, max(max_points//2, 1))
+    else:
+        raise ValueError("Unknown downsampling algorithm '%s'" % algorithm)
+
+
+@filtermethod(OutputThing)
+def downsample(this, max_points, algorithm=LTTB):
+    """Each event in the stream is a list of SensorEvents (e.g. from
+    buffer_with_count()). Replace it with a list of at most max_points of
+    the events, selected by the algorithm (LTTB or MIN_MAX) using the ts and
+    val fields.
+    """
+    if algorithm not in (LTTB, MIN_MAX):
+        raise ValueError("Unknown downsampling algorithm '%s'" % algorithm)
+    def on_next(self, x):
+        indices = downsample_indices([e.ts for e in x], [e.val for e in x],
+                                     max_points, algorithm)
+        self._dispatch_next([x[i] for i in indices])
+
+    return FunctionFilter(this, on_next=on_next,
+                          name='downsample(%s, %s)' % (max_points, algorithm))
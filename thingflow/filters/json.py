@@ -1,30 +1,174 @@
 # Copyright 2016 by MPI-SWS and Data-Ken Research.
 # Licensed under the Apache 2.0 License.
+"""
+Convert the events in a stream to and from JSON.
+
+By default, these filters use the standard json module. If the stream has a
+fixed layout (e.g. each event is a SensorEvent, encoded as a JSON list), it
+can be declared by passing a JsonSchema via the schema parameter. to_json()
+then uses an encoder generated for the schema, which produces the same
+output as json.dumps() but is much faster, and from_json() constructs the
+events directly from the decoded lists, using the fastest installed backend
+(orjson, if available).
+
+from_json() can also decode several JSON values in one call: either a list
+of payloads (batch=True) or a newline-delimited JSON string (ndjson=True).
+
+Additional backends can be registered in BACKENDS. Note that orjson only
+accepts strict JSON (e.g. not NaN).
+"""
 import json
+from json.encoder import encode_basestring_ascii
+from math import isfinite
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from thingflow.base import OutputThing, FunctionFilter, filtermethod,\
+                           SensorEvent
+
+
+# Map from backend name to a (loads, dumps) pair, where dumps returns a str.
+BACKENDS = {'json': (json.loads, json.dumps)}
+if orjson is not None:
+    BACKENDS['orjson'] = (orjson.loads,
+                          lambda x: orjson.dumps(x).decode('utf-8'))
+
+# The backend used for streams with a schema, if none is specified.
+FASTEST_BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _get_backend(backend):
+    try:
+        return BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown json backend '%s', available backends are: %s"
+                         % (backend, ', '.join(sorted(BACKENDS.keys()))))
+
+
+# The fast paths below are only taken for the exact builtin types: for
+# subclasses (e.g. bool or numpy scalars), None, inf and nan, we fall back to
+# json.dumps(), so that the output is the same.
+
+def _float(v):
+    if type(v) is float and isfinite(v):
+        return repr(v)
+    return json.dumps(v)
+
+def _int(v):
+    return repr(v) if type(v) is int else json.dumps(v)
+
+def _str(v):
+    return encode_basestring_ascii(v) if type(v) is str else json.dumps(v)
+
+def _any(v):
+    t = type(v)
+    if t is str:
+        return encode_basestring_ascii(v)
+    elif t is float:
+        return _float(v)
+    elif t is int:
+        return repr(v)
+    else:
+        return json.dumps(v)
+
+_FIELD_ENCODERS = {str:'_str', int:'_int', float:'_float', None:'_any'}
+
+def _make_encoder(types):
+    """Generate a function that encodes a tuple with fields of the specified
+    types as a JSON list, with the same output as json.dumps().
+    """
+    fields = ', '.join(['%s']*len(types))
+    args = ', '.join(['%s(x[%d])' % (_FIELD_ENCODERS[t], i)
+                      for (i, t) in enumerate(types)])
+    source = "def encode(x):\n    return '[%s]' %% (%s,)\n" % (fields, args)
+    namespace = {'_str':_str, '_int':_int, '_float':_float, '_any':_any}
+    exec(source, namespace)
+    return namespace['encode']
+
+
+class JsonSchema:
+    """Declares that each JSON value in a stream is a list with one element
+    per field of constructor (e.g. a namedtuple such as SensorEvent).
+    types is an optional sequence with the type of each field (str, int,
+    float, or None for any JSON-serializable value).
+    """
+    def __init__(self, constructor, types=None):
+        self.constructor = constructor
+        self.make = getattr(constructor, '_make', None) or \
+                    (lambda obj: constructor(*obj))
+        if types is None:
+            types = [None]*len(constructor._fields)
+        self.types = tuple(types)
+        self.encode = _make_encoder(self.types)
+
+    def __repr__(self):
+        return 'JsonSchema(%s)' % self.constructor.__name__
+
+
+SENSOR_EVENT_SCHEMA = JsonSchema(SensorEvent, (None, float, float))
 
-from thingflow.base import OutputThing, FunctionFilter, filtermethod
 
 @filtermethod(OutputThing)
-def to_json(this):
-    """Convert the events in the stream to a json string.
+def to_json(this, schema=None, backend='json'):
+    """Convert the events in the stream to a json string. If a JsonSchema is
+    specified, use the encoder generated for it, otherwise use the dumps()
+    function of the backend.
     """
+    dumps = schema.encode if schema is not None else _get_backend(backend)[1]
     def on_next(self, x):
-        self._dispatch_next(json.dumps(x))
-        
+        self._dispatch_next(dumps(x))
+
     return FunctionFilter(this, on_next=on_next, name='to_json')
 
 
+def _join(payloads, sep):
+    if len(payloads)>0 and not isinstance(payloads[0], str):
+        return b'[' + sep.encode('utf-8').join(payloads) + b']'
+    return '[' + sep.join(payloads) + ']'
+
+
 @filtermethod(OutputThing)
-def from_json(this, constructor=None):
+def from_json(this, constructor=None, schema=None, batch=False, ndjson=False,
+              backend=None):
     """Parse a sequence of json strings. If constructor is specified, the
     parsed value is passed as *args to the constructor to return the actual
-    object.
+    object. If a JsonSchema is specified, the values are constructed as
+    declared by the schema instead.
+
+    If batch is True, each element of the stream is a list of json strings
+    (or bytes), and if ndjson is True, it is a string containing one json
+    value per line. In either case, the values are decoded with a single
+    call and dispatched one at a time.
+
+    The backend defaults to FASTEST_BACKEND if a schema is specified and
+    to 'json' otherwise.
     """
-    def on_next(self, x):
-        obj = json.loads(x)
-        if constructor:
-            obj = constructor(*obj)
-        self._dispatch_next(obj)
-        
-    return FunctionFilter(this, on_next=on_next, name='from_json')
+    if backend is None:
+        backend = FASTEST_BACKEND if schema is not None else 'json'
+    loads = _get_backend(backend)[0]
+    if schema is not None:
+        make = schema.make
+    elif constructor is not None:
+        make = lambda obj: constructor(*obj)
+    else:
+        make = None
+    if batch or ndjson:
+        def on_next(self, x):
+            if ndjson:
+                x = [line for line in x.splitlines() if line.strip()]
+            objs = loads(_join(x, ','))
+            if make:
+                objs = [make(obj) for obj in objs]
+            for obj in objs:
+                self._dispatch_next(obj)
+    else:
+        def on_next(self, x):
+            obj = loads(x)
+            if make:
+                obj = make(obj)
+            self._dispatch_next(obj)
 
+    return FunctionFilter(this, on_next=on_next, name='from_json')
@@ -0,0 +1,398 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Load shedding: filters that reduce the event rate of a stream when the
+system is overloaded, and a controller that sets how much to shed.
+
+The SheddingController computes a shedding level from the event loop lag
+(via the scheduler's lag monitor) and from the depths of any queues
+registered with add_queue(), such as the queue of a BlockingInputThing or
+AsyncInputThing. Level 0 means no shedding. The level goes up as soon as a
+threshold is crossed and comes down one step at a time, after the load has
+stayed below the threshold for recovery_time seconds.
+
+Each shedding filter declares a policy for its stream, as a dict mapping a
+level to a parameter. The parameter for the highest level in the dict that
+does not exceed the current level is used. For example, with
+rates={1:2, 3:10}, sample() passes every event at level 0, one in two events
+at levels 1 and 2, and one in ten at level 3 and above. The policies are:
+
+ * sample(rates) - pass one in N events
+ * latest_per_key(scheduler, intervals, key_fn) - keep only the latest event
+   for each key and emit them every interval seconds
+ * drop_below_priority(priority_fn, min_priorities) - drop events whose
+   priority is below the minimum
+ * degrade_aggregation(windows, key_fn, aggregate_fn) - replace each window
+   of events for a key by a single aggregated event
+
+At level 0, the filters just pass the events through. Each filter counts
+the events it received (events_in), sent on (events_out), and shed
+(events_shed). For example::
+
+    controller = SheddingController(scheduler)
+    controller.add_queue(queue_depth_fn(writer), (1000, 5000, 20000))
+    sensor.sample({1:2, 2:10}, controller=controller).connect(writer)
+    controller.start()
+"""
+from statistics import mean
+
+from thingflow.base import OutputThing, Filter, SensorEvent, filtermethod
+
+DEFAULT_LAG_THRESHOLDS = (0.05, 0.2, 0.5) # seconds, for levels 1, 2, and 3
+DEFAULT_CHECK_INTERVAL = 0.1 # seconds
+DEFAULT_RECOVERY_TIME = 1.0  # seconds
+
+
+def _param_for_level(policy, level):
+    """Return the parameter from the policy dict for the highest level that
+    does not exceed the specified level, or None if no shedding should be done.
+    """
+    best = None
+    for (l, param) in policy.items():
+        if l<=level and l>0 and (best is None or l>best[0]):
+            best = (l, param)
+    return best[1] if best is not None else None
+
+
+def queue_depth_fn(thing):
+    """Return a function that gets the depth of the input queue of a thing
+    (BlockingInputThing, AsyncInputThing, or mqtt_async.QueueWriter).
+    """
+    for attr in ('__queue__', 'queue', 'request_queue'):
+        if hasattr(thing, attr):
+            return lambda: len(getattr(thing, attr))
+    raise ValueError("%s does not have a known queue" % thing)
+
+
+class Shedder(Filter):
+    """Base class for the shedding filters. At level 0, events are passed
+    through. Otherwise, _shed() is called. Subclasses implement _shed() and
+    may override _level_changed() to flush any state.
+    """
+    def __init__(self, previous_in_chain, policy, controller=None):
+        super().__init__(previous_in_chain)
+        self.policy = policy
+        self.level = 0
+        self.param = None
+        self.events_in = 0
+        self.events_out = 0
+        self.events_shed = 0
+        if controller is not None:
+            controller.add_shedder(self)
+
+    def set_level(self, level):
+        old_param = self.param
+        self.level = level
+        self.param = _param_for_level(self.policy, level)
+        if self.param!=old_param:
+            self._level_changed(old_param)
+
+    def _level_changed(self, old_param):
+        pass
+
+    def _pass(self, x):
+        self.events_out += 1
+        self._dispatch_next(x)
+
+    def on_next(self, x):
+        self.events_in += 1
+        if self.param is None:
+            self.events_out += 1
+            self._dispatch_next(x)
+        else:
+            self._shed(x)
+
+    def _shed(self, x):
+        raise NotImplementedError
+
+    def counters(self):
+        return {'shedder':str(self), 'level':self.level,
+                'events_in':self.events_in, 'events_out':self.events_out,
+                'events_shed':self.events_shed}
+
+
+class SampleShedder(Shedder):
+    """Pass one in N events, where N is given by the rates policy.
+    """
+    def __init__(self, previous_in_chain, rates, controller=None):
+        super().__init__(previous_in_chain, rates, controller)
+        self.count = 0
+
+    def _level_changed(self, old_param):
+        self.count = 0
+
+    def _shed(self, x):
+        if self.count==0:
+            self._pass(x)
+        else:
+            self.events_shed += 1
+        self.count = (self.count+1) % self.param
+
+    def __str__(self):
+        return 'sample(%s)' % self.policy
+
+
+@filtermethod(OutputThing)
+def sample(this, rates, controller=None):
+    """When shedding, pass only one in N events, where the rates dict maps
+    shedding levels to N.
+    """
+    return SampleShedder(this, rates, controller)
+
+
+class LatestPerKeyShedder(Shedder):
+    """Keep only the latest event for each key, and emit the kept events
+    every interval seconds, where the intervals policy maps levels to
+    intervals.
+    """
+    def __init__(self, previous_in_chain, scheduler, intervals,
+                 key_fn=lambda e: e.sensor_id, controller=None):
+        super().__init__(previous_in_chain, intervals, controller)
+        self.scheduler = scheduler
+        self.key_fn = key_fn
+        self.latest = {}
+        self.timer = None
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        latest = self.latest
+        self.latest = {}
+        for x in latest.values():
+            self._pass(x)
+
+    def _level_changed(self, old_param):
+        self._flush()
+
+    def _shed(self, x):
+        key = self.key_fn(x)
+        if key in self.latest:
+            self.events_shed += 1
+        self.latest[key] = x
+        if self.timer is None:
+            self.timer = self.scheduler.event_loop.call_later(self.param,
+                                                              self._flush)
+
+    def on_completed(self):
+        self._flush()
+        self._dispatch_completed()
+
+    def on_error(self, e):
+        self._flush()
+        self._dispatch_error(e)
+
+    def __str__(self):
+        return 'latest_per_key(%s)' % self.policy
+
+
+@filtermethod(OutputThing)
+def latest_per_key(this, scheduler, intervals, key_fn=lambda e: e.sensor_id,
+                   controller=None):
+    """When shedding, keep only the latest event for each key (by default,
+    the sensor id) and emit the kept events periodically. The intervals dict
+    maps shedding levels to the emission interval in seconds.
+    """
+    return LatestPerKeyShedder(this, scheduler, intervals, key_fn, controller)
+
+
+class PriorityShedder(Shedder):
+    """Drop the events whose priority (as computed by priority_fn) is
+    below the minimum given by the min_priorities policy.
+    """
+    def __init__(self, previous_in_chain, priority_fn, min_priorities,
+                 controller=None):
+        super().__init__(previous_in_chain, min_priorities, controller)
+        self.priority_fn = priority_fn
+
+    def _shed(self, x):
+        if self.priority_fn(x)>=self.param:
+            self._pass(x)
+        else:
+            self.events_shed += 1
+
+    def __str__(self):
+        return 'drop_below_priority(%s)' % self.policy
+
+
+@filtermethod(OutputThing)
+def drop_below_priority(this, priority_fn, min_priorities, controller=None):
+    """When shedding, drop events whose priority (as returned by
+    priority_fn) is below a minimum. The min_priorities dict maps shedding
+    levels to minimum priorities.
+    """
+    return PriorityShedder(this, priority_fn, min_priorities, controller)
+
+
+def mean_sensor_event(events):
+    """Aggregate a list of SensorEvents with the same sensor id into one
+    event, with the mean value and the timestamp of the last event.
+    """
+    return SensorEvent(sensor_id=events[-1].sensor_id, ts=events[-1].ts,
+                       val=mean(e.val for e in events))
+
+
+class AggregationShedder(Shedder):
+    """Replace each window of N events for a key by one aggregated event,
+    where N is given by the windows policy. The events absorbed into an
+    aggregate (all but one per window) are counted as shed.
+    """
+    def __init__(self, previous_in_chain, windows,
+                 key_fn=lambda e: e.sensor_id,
+                 aggregate_fn=mean_sensor_event, controller=None):
+        super().__init__(previous_in_chain, windows, controller)
+        self.key_fn = key_fn
+        self.aggregate_fn = aggregate_fn
+        self.windows = {} # map from key to list of events
+
+    def _flush(self):
+        windows = self.windows
+        self.windows = {}
+        for events in windows.values():
+            self.events_shed += len(events)-1
+            self._pass(self.aggregate_fn(events))
+
+    def _level_changed(self, old_param):
+        self._flush()
+
+    def _shed(self, x):
+        key = self.key_fn(x)
+        events = self.windows.get(key)
+        if events is None:
+            events = self.windows[key] = []
+        events.append(x)
+        if len(events)>=self.param:
+            del self.windows[key]
+            self.events_shed += len(events)-1
+            self._pass(self.aggregate_fn(events))
+
+    def on_completed(self):
+        self._flush()
+        self._dispatch_completed()
+
+    def on_error(self, e):
+        self._flush()
+        self._dispatch_error(e)
+
+    def __str__(self):
+        return 'degrade_aggregation(%s)' % self.policy
+
+
+@filtermethod(OutputThing)
+def degrade_aggregation(this, windows, key_fn=lambda e: e.sensor_id,
+                        aggregate_fn=mean_sensor_event, controller=None):
+    """When shedding, aggregate each window of events for a key (by default,
+    the sensor id) into one event. The windows dict maps shedding levels to
+    window sizes. By default, SensorEvents are averaged.
+    """
+    return AggregationShedder(this, windows, key_fn, aggregate_fn, controller)
+
+
+class SheddingController:
+    """Set the shedding level of the registered shedding filters, based on
+    the event loop lag and queue depths. See the module documentation for
+    details. lag_thresholds gives the lag (in seconds) at which each level
+    starts. Set it to None to ignore the lag.
+    """
+    def __init__(self, scheduler, lag_thresholds=DEFAULT_LAG_THRESHOLDS,
+                 check_interval=DEFAULT_CHECK_INTERVAL,
+                 recovery_time=DEFAULT_RECOVERY_TIME):
+        self.scheduler = scheduler
+        self.lag_thresholds = lag_thresholds
+        self.check_interval = check_interval
+        self.recovery_time = recovery_time
+        self.queues = [] # list of (name, depth_fn, thresholds)
+        self.shedders = []
+        self.level = 0
+        self.level_changes = 0
+        self.max_lag = 0.0 # since the last check
+        self.last_lag = 0.0
+        self.below_since = None # time since the load has been below level
+        self.monitor = None
+        self.handle = None
+
+    def add_queue(self, depth_fn, thresholds, name=None):
+        """Include a queue in the computation of the shedding level.
+        depth_fn returns the current depth (see queue_depth_fn()) and
+        thresholds gives the depth at which each level starts.
+        """
+        self.queues.append((name or repr(depth_fn), depth_fn, thresholds))
+
+    def add_shedder(self, shedder):
+        self.shedders.append(shedder)
+        shedder.set_level(self.level)
+
+    def start(self):
+        """Start monitoring the load. The controller uses the scheduler's lag
+        monitor, enabling it if needed.
+        """
+        if self.lag_thresholds is not None and self.monitor is None:
+            self.monitor = self.scheduler.enable_lag_monitor(
+                attribute_downstream=False)
+            self.monitor.add_listener(self._on_lag)
+        if self.handle is None:
+            self.handle = self.scheduler.event_loop.call_later(
+                self.check_interval, self._check)
+
+    def stop(self):
+        if self.monitor is not None:
+            self.monitor.remove_listener(self._on_lag)
+            self.monitor = None
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _on_lag(self, lag):
+        if lag>self.max_lag:
+            self.max_lag = lag
+
+    def _level_for(self, value, thresholds):
+        return sum(1 for t in thresholds if value>=t)
+
+    def _compute_level(self):
+        level = 0
+        if self.lag_thresholds is not None:
+            level = self._level_for(self.max_lag, self.lag_thresholds)
+        for (name, depth_fn, thresholds) in self.queues:
+            level = max(level, self._level_for(depth_fn(), thresholds))
+        return level
+
+    def _check(self):
+        self.handle = self.scheduler.event_loop.call_later(self.check_interval,
+                                                           self._check)
+        target = self._compute_level()
+        self.last_lag = self.max_lag
+        self.max_lag = 0.0
+        now = self.scheduler.event_loop.time()
+        if target>self.level:
+            self.below_since = None
+            self.set_level(target)
+        elif target<self.level:
+            if self.below_since is None:
+                self.below_since = now
+            elif now-self.below_since>=self.recovery_time:
+                self.below_since = now
+                self.set_level(self.level-1)
+        else:
+            self.below_since = None
+
+    def set_level(self, level):
+        """Set the shedding level of all the registered filters. This is
+        called by the controller, but can also be used to override the level.
+        """
+        if level!=self.level:
+            self.level_changes += 1
+        self.level = level
+        for shedder in self.shedders:
+            shedder.set_level(level)
+
+    def report(self):
+        """Return a dict with the current level, the load signals, and the
+        counters of each shedding filter.
+        """
+        return {'level':self.level, 'level_changes':self.level_changes,
+                'lag_ms':self.last_lag*1000.0,
+                'queues':dict((name, depth_fn())
+                              for (name, depth_fn, thresholds) in self.queues),
+                'shedders':[s.counters() for s in self.shedders],
+                'events_shed':sum(s.events_shed for s in self.shedders)}
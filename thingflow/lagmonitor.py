@@ -0,0 +1,261 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Event loop lag monitoring, with attribution of slow callbacks to the things
+in a graph.
+
+The monitor does two things:
+
+ 1. It schedules a probe callback on the event loop every probe_interval
+    seconds and records how late the probe ran (the loop lag). A large lag
+    means that some callback held the event loop for too long or that the
+    scheduler cannot keep up with the load.
+ 2. It times the callbacks that the scheduler runs on behalf of OutputThings
+    (e.g. each _observe() call from schedule_periodic() and
+    schedule_recurring(), and each event handed off from a blocking or
+    private event loop thread). When a callback takes longer than
+    slow_callback_threshold seconds, the time is attributed to the
+    OutputThing and to the downstream InputThing that spent the most time
+    in its on_next() (excluding the time spent further downstream). To
+    measure the downstream time, we wrap the connections of the graph, as
+    in thingflow.metrics, so this can be turned off with
+    attribute_downstream=False.
+
+The report covers a rolling window of the last window seconds. Listeners
+(see LagMonitor.add_listener()) are called with the lag after each probe,
+which can be used to trigger load shedding.
+
+Callbacks that OutputThings schedule for themselves on the main event loop
+(e.g. via Scheduler.schedule_on_main_event_loop()) are not timed, but they
+still show up in the loop lag.
+
+Usually, you do not use this module directly, but call
+Scheduler.enable_lag_monitor(), Scheduler.disable_lag_monitor(), and
+Scheduler.lag_report().
+"""
+import threading
+import time
+from collections import deque
+
+from thingflow.base import _WrappedConnection, _wrap_connections,\
+                           _unwrap_connections
+from thingflow.metrics import _perf_counter_ns
+
+DEFAULT_PROBE_INTERVAL = 0.05          # seconds
+DEFAULT_SLOW_CALLBACK_THRESHOLD = 0.05 # seconds
+DEFAULT_WINDOW = 60.0                  # seconds
+MAX_SLOW_CALLBACKS = 1000              # slow callbacks kept in the window
+
+
+def _percentile(sorted_values, p):
+    if len(sorted_values)==0:
+        return None
+    idx = min(len(sorted_values)-1,
+              max(0, int(round(len(sorted_values)*p/100.0))-1))
+    return sorted_values[idx]
+
+
+class _AttributionState(threading.local):
+    # While a timed callback is running, maps id(input_thing) to
+    # [input_thing, path, self_ns]. None outside of timed callbacks.
+    breakdown = None
+    child_ns = 0
+
+_attribution_state = _AttributionState()
+
+
+class _LagConnection(_WrappedConnection):
+    __slots__ = ()
+
+
+def _wrap_connection(connection, path):
+    original_on_next = connection.on_next
+    input_thing = connection.input_thing
+    key = id(input_thing)
+    state = _attribution_state
+    perf_counter_ns = _perf_counter_ns
+    def on_next(x):
+        breakdown = state.breakdown
+        if breakdown is None:
+            original_on_next(x)
+            return
+        outer_child_ns = state.child_ns
+        state.child_ns = 0
+        start = perf_counter_ns()
+        try:
+            original_on_next(x)
+        finally:
+            elapsed = perf_counter_ns() - start
+            entry = breakdown.get(key)
+            if entry is None:
+                breakdown[key] = [input_thing, path, elapsed - state.child_ns]
+            else:
+                entry[2] += elapsed - state.child_ns
+            state.child_ns = outer_child_ns + elapsed
+    return _LagConnection(connection, on_next=on_next)
+
+
+class LagMonitor:
+    """Monitor the lag of the scheduler's event loop. See the module
+    documentation for details.
+    """
+    def __init__(self, scheduler, probe_interval=DEFAULT_PROBE_INTERVAL,
+                 slow_callback_threshold=DEFAULT_SLOW_CALLBACK_THRESHOLD,
+                 window=DEFAULT_WINDOW, attribute_downstream=True):
+        self.scheduler = scheduler
+        self.event_loop = scheduler.event_loop
+        self.probe_interval = probe_interval
+        self.slow_callback_threshold = slow_callback_threshold
+        self.slow_threshold_ns = int(slow_callback_threshold*1000000000)
+        self.window = window
+        self.attribute_downstream = attribute_downstream
+        self.lags = deque() # (loop time, lag in seconds) for each probe
+        self.max_lag = 0.0  # over the lifetime of the monitor
+        self.slow_callbacks = deque(maxlen=MAX_SLOW_CALLBACKS)
+        self.listeners = []
+        self.instrumented = {} # map from id(output_thing) to output_thing
+        self.probe_handle = None
+
+    def add_listener(self, fn):
+        """Call fn(lag) after each probe, where lag is in seconds.
+        """
+        self.listeners.append(fn)
+
+    def remove_listener(self, fn):
+        self.listeners.remove(fn)
+
+    def start(self, roots=[]):
+        """Start probing the event loop and, if attribute_downstream is True,
+        wrap the connections reachable from the roots. This can be called
+        again to pick up connections made since the last call.
+        """
+        if self.attribute_downstream:
+            self._instrument(roots)
+        if self.probe_handle is None:
+            expected = self.event_loop.time() + self.probe_interval
+            self.probe_handle = self.event_loop.call_at(expected, self._probe,
+                                                        expected)
+
+    def stop(self):
+        """Stop probing and restore the original connections.
+        """
+        if self.probe_handle is not None:
+            self.probe_handle.cancel()
+            self.probe_handle = None
+        _unwrap_connections(self.instrumented.values(), _LagConnection)
+        self.instrumented = {}
+
+    def _instrument(self, roots):
+        def wrap(thing, port, connection, path):
+            return _wrap_connection(connection, path)
+        self.instrumented.update(
+            _wrap_connections(roots, _LagConnection, wrap))
+
+    def _probe(self, expected):
+        now = self.event_loop.time()
+        lag = max(0.0, now - expected)
+        self.lags.append((now, lag))
+        if lag>self.max_lag:
+            self.max_lag = lag
+        self._expire(now)
+        expected = now + self.probe_interval
+        self.probe_handle = self.event_loop.call_at(expected, self._probe,
+                                                    expected)
+        for listener in self.listeners:
+            listener(lag)
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        while len(self.lags)>0 and self.lags[0][0]<cutoff:
+            self.lags.popleft()
+        while len(self.slow_callbacks)>0 and \
+              self.slow_callbacks[0]['loop_time']<cutoff:
+            self.slow_callbacks.popleft()
+
+    def timed_call(self, output_thing, fn, *args):
+        """Call fn(*args) on behalf of output_thing. If this takes longer than
+        the slow callback threshold, record it.
+        """
+        state = _attribution_state
+        outer_breakdown = state.breakdown
+        breakdown = state.breakdown = {}
+        start = _perf_counter_ns()
+        try:
+            fn(*args)
+        finally:
+            elapsed = _perf_counter_ns() - start
+            state.breakdown = outer_breakdown
+            if elapsed>=self.slow_threshold_ns:
+                self._record_slow(output_thing, elapsed, breakdown)
+
+    def _record_slow(self, output_thing, elapsed_ns, breakdown):
+        slowest = None
+        for entry in breakdown.values():
+            if slowest is None or entry[2]>slowest[2]:
+                slowest = entry
+        self.slow_callbacks.append({
+            'loop_time': self.event_loop.time(),
+            'time': time.time(),
+            'duration_ms': elapsed_ns/1000000.0,
+            'output_thing': str(output_thing),
+            'input_thing': str(slowest[0]) if slowest else None,
+            'input_self_ms': slowest[2]/1000000.0 if slowest else None,
+            'path': slowest[1] if slowest else None})
+
+    def report(self):
+        """Return a dict summarizing the window: the loop lag percentiles (in
+        milliseconds), the recent slow callbacks, and the total slow callback
+        time attributed to each OutputThing and InputThing (slowest first).
+        """
+        self._expire(self.event_loop.time())
+        lags = sorted(lag for (t, lag) in self.lags)
+        def ms(v):
+            return v*1000.0 if v is not None else None
+        by_output = {}
+        by_input = {}
+        for cb in self.slow_callbacks:
+            for (key, table, duration) in \
+                ((cb['output_thing'], by_output, cb['duration_ms']),
+                 (cb['input_thing'], by_input, cb['input_self_ms'])):
+                if key is None:
+                    continue
+                stats = table.get(key)
+                if stats is None:
+                    stats = table[key] = {'thing':key, 'count':0,
+                                          'total_ms':0.0, 'max_ms':0.0}
+                stats['count'] += 1
+                stats['total_ms'] += duration
+                stats['max_ms'] = max(stats['max_ms'], duration)
+        def ranked(table):
+            return sorted(table.values(), key=lambda s: s['total_ms'],
+                          reverse=True)
+        return {'enabled': self.probe_handle is not None,
+                'window': self.window,
+                'probes': len(lags),
+                'lag_ms': {'p50':ms(_percentile(lags, 50)),
+                           'p99':ms(_percentile(lags, 99)),
+                           'max':ms(lags[-1] if len(lags)>0 else None)},
+                'max_lag_ms': self.max_lag*1000.0,
+                'slow_callbacks': list(self.slow_callbacks),
+                'slow_output_things': ranked(by_output),
+                'slow_input_things': ranked(by_input)}
+
+
+def print_lag_report(report):
+    """Print a report returned by LagMonitor.report().
+    """
+    lag = report['lag_ms']
+    print("***** Event loop lag, last %.0f seconds (%d probes) *****" %
+          (report['window'], report['probes']))
+    if report['probes']>0:
+        print("  p50 %.1f ms, p99 %.1f ms, max %.1f ms" %
+              (lag['p50'], lag['p99'], lag['max']))
+    print("  %d slow callbacks" % len(report['slow_callbacks']))
+    for (title, things) in (('OutputThing', report['slow_output_things']),
+                            ('InputThing', report['slow_input_things'])):
+        if len(things)==0:
+            continue
+        print("  %-50s %6s %10s %10s" % (title, 'count', 'total ms', 'max ms'))
+        for s in things:
+            print("  %-50s %6d %10.1f %10.1f" %
+                  (s['thing'][:50], s['count'], s['total_ms'], s['max_ms']))
@@ -0,0 +1,122 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+End-to-end latency tracking, from the time a sensor is sampled (or a reader
+receives a message) to the time a sink has handled the resulting event.
+
+When tracking is enabled, sources stamp each event's ingress time
+(monotonic nanoseconds) on thingflow.base.ingress_clock. This stamp is a
+side channel: it is not stored in the event, so it does not change the
+event types seen by filters. Sinks then record, per event:
+
+ * queue_ns      - time the event spent queued inside the sink (for example
+                   in a BlockingInputThing or AsyncInputThing) before
+                   processing started
+ * processing_ns - time taken to process (e.g. write) the event
+ * end_to_end_ns - time from ingress until processing completed
+
+For sinks that are plain InputThings, we wrap the connection to the sink
+(as for thingflow.metrics) and the queue time is always zero.
+BlockingInputThing and AsyncInputThing record their own latencies.
+
+Usually, you do not use this module directly, but call
+Scheduler.enable_latency_tracking(), Scheduler.disable_latency_tracking(),
+and Scheduler.latencies().
+"""
+from thingflow.base import ingress_clock, _monotonic_ns, _WrappedConnection,\
+                           _wrap_connections, _unwrap_connections
+from thingflow.metrics import LogHistogram
+
+
+class SinkLatency:
+    """Latency histograms for a single sink.
+    """
+    __slots__ = ('sink', 'queue_ns', 'processing_ns', 'end_to_end_ns')
+    def __init__(self, sink):
+        self.sink = sink
+        self.queue_ns = LogHistogram()
+        self.processing_ns = LogHistogram()
+        self.end_to_end_ns = LogHistogram()
+
+    def snapshot(self):
+        return {'sink':str(self.sink),
+                'queue_ns':self.queue_ns.summary(),
+                'processing_ns':self.processing_ns.summary(),
+                'end_to_end_ns':self.end_to_end_ns.summary()}
+
+
+class _LatencyConnection(_WrappedConnection):
+    __slots__ = ()
+
+
+class LatencyTracker:
+    """Tracks the latencies of the sinks reachable from a set of root
+    OutputThings. Since ingress_clock is global, only one tracker should be
+    enabled at a time.
+    """
+    def __init__(self):
+        self.sinks = {} # map from id(sink) to SinkLatency
+        self.instrumented = {} # map from id(output_thing) to output_thing
+
+    def _get_sink(self, sink):
+        s = self.sinks.get(id(sink))
+        if s is None:
+            s = self.sinks[id(sink)] = SinkLatency(sink)
+        return s
+
+    def record(self, sink, ingress_ns, enqueue_ns, start_ns, end_ns):
+        """Record the latencies for one event. This is the recorder called
+        by sinks via ingress_clock.recorder.
+        """
+        s = self._get_sink(sink)
+        s.queue_ns.record(start_ns - enqueue_ns)
+        s.processing_ns.record(end_ns - start_ns)
+        if ingress_ns is not None:
+            s.end_to_end_ns.record(end_ns - ingress_ns)
+
+    def _wrap_connection(self, connection):
+        original_on_next = connection.on_next
+        sink = connection.input_thing
+        record = self.record
+        get_ingress = ingress_clock.get
+        def on_next(x):
+            ingress_ns = get_ingress()
+            start_ns = _monotonic_ns()
+            original_on_next(x)
+            record(sink, ingress_ns, start_ns, start_ns, _monotonic_ns())
+        return _LatencyConnection(connection, on_next=on_next)
+
+    def enable(self, roots):
+        """Start stamping ingress times and wrap the connections to all the
+        plain sinks reachable from the roots.
+        """
+        def is_sink(thing):
+            if not hasattr(thing, '__connections__'):
+                return True
+            return not thing._has_connections()
+        def wrap(thing, port, connection, path):
+            input_thing = connection.input_thing
+            if is_sink(input_thing) and \
+               (not getattr(input_thing, '_records_latency', False)):
+                return self._wrap_connection(connection)
+            else:
+                return None
+        self.instrumented.update(
+            _wrap_connections(roots, _LatencyConnection, wrap))
+        ingress_clock.recorder = self.record
+        ingress_clock.enabled = True
+
+    def disable(self):
+        """Stop stamping ingress times and restore the original connections.
+        """
+        ingress_clock.enabled = False
+        ingress_clock.recorder = None
+        _unwrap_connections(self.instrumented.values(), _LatencyConnection)
+        self.instrumented = {}
+
+    def snapshot(self):
+        """Return a dict with the per-sink latency summaries (including
+        the p50, p99, and p999 percentiles), in nanoseconds.
+        """
+        return {'enabled':ingress_clock.recorder==self.record,
+                'sinks':[s.snapshot() for s in self.sinks.values()]}
@@ -0,0 +1,260 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+Low-overhead metrics for the nodes of a ThingFlow graph.
+
+Metrics are collected by replacing the connections between things with
+instrumented versions (similar to OutputThing.trace_downstream()). When
+metrics are disabled, the original connections are restored, so there is
+no cost in the dispatch path. Usually, you do not use this module directly,
+but call Scheduler.enable_metrics(), Scheduler.disable_metrics(), and
+Scheduler.metrics().
+
+For each InputThing, we record the events received, the on_error and
+on_completed notifications, exceptions raised by on_next(), and the
+time spent in on_next(). The time is the "self" time of the thing: time
+spent in things further downstream is subtracted out. Thus, sorting
+by total time identifies the slow nodes of a graph. For each OutputThing
+port, we record the number of on_next() calls made to its connections.
+"""
+import threading
+import time
+
+from thingflow.base import _WrappedConnection, _wrap_connections,\
+                           _unwrap_connections
+
+# time.perf_counter_ns() is not available before Python 3.7
+_perf_counter_ns = getattr(time, 'perf_counter_ns', None) or \
+                   (lambda: int(time.perf_counter()*1000000000))
+
+# Each power of two is divided into 2**SUB_BUCKET_BITS buckets, which
+# bounds the relative error of a recorded value to about 12%.
+SUB_BUCKET_BITS = 3
+_SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+_NUM_BUCKETS = (64 - SUB_BUCKET_BITS + 1)*_SUB_BUCKETS
+
+
+def _bucket_index(v):
+    if v < _SUB_BUCKETS:
+        return v
+    shift = v.bit_length() - 1 - SUB_BUCKET_BITS
+    return ((shift+1) << SUB_BUCKET_BITS) + (v >> shift) - _SUB_BUCKETS
+
+
+def _bucket_upper_bound(i):
+    """Return the largest value that falls into bucket i"""
+    if i < _SUB_BUCKETS:
+        return i
+    shift = (i >> SUB_BUCKET_BITS) - 1
+    mantissa = (i & (_SUB_BUCKETS-1)) + _SUB_BUCKETS
+    return ((mantissa+1) << shift) - 1
+
+
+class LogHistogram:
+    """A histogram of non-negative integer values (e.g. nanoseconds), using
+    logarithmic buckets in the style of HdrHistogram. Recording a value is
+    constant time and the memory used is fixed.
+    """
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+    def __init__(self):
+        self.counts = [0]*_NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, v):
+        if v < 0:
+            v = 0
+        self.counts[_bucket_index(v)] += 1
+        self.count += 1
+        self.total += v
+        if self.max is None or v > self.max:
+            self.max = v
+        if self.min is None or v < self.min:
+            self.min = v
+
+    def percentile(self, p):
+        """Return an upper bound for the p-th percentile (0-100) of the recorded
+        values, or None if no values have been recorded.
+        """
+        if self.count==0:
+            return None
+        target = max(1, int(round(self.count*p/100.0)))
+        seen = 0
+        for (i, c) in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return min(_bucket_upper_bound(i), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total/self.count if self.count>0 else None
+
+    def summary(self):
+        """Return a dict summarizing the histogram"""
+        return {'count':self.count, 'total':self.total, 'mean':self.mean(),
+                'min':self.min, 'max':self.max,
+                'p50':self.percentile(50), 'p90':self.percentile(90),
+                'p99':self.percentile(99), 'p999':self.percentile(99.9)}
+
+
+class InputThingMetrics:
+    """Counters for a single InputThing (summed over all of its ports).
+    """
+    __slots__ = ('input_thing', 'events_in', 'errors_in', 'completed_in',
+                 'exceptions', 'self_ns')
+    def __init__(self, input_thing):
+        self.input_thing = input_thing
+        self.events_in = 0
+        self.errors_in = 0
+        self.completed_in = 0
+        self.exceptions = 0
+        self.self_ns = LogHistogram()
+
+    def snapshot(self):
+        return {'thing':str(self.input_thing), 'events_in':self.events_in,
+                'errors_in':self.errors_in, 'completed_in':self.completed_in,
+                'exceptions':self.exceptions,
+                'self_ns':self.self_ns.summary()}
+
+
+class OutputPortMetrics:
+    """Counters for a single port of an OutputThing.
+    """
+    __slots__ = ('output_thing', 'port', 'events_out', 'errors_out',
+                 'completed_out')
+    def __init__(self, output_thing, port):
+        self.output_thing = output_thing
+        self.port = port
+        self.events_out = 0
+        self.errors_out = 0
+        self.completed_out = 0
+
+    def snapshot(self):
+        return {'thing':str(self.output_thing), 'port':self.port,
+                'events_out':self.events_out, 'errors_out':self.errors_out,
+                'completed_out':self.completed_out}
+
+
+class _TimingState(threading.local):
+    # nanoseconds spent in downstream on_next() calls by the current call
+    child_ns = 0
+
+_timing_state = _TimingState()
+
+
+class _InstrumentedConnection(_WrappedConnection):
+    __slots__ = ()
+
+
+def _instrument_connection(connection, port_metrics, thing_metrics):
+    original_on_next = connection.on_next
+    original_on_error = connection.on_error
+    original_on_completed = connection.on_completed
+    state = _timing_state
+    perf_counter_ns = _perf_counter_ns
+    record = thing_metrics.self_ns.record
+    def on_next(x):
+        port_metrics.events_out += 1
+        thing_metrics.events_in += 1
+        outer_child_ns = state.child_ns
+        state.child_ns = 0
+        start = perf_counter_ns()
+        try:
+            original_on_next(x)
+        except:
+            thing_metrics.exceptions += 1
+            raise
+        finally:
+            elapsed = perf_counter_ns() - start
+            record(elapsed - state.child_ns)
+            state.child_ns = outer_child_ns + elapsed
+    def on_error(e):
+        port_metrics.errors_out += 1
+        thing_metrics.errors_in += 1
+        original_on_error(e)
+    def on_completed():
+        port_metrics.completed_out += 1
+        thing_metrics.completed_in += 1
+        original_on_completed()
+    return _InstrumentedConnection(connection, on_next=on_next,
+                                   on_completed=on_completed,
+                                   on_error=on_error)
+
+
+class GraphMetrics:
+    """Collects the metrics for all the things reachable from a set of
+    root OutputThings. The metrics accumulate across calls to instrument()
+    and uninstrument(), until reset() is called.
+    """
+    def __init__(self):
+        self.input_metrics = {} # map from id(input_thing) to metrics
+        self.port_metrics = {}  # map from (id(output_thing), port) to metrics
+        self.instrumented = {}  # map from id(output_thing) to output_thing
+
+    def _get_input_metrics(self, thing):
+        m = self.input_metrics.get(id(thing))
+        if m is None:
+            m = self.input_metrics[id(thing)] = InputThingMetrics(thing)
+        return m
+
+    def _get_port_metrics(self, thing, port):
+        m = self.port_metrics.get((id(thing), port))
+        if m is None:
+            m = self.port_metrics[(id(thing), port)] = \
+                OutputPortMetrics(thing, port)
+        return m
+
+    def instrument(self, roots):
+        """Instrument all the connections reachable from the roots. This can
+        be called again to pick up connections that were added later.
+        """
+        def wrap(thing, port, connection, path):
+            return _instrument_connection(
+                connection, self._get_port_metrics(thing, port),
+                self._get_input_metrics(connection.input_thing))
+        self.instrumented.update(
+            _wrap_connections(roots, _InstrumentedConnection, wrap))
+
+    def uninstrument(self):
+        """Restore the original connections of all instrumented things.
+        """
+        _unwrap_connections(self.instrumented.values(),
+                            _InstrumentedConnection)
+        self.instrumented = {}
+
+    def reset(self):
+        """Zero all the metrics. Instrumented connections keep updating the
+        old metrics objects, so call this when not instrumented.
+        """
+        assert len(self.instrumented)==0, "Cannot reset while instrumented"
+        self.input_metrics = {}
+        self.port_metrics = {}
+
+    def snapshot(self):
+        """Return a dict with the current metrics. The inputs are sorted by
+        total self time, in descending order.
+        """
+        inputs = [m.snapshot() for m in self.input_metrics.values()]
+        inputs.sort(key=lambda s: s['self_ns']['total'], reverse=True)
+        return {'enabled': len(self.instrumented)>0,
+                'inputs': inputs,
+                'outputs': [m.snapshot() for m in self.port_metrics.values()]}
+
+
+def print_metrics(snapshot):
+    """Print a metrics snapshot as a table, slowest things first.
+    """
+    print("***** Metrics (enabled=%s) *****" % snapshot['enabled'])
+    print("  %-40s %10s %6s %12s %10s %10s" %
+          ('InputThing', 'events', 'excs', 'total ms', 'p50 ns', 'p99 ns'))
+    for m in snapshot['inputs']:
+        h = m['self_ns']
+        print("  %-40s %10d %6d %12.3f %10s %10s" %
+              (m['thing'][:40], m['events_in'], m['exceptions'],
+               h['total']/1000000.0, h['p50'], h['p99']))
+    print("  %-40s %10s" % ('OutputThing.port', 'events'))
+    for m in snapshot['outputs']:
+        print("  %-40s %10d" % (('%s.%s' % (m['thing'], m['port']))[:40],
+                                m['events_out']))
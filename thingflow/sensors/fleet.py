@@ -0,0 +1,335 @@
+# Copyright 2017 by MPI-SWS and Data-Ken Research.
+# Licensed under the Apache 2.0 License.
+"""
+A synthetic sensor fleet, for load and capacity testing.
+
+A SensorFleet simulates a set of sensors, each sampled at its own rate,
+and produces a single stream of SensorEvents, ordered by delivery time. We
+can configure the shape of the load:
+
+ * rate - events/second for each sensor (one number or a list, one per sensor)
+ * values - a value model (see gaussian(), uniform(), sine(), and
+   random_walk() below)
+ * burstiness - the coefficient of variation of the time between samples.
+   0 gives evenly spaced samples, 1 gives Poisson arrivals, and larger values
+   give increasingly bursty traffic.
+ * out_of_order - the fraction of events that are delivered late. The
+   timestamp of a late event is up to max_lateness seconds before its
+   delivery time, so timestamps are no longer monotonic.
+ * dropout - the probability that, at any given sample, a sensor drops out.
+   It stays offline for an exponentially distributed time with mean
+   mean_dropout_duration seconds.
+
+The fleet runs in virtual time and the events are generated from a seeded
+random number generator, so a given configuration always produces the same
+events. There are several ways to use the events:
+
+ * FleetOutputThing - an OutputThing that dispatches the events (singly or
+   in batches) into a graph, either as fast as possible or paced in real time
+ * SensorFleet.write_csv() and SensorFleet.write_binary() - write the events
+   to a file, to be replayed later (see read_binary())
+ * SensorFleet.publish() - publish the events via an MQTT client (e.g. a paho
+   client connected to a local broker or thingflow.adapters.mqtt.MockMQTTClient)
+
+Example::
+
+    fleet = SensorFleet(1000, rate=10, burstiness=1.0, dropout=0.001, seed=1)
+    o = FleetOutputThing(fleet, duration=60, batch_size=100)
+    o.connect(my_pipeline)
+    scheduler.schedule_recurring(o)
+"""
+import csv as csvlib
+import heapq
+import json
+import math
+import random
+import struct
+import time
+
+from thingflow.base import OutputThing, DirectOutputThingMixin, SensorEvent,\
+                           ingress_clock
+
+
+###########################################################################
+#                          Value models                                    #
+###########################################################################
+# A value model is a function that takes the random number generator and the
+# number of sensors, and returns a function from (sensor index, time offset)
+# to a sample value. This lets models keep per-run state (e.g. a random walk).
+
+def gaussian(mean=100.0, stddev=20.0):
+    """Independent, normally distributed samples.
+    """
+    def model(rng, num_sensors):
+        return lambda i, t: rng.gauss(mean, stddev)
+    return model
+
+
+def uniform(low=0.0, high=100.0):
+    """Independent, uniformly distributed samples.
+    """
+    def model(rng, num_sensors):
+        return lambda i, t: rng.uniform(low, high)
+    return model
+
+
+def sine(mean=100.0, amplitude=10.0, period=60.0, noise=0.0):
+    """A sine wave over time, with gaussian noise of the specified stddev.
+    Each sensor gets a random phase.
+    """
+    def model(rng, num_sensors):
+        phases = [rng.uniform(0, 2*math.pi) for i in range(num_sensors)]
+        w = 2*math.pi/period
+        def value(i, t):
+            v = mean + amplitude*math.sin(w*t + phases[i])
+            return v + rng.gauss(0, noise) if noise else v
+        return value
+    return model
+
+
+def random_walk(start=100.0, stddev=1.0):
+    """Each sensor's value takes a normally distributed step from its
+    previous value.
+    """
+    def model(rng, num_sensors):
+        current = [start]*num_sensors
+        def value(i, t):
+            current[i] += rng.gauss(0, stddev)
+            return current[i]
+        return value
+    return model
+
+
+###########################################################################
+#                          The fleet                                       #
+###########################################################################
+
+# Binary file format: one little-endian record per event, containing the
+# sensor id (unsigned 32 bit int), the timestamp, and the value (doubles).
+BINARY_RECORD = struct.Struct('<Idd')
+
+
+class SensorFleet:
+    """Simulate num_sensors sensors. See the module documentation for the
+    meaning of the parameters. sensor_ids is an optional list of ids; by
+    default the sensors are numbered from 0.
+    """
+    def __init__(self, num_sensors, rate=1.0, values=gaussian(),
+                 burstiness=0.0, out_of_order=0.0, max_lateness=1.0,
+                 dropout=0.0, mean_dropout_duration=10.0, sensor_ids=None,
+                 seed=None):
+        if isinstance(rate, (int, float)):
+            rates = [float(rate)]*num_sensors
+        else:
+            rates = [float(r) for r in rate]
+        if len(rates)!=num_sensors:
+            raise ValueError("Got %d rates for %d sensors" %
+                             (len(rates), num_sensors))
+        if any(r<=0 for r in rates):
+            raise ValueError("Sensor rates must be positive")
+        if burstiness<0:
+            raise ValueError("burstiness must be non-negative")
+        if sensor_ids is None:
+            sensor_ids = list(range(num_sensors))
+        elif len(sensor_ids)!=num_sensors:
+            raise ValueError("Got %d sensor ids for %d sensors" %
+                             (len(sensor_ids), num_sensors))
+        self.num_sensors = num_sensors
+        self.rates = rates
+        self.values = values
+        self.burstiness = burstiness
+        self.out_of_order = out_of_order
+        self.max_lateness = max_lateness
+        self.dropout = dropout
+        self.mean_dropout_duration = mean_dropout_duration
+        self.sensor_ids = sensor_ids
+        self.seed = seed
+
+    def _interval_fn(self, rng):
+        b = self.burstiness
+        if b==0:
+            return lambda mean: mean
+        # A gamma distribution with shape k has a coefficient of variation
+        # of 1/sqrt(k).
+        k = 1.0/(b*b)
+        return lambda mean: rng.gammavariate(k, mean/k)
+
+    def events(self, start_ts=0.0, max_events=None, duration=None):
+        """Generate (delivery_ts, SensorEvent) pairs, in order of delivery
+        time. Times are offsets (in seconds) from start_ts. The generator
+        stops after max_events events or duration seconds of virtual time,
+        or runs forever if neither is specified.
+        """
+        rng = random.Random(self.seed)
+        value_fn = self.values(rng, self.num_sensors)
+        interval_fn = self._interval_fn(rng)
+        means = [1.0/r for r in self.rates]
+        offline_until = [0.0]*self.num_sensors
+        # start each sensor at a random phase, so they are not synchronized
+        heap = [(rng.uniform(0, means[i]), i) for i in range(self.num_sensors)]
+        heapq.heapify(heap)
+        count = 0
+        while len(heap)>0:
+            if max_events is not None and count>=max_events:
+                return
+            (due, i) = heap[0]
+            if duration is not None and due>duration:
+                return
+            heapq.heapreplace(heap, (due + interval_fn(means[i]), i))
+            if due<offline_until[i]:
+                continue
+            if self.dropout and rng.random()<self.dropout:
+                offline_until[i] = \
+                    due + rng.expovariate(1.0/self.mean_dropout_duration)
+                continue
+            ts = due
+            if self.out_of_order and rng.random()<self.out_of_order:
+                ts = max(0.0, due - rng.uniform(0, self.max_lateness))
+            count += 1
+            yield (start_ts+due,
+                   SensorEvent(sensor_id=self.sensor_ids[i], ts=start_ts+ts,
+                               val=value_fn(i, due)))
+
+    def sensor_events(self, start_ts=0.0, max_events=None, duration=None):
+        """Like events(), but just generate the SensorEvents.
+        """
+        for (delivery_ts, event) in self.events(start_ts, max_events,
+                                                duration):
+            yield event
+
+    def write_csv(self, filename, start_ts=0.0, max_events=None,
+                  duration=None):
+        """Write the events to a CSV file in the format used by
+        thingflow.adapters.csv. Returns the number of events written.
+        """
+        from thingflow.adapters.csv import default_event_mapper
+        cnt = 0
+        with open(filename, 'w', newline='') as f:
+            writer = csvlib.writer(f)
+            writer.writerow(default_event_mapper.get_header_row())
+            for event in self.sensor_events(start_ts, max_events, duration):
+                writer.writerow(default_event_mapper.event_to_row(event))
+                cnt += 1
+        return cnt
+
+    def write_binary(self, filename, start_ts=0.0, max_events=None,
+                     duration=None):
+        """Write the events to a file of BINARY_RECORDs. The sensor ids must
+        be non-negative integers. Returns the number of events written.
+        """
+        cnt = 0
+        pack = BINARY_RECORD.pack
+        with open(filename, 'wb') as f:
+            for event in self.sensor_events(start_ts, max_events, duration):
+                f.write(pack(event.sensor_id, event.ts, event.val))
+                cnt += 1
+        return cnt
+
+    def publish(self, client, topic_prefix='sensors', qos=0, start_ts=0.0,
+                max_events=None, duration=None):
+        """Publish each event via client.publish(), using the paho-mqtt API.
+        The topic is TOPIC_PREFIX/SENSOR_ID and the payload is the JSON
+        encoding of the event (as with thingflow.filters.json.to_json()).
+        Returns the number of events published.
+        """
+        cnt = 0
+        for event in self.sensor_events(start_ts, max_events, duration):
+            client.publish('%s/%s' % (topic_prefix, event.sensor_id),
+                           json.dumps(event), qos)
+            cnt += 1
+        return cnt
+
+    def __repr__(self):
+        return 'SensorFleet(%d sensors, seed=%s)' % (self.num_sensors,
+                                                     self.seed)
+
+
+def read_binary(filename):
+    """Generate the SensorEvents from a file written by
+    SensorFleet.write_binary(). To replay the file in a graph, use
+    from_iterable(read_binary(filename)).
+    """
+    size = BINARY_RECORD.size
+    unpack = BINARY_RECORD.unpack
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(size)
+            if len(data)<size:
+                return
+            (sensor_id, ts, val) = unpack(data)
+            yield SensorEvent(sensor_id=sensor_id, ts=ts, val=val)
+
+
+class FleetOutputThing(OutputThing, DirectOutputThingMixin):
+    """Dispatch the events of a SensorFleet. The timestamps start at the
+    current time. If batch_size is specified, the events are dispatched as
+    lists of up to batch_size events, otherwise they are dispatched singly.
+
+    If realtime is False, each call to _observe() dispatches one event (or
+    one batch), as fast as possible. Schedule via
+    Scheduler.schedule_recurring().
+
+    If realtime is True, the events are paced by their delivery times: each
+    call to _observe() dispatches all the events that have become due since
+    the last call. Schedule via Scheduler.schedule_periodic(), where the
+    interval is the tick (e.g. 0.01 seconds).
+    """
+    def __init__(self, fleet, max_events=None, duration=None, batch_size=None,
+                 realtime=False, name=None):
+        super().__init__()
+        self.fleet = fleet
+        self.batch_size = batch_size
+        self.realtime = realtime
+        self.name = name
+        self.start_ts = time.time()
+        self.iterator = fleet.events(self.start_ts, max_events, duration)
+        self.pending = None # next (delivery_ts, event) pair, in realtime mode
+        self.events_dispatched = 0
+
+    def _next_events(self):
+        """Return a list of the events to be dispatched now. An empty list
+        means that there are no events due (in realtime mode), and None means
+        that the fleet is done.
+        """
+        events = []
+        if self.realtime:
+            now = time.time()
+            while True:
+                if self.pending is None:
+                    self.pending = next(self.iterator, None)
+                    if self.pending is None:
+                        return events if len(events)>0 else None
+                if self.pending[0]>now:
+                    return events
+                events.append(self.pending[1])
+                self.pending = None
+        else:
+            n = self.batch_size or 1
+            for (delivery_ts, event) in self.iterator:
+                events.append(event)
+                if len(events)==n:
+                    break
+            return events if len(events)>0 else None
+
+    def _observe(self):
+        events = self._next_events()
+        if events is None:
+            self._dispatch_completed()
+            return
+        if len(events)==0:
+            return
+        if ingress_clock.enabled:
+            ingress_clock.stamp()
+        self.events_dispatched += len(events)
+        if self.batch_size is None:
+            for event in events:
+                self._dispatch_next(event)
+        else:
+            for i in range(0, len(events), self.batch_size):
+                self._dispatch_next(events[i:i+self.batch_size])
+
+    def __str__(self):
+        if self.name:
+            return self.name
+        else:
+            return 'FleetOutputThing(%s)' % repr(self.fleet)